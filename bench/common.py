@@ -0,0 +1,35 @@
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import yaml
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def write_bot_config(config_dir, mongodb_uri="mongodb://localhost:27017", **overrides):
+    # a config directory for the bot based on config.example.yml, top-level keys can be overridden
+    config_dir = Path(config_dir)
+    with open(ROOT_DIR / "config" / "config.example.yml") as f:
+        config_yaml = yaml.safe_load(f)
+
+    config_yaml["telegram_token"] = "123456:BENCHMARK"
+    config_yaml["openai_api_key"] = "sk-benchmark"
+    config_yaml["long_dialog"]["files_dir"] = str(config_dir / "long_dialogs")
+    (config_dir / "long_dialogs").mkdir(exist_ok=True)
+    config_yaml.update(overrides)
+
+    with open(config_dir / "config.yml", "w") as f:
+        yaml.safe_dump(config_yaml, f)
+    with open(config_dir / "config.env", "w") as f:
+        f.write(f"MONGODB_PORT=27017\nMONGODB_URI={mongodb_uri}\n")
+    for file_name in ("chat_modes.yml", "models.yml"):
+        shutil.copy(ROOT_DIR / "config" / file_name, config_dir / file_name)
+
+
+def use_bot_config(config_dir):
+    # must be called before the first import of a bot module
+    os.environ["BOT_CONFIG_DIR"] = str(config_dir)
+    sys.path.insert(0, str(ROOT_DIR / "bot"))
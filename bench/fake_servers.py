@@ -0,0 +1,160 @@
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+
+FAKE_BOT_ID = 1000000
+FAKE_BOT_USERNAME = "load_test_bot"
+
+
+def build_fake_openai_app(first_token_latency_sec=0.5, tokens_per_sec=50.0, n_answer_tokens=200):
+    # OpenAI-compatible completions with SSE streaming, the answer is n_answer_tokens words,
+    # GET /stats returns how many streams were completed or aborted by the client and the tokens sent
+    answer_tokens = [f"word{i % 100} " for i in range(n_answer_tokens)]
+    stats = {"completed_streams": 0, "aborted_streams": 0, "streamed_tokens": 0}
+
+    def chunk(object_type, model, choice):
+        return {
+            "id": "fake",
+            "object": object_type,
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": None, **choice}],
+        }
+
+    async def stream(request, object_type, model, make_choice, role_choice=None):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        try:
+            await asyncio.sleep(first_token_latency_sec)
+            if role_choice is not None:
+                await response.write(f"data: {json.dumps(chunk(object_type, model, role_choice))}\n\n".encode())
+            for token in answer_tokens:
+                await response.write(f"data: {json.dumps(chunk(object_type, model, make_choice(token)))}\n\n".encode())
+                stats["streamed_tokens"] += 1
+                await asyncio.sleep(1 / tokens_per_sec)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except asyncio.CancelledError:  # the client closed the connection
+            stats["aborted_streams"] += 1
+            raise
+        except ConnectionError:
+            stats["aborted_streams"] += 1
+            return response
+        stats["completed_streams"] += 1
+        return response
+
+    def usage(n_prompt_tokens):
+        return {
+            "prompt_tokens": n_prompt_tokens,
+            "completion_tokens": n_answer_tokens,
+            "total_tokens": n_prompt_tokens + n_answer_tokens,
+        }
+
+    async def chat_completions(request):
+        body = await request.json()
+        model = body.get("model", "gpt-3.5-turbo")
+        if body.get("stream"):
+            return await stream(
+                request, "chat.completion.chunk", model,
+                lambda token: {"delta": {"content": token}},
+                role_choice={"delta": {"role": "assistant"}}
+            )
+
+        await asyncio.sleep(first_token_latency_sec + n_answer_tokens / tokens_per_sec)
+        n_prompt_tokens = sum(len(message["content"].split()) for message in body["messages"])
+        return web.json_response({
+            "id": "fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "".join(answer_tokens)}}],
+            "usage": usage(n_prompt_tokens),
+        })
+
+    async def completions(request):
+        body = await request.json()
+        model = body.get("model", body.get("engine", "text-davinci-003"))
+        if body.get("stream"):
+            return await stream(request, "text_completion", model, lambda token: {"text": token})
+
+        await asyncio.sleep(first_token_latency_sec + n_answer_tokens / tokens_per_sec)
+        return web.json_response({
+            "id": "fake",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "text": "".join(answer_tokens)}],
+            "usage": usage(len(body["prompt"].split())),
+        })
+
+    async def moderations(request):
+        return web.json_response({"id": "fake", "model": "fake", "results": [{"flagged": False, "categories": {}}]})
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/completions", completions)
+    app.router.add_post("/v1/engines/{engine}/completions", completions)
+    app.router.add_post("/v1/moderations", moderations)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+def build_fake_telegram_app(latency_sec=0.0):
+    # the subset of the Bot API used by the handlers, GET /stats returns request counters
+    message_ids = itertools.count(1)
+    stats = {"requests": {}, "error_replies": 0}
+
+    def message(chat_id, text):
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "Bot", "username": FAKE_BOT_USERNAME},
+            "text": text,
+        }
+
+    async def bot_api(request):
+        method = request.match_info["method"]
+        stats["requests"][method] = stats["requests"].get(method, 0) + 1
+        if latency_sec > 0:
+            await asyncio.sleep(latency_sec)
+
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+
+        if method == "getMe":
+            result = {
+                "id": FAKE_BOT_ID, "is_bot": True, "first_name": "Bot", "username": FAKE_BOT_USERNAME,
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False,
+            }
+        elif method in {"sendMessage", "editMessageText"}:
+            text = data.get("text", "")
+            if text.startswith("Something went wrong"):
+                stats["error_replies"] += 1
+            result = message(int(data.get("chat_id", 0)), text)
+        else:  # sendChatAction, setMyCommands, answerCallbackQuery, ...
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", bot_api)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+def serve(app, port):
+    web.run_app(app, host="127.0.0.1", port=port, print=None, handle_signals=False)
@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import common
+import fake_servers
+
+
+IN_MEMORY_MONGODB = "memory"
+LLM_PROVIDERS = ("fake_server", "mock")
+SERVER_START_TIMEOUT_SEC = 10.0
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SEC
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Fake server on port {port} did not start")
+
+
+def run_fake_openai(port, options):
+    fake_servers.serve(fake_servers.build_fake_openai_app(**options), port)
+
+
+def run_fake_telegram(port, latency_sec):
+    fake_servers.serve(fake_servers.build_fake_telegram_app(latency_sec=latency_sec), port)
+
+
+def get_openai_options(args):
+    return {
+        "first_token_latency_sec": args.first_token_latency,
+        "tokens_per_sec": args.tokens_per_sec,
+        "n_answer_tokens": args.answer_tokens,
+    }
+
+
+def import_bot(args, config_dir):
+    if args.llm_provider == "mock":  # in the bot process, without HTTP
+        llm_provider = {"type": "mock", "mock": get_openai_options(args)}
+    else:
+        llm_provider = {"type": "openai"}
+
+    common.write_bot_config(
+        config_dir,
+        mongodb_uri="mongodb://localhost:27017" if args.mongodb_uri == IN_MEMORY_MONGODB else args.mongodb_uri,
+        openai_api_base=f"http://127.0.0.1:{args.openai_port}/v1",
+        enable_message_streaming=not args.no_streaming,
+        llm_provider=llm_provider
+    )
+    common.use_bot_config(config_dir)
+
+    if args.mongodb_uri == IN_MEMORY_MONGODB:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("In-memory MongoDB requires mongomock: pip install -r bench/requirements.txt")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+    import bot
+    return bot
+
+
+def make_text_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        }
+    }
+
+
+def histogram_quantile(histogram, q):
+    # like histogram_quantile() of Prometheus: linear interpolation inside the bucket holding the quantile
+    buckets = [
+        (float(sample.labels["le"]), sample.value)
+        for metric in histogram.collect() for sample in metric.samples if sample.name.endswith("_bucket")
+    ]
+    n_total = buckets[-1][1] if buckets else 0
+    if n_total == 0:
+        return float("nan")
+
+    rank = q * n_total
+    prev_upper_bound, prev_count = 0.0, 0.0
+    for upper_bound, count in buckets:
+        if count >= rank:
+            if upper_bound == float("inf"):
+                return prev_upper_bound
+            return prev_upper_bound + (upper_bound - prev_upper_bound) * (rank - prev_count) / max(count - prev_count, 1)
+        prev_upper_bound, prev_count = upper_bound, count
+    return prev_upper_bound
+
+
+def percentile(sorted_values, p):
+    # nearest-rank percentile
+    if not sorted_values:
+        return float("nan")
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def drive(bot, args, telegram_port):
+    from telegram import Update
+
+    application = bot.build_application(base_url=f"http://127.0.0.1:{telegram_port}/bot")
+    await application.initialize()
+
+    update_ids = itertools.count(1)
+    latencies = []
+
+    async def simulate_user(user_id):
+        for i in range(args.messages_per_user):
+            update_data = make_text_update(next(update_ids), user_id, f"Message {i}: {args.message_text}")
+            update = Update.de_json(update_data, application.bot)
+
+            start_time = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_cpu_time = time.process_time()
+    start_time = time.perf_counter()
+    await asyncio.gather(*(simulate_user(args.first_user_id + i) for i in range(args.users)))
+    elapsed_time = time.perf_counter() - start_time
+    cpu_time = time.process_time() - start_cpu_time
+
+    await application.shutdown()
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{telegram_port}/stats") as response:
+        telegram_stats = json.load(response)
+
+    latencies.sort()
+    n_messages = len(latencies)
+    return {
+        "users": args.users,
+        "messages": n_messages,
+        "error_replies": telegram_stats["error_replies"],
+        "elapsed_sec": elapsed_time,
+        "messages_per_sec": n_messages / elapsed_time,
+        "latency_sec": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else float("nan"),
+        },
+        "time_to_first_token_sec": {
+            "p50": histogram_quantile(bot.metrics.TIME_TO_FIRST_TOKEN, 0.5),
+            "p95": histogram_quantile(bot.metrics.TIME_TO_FIRST_TOKEN, 0.95),
+        },
+        "cpu_ms_per_message": cpu_time * 1000 / max(n_messages, 1),
+        "telegram_requests": telegram_stats["requests"],
+    }
+
+
+def print_report(report):
+    latency = report["latency_sec"]
+    print(f"users: {report['users']}, messages: {report['messages']}, error replies: {report['error_replies']}")
+    print(f"throughput: {report['messages_per_sec']:.2f} messages/sec over {report['elapsed_sec']:.2f} sec")
+    print(f"latency: p50 {latency['p50']:.3f}s, p95 {latency['p95']:.3f}s, p99 {latency['p99']:.3f}s, max {latency['max']:.3f}s")
+    ttft = report["time_to_first_token_sec"]
+    print(f"time to first token: p50 {ttft['p50']:.3f}s, p95 {ttft['p95']:.3f}s (estimated from histogram buckets)")
+    print(f"cpu: {report['cpu_ms_per_message']:.2f} ms per message")
+    print(f"telegram requests: {report['telegram_requests']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the bot handlers against fake Telegram and OpenAI servers")
+    parser.add_argument("--users", type=int, default=20, help="concurrently active users")
+    parser.add_argument("--messages-per-user", type=int, default=5)
+    parser.add_argument("--first-user-id", type=int, default=1)
+    parser.add_argument("--message-text", default="Tell me something interesting about load testing.")
+    parser.add_argument("--no-streaming", action="store_true", help="disable enable_message_streaming")
+    parser.add_argument("--first-token-latency", type=float, default=0.5, help="fake OpenAI latency before the first token, sec")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="fake OpenAI token rate")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="tokens in every fake answer")
+    parser.add_argument("--llm-provider", choices=LLM_PROVIDERS, default="fake_server", help="answer with the fake OpenAI server or with the mock provider of the bot")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="fake Telegram latency of every request, sec")
+    parser.add_argument("--mongodb-uri", default=IN_MEMORY_MONGODB, help=f"MongoDB to use, '{IN_MEMORY_MONGODB}' for mongomock")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    openai_port, telegram_port = get_free_port(), get_free_port()
+    args.openai_port = openai_port
+    servers = [multiprocessing.Process(target=run_fake_telegram, args=(telegram_port, args.telegram_latency), daemon=True)]
+    if args.llm_provider == "fake_server":
+        servers.append(multiprocessing.Process(target=run_fake_openai, args=(openai_port, get_openai_options(args)), daemon=True))
+    for server in servers:
+        server.start()
+
+    try:
+        wait_for_port(telegram_port)
+        if args.llm_provider == "fake_server":
+            wait_for_port(openai_port)
+
+        with tempfile.TemporaryDirectory() as config_dir:
+            bot = import_bot(args, Path(config_dir))
+            report = asyncio.run(drive(bot, args, telegram_port))
+    finally:
+        for server in servers:
+            server.terminate()
+
+    print_report(report)
+    if args.json_path is not None:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
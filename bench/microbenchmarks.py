@@ -0,0 +1,259 @@
+import argparse
+import datetime
+import json
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import common
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+DEFAULT_LARGE_MESSAGE_KB = 100
+DEFAULT_REPEAT = 7
+MIN_SAMPLE_SEC = 0.01
+MODEL = "gpt-3.5-turbo-16k"
+WORDS = "the quick brown fox jumps over lazy dog while bot answers user questions about python code".split()
+
+
+def make_text(rng, n_words):
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def make_dialog_messages(n_turns, seed=0):
+    rng = random.Random(seed)
+    dialog_messages = []
+    for _ in range(n_turns):
+        user, bot = make_text(rng, rng.randint(5, 40)), make_text(rng, rng.randint(20, 120))
+        dialog_messages.append({
+            "user": user,
+            "bot": bot,
+            "date": datetime.datetime(2023, 1, 1),
+            "n_tokens": len(user.split()) + len(bot.split()),
+        })
+    return dialog_messages
+
+
+def make_large_text(n_bytes, seed=0):
+    rng = random.Random(seed)
+    words, size = [], 0
+    while size < n_bytes:
+        words.append(rng.choice(WORDS))
+        size += len(words[-1]) + 1
+    return " ".join(words)[:n_bytes]
+
+
+def make_custom_settings_message(n_words, seed=0):
+    rng = random.Random(seed)
+    return (
+        f"PROMPT: {make_text(rng, n_words // 2)}\n"
+        f"PREV: {make_text(rng, n_words // 2)}\n"
+        f"SUMMARY_FORMAT: Use bullet points."
+    )
+
+
+class Benchmark:
+    # fn(*setup()) is timed; stateful benchmarks need a fresh setup for every call
+    def __init__(self, name, size, setup, fn, stateful=False):
+        self.name = name
+        self.size = size
+        self.setup = setup
+        self.fn = fn
+        self.stateful = stateful
+
+    @property
+    def key(self):
+        return f"{self.name}[{self.size}]"
+
+    def run(self, repeat):
+        number = 1 if self.stateful else self._calibrate()
+
+        samples = []
+        for _ in range(repeat):
+            args = self.setup()
+            start_time = time.perf_counter()
+            for _ in range(number):
+                self.fn(*args)
+            samples.append((time.perf_counter() - start_time) / number)
+
+        return {
+            "min_sec": min(samples),
+            "median_sec": statistics.median(samples),
+            "number": number,
+            "repeat": repeat,
+        }
+
+    def _calibrate(self):
+        args = self.setup()
+        number = 1
+        while True:
+            start_time = time.perf_counter()
+            for _ in range(number):
+                self.fn(*args)
+            if time.perf_counter() - start_time >= MIN_SAMPLE_SEC:
+                return number
+            number *= 2
+
+
+def build_benchmarks(sizes, files_dir, large_message_kb=DEFAULT_LARGE_MESSAGE_KB):
+    import dialog_keeper
+    import openai_utils
+
+    def new_keeper(enable_complete_data_file=False):
+        keeper = dialog_keeper.DialogKeeper(user_id=1)
+        keeper.start_new_dialog(MODEL, "custom")
+        keeper._set_new_dialog("You are a helpful assistant.", "We talked about Python.", None)
+        keeper._metadata_file_path = Path(files_dir) / "1.yml"
+        keeper._complete_data_file_path = Path(files_dir) / "1__2023-01-01.yml" if enable_complete_data_file else None
+        return keeper
+
+    def collect_long_dialog(keeper, message, dialog_messages):
+        keeper._n_tokens_since_summary_request = 0  # every call takes the same branch
+        keeper._collect_long_dialog(message, dialog_messages)
+
+    chatgpt = openai_utils.ChatGPT(model=MODEL)
+    benchmarks = []
+    for size in sizes:
+        dialog_messages = make_dialog_messages(size)
+        message = make_text(random.Random(size), 30)
+
+        keeper = new_keeper()
+        benchmarks.append(Benchmark(
+            "DialogKeeper._collect_long_dialog", size,
+            lambda keeper=keeper, dialog_messages=dialog_messages, message=message: (keeper, message, dialog_messages),
+            collect_long_dialog
+        ))
+
+        keywords_message = " ".join([dialog_keeper.UserKeywords.ADD_TO_IMPORTANT_MESSAGES.value, make_text(random.Random(size), size)])
+        benchmarks.append(Benchmark(
+            "parse_keywords", size,
+            lambda keywords_message=keywords_message: (keywords_message,),
+            dialog_keeper.parse_keywords
+        ))
+
+        custom_settings_message = make_custom_settings_message(size)
+        benchmarks.append(Benchmark(
+            "parse_custom_settings", size,
+            lambda custom_settings_message=custom_settings_message: (custom_settings_message,),
+            dialog_keeper.parse_custom_settings
+        ))
+
+        benchmarks.append(Benchmark(
+            "ChatGPT._generate_api_options", size,
+            lambda dialog_messages=dialog_messages, message=message: (message, dialog_messages),
+            lambda message, dialog_messages: chatgpt._generate_api_options(message, dialog_messages, "assistant", None)
+        ))
+
+        messages, _ = chatgpt._generate_api_options(message, dialog_messages, "assistant", None)
+        answer = make_text(random.Random(size), 200)
+        benchmarks.append(Benchmark(
+            "ChatGPT._count_tokens_from_messages", size,
+            lambda messages=messages, answer=answer: (messages, answer),
+            lambda messages, answer: chatgpt._count_tokens_from_messages(messages, answer, model=MODEL)
+        ))
+
+        def save_to_file_setup(dialog_messages=dialog_messages):
+            for path in Path(files_dir).iterdir():
+                path.unlink()
+            keeper = new_keeper(enable_complete_data_file=True)
+            keeper._unsaved_dialog = list(dialog_messages)
+            return (keeper,)
+
+        benchmarks.append(Benchmark(
+            "DialogKeeper._save_to_file", size,
+            save_to_file_setup,
+            lambda keeper: keeper._save_to_file(),
+            stateful=True
+        ))
+
+    if large_message_kb > 0:
+        # a pasted document, keywords and sections at the end are found only after scanning all of it
+        size = f"{large_message_kb}KB"
+        large_text = make_large_text(large_message_kb * 1024)
+        keywords_message = f"{large_text} {dialog_keeper.UserKeywords.ADD_TO_IMPORTANT_MESSAGES.value}"
+        benchmarks.append(Benchmark(
+            "parse_keywords", size,
+            lambda: (keywords_message,),
+            dialog_keeper.parse_keywords
+        ))
+
+        half = len(large_text) // 2
+        custom_settings_message = f"PROMPT: {large_text[:half]}\nPREV: {large_text[half:]}\nSUMMARY_FORMAT: Use bullet points."
+        benchmarks.append(Benchmark(
+            "parse_custom_settings", size,
+            lambda: (custom_settings_message,),
+            dialog_keeper.parse_custom_settings
+        ))
+
+    return benchmarks
+
+
+def compare(results, baseline, fail_threshold):
+    # returns keys that became slower than fail_threshold times the baseline median
+    regressions = []
+    print(f"{'benchmark':<50} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        baseline_sec, current_sec = baseline[key]["median_sec"], result["median_sec"]
+        ratio = current_sec / baseline_sec if baseline_sec > 0 else float("inf")
+        mark = ""
+        if ratio > fail_threshold:
+            regressions.append(key)
+            mark = " REGRESSION"
+        print(f"{key:<50} {baseline_sec * 1e3:>10.3f}ms {current_sec * 1e3:>10.3f}ms {ratio:>7.2f}x{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of DialogKeeper and openai_utils hot functions")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="dialog turns / message words, comma separated")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--large-message-kb", type=int, default=DEFAULT_LARGE_MESSAGE_KB, help="size of the pasted message of the parser benchmarks, 0 to skip them")
+    parser.add_argument("--filter", default="", help="run only benchmarks whose name contains this string")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results saved by --output")
+    parser.add_argument("--fail-threshold", type=float, default=1.25, help="exit with 1 if a benchmark is this many times slower than the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_dir, files_dir = Path(tmp_dir) / "config", Path(tmp_dir) / "files"
+        config_dir.mkdir()
+        files_dir.mkdir()
+        common.write_bot_config(config_dir)
+        common.use_bot_config(config_dir)
+
+        sizes = [int(size) for size in args.sizes.split(",")]
+        results = {}
+        for benchmark in build_benchmarks(sizes, files_dir, args.large_message_kb):
+            if args.filter not in benchmark.name:
+                continue
+            results[benchmark.key] = benchmark.run(args.repeat)
+            print(f"{benchmark.key:<50} {results[benchmark.key]['median_sec'] * 1e3:>10.3f}ms", flush=True)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.datetime.now().isoformat(),
+        },
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print()
+        if compare(results, baseline, args.fail_threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,19 @@
+import startup  # first, so that the startup profile includes the imports below
+
 import os
+import signal
 import logging
 import asyncio
+import contextvars
+import functools
 import traceback
 import html
 import json
 import tempfile
-import pydub
+import time
+import importlib
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 import openai
 
 import telegram
@@ -25,24 +31,56 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
-    AIORateLimiter,
+    TypeHandler,
     filters
 )
 from telegram.constants import ParseMode, ChatAction
 
 import config
 import database
+import manage
+import metrics
+import sharding
+import shutdown
+import tracing
 import openai_utils
 import dialog_keeper
+import group_chats
+import quota
+import routing
+
+startup.profile.mark("imports")
 
 
 # setup
-db = database.Database()
+db = database.Database(bootstrap=False)  # bootstrapped in the background after post_init
 states = {}
 logger = logging.getLogger(__name__)
 
 user_semaphores = {}
 user_tasks = {}
+user_message_queues = {}  # user_id -> [(update, message, received_time)] received while the previous answer was generated
+chat_semaphores = {}  # group chat mode, per group chat
+chat_message_queues = {}  # chat_id -> [(update, message)] of mentions waiting for the next batch
+chat_wait_tasks = {}  # chat_id -> task waiting for the batch window or the rate limit of the chat
+chat_rate_limiter = group_chats.ChatRateLimiter(config.group_chat_config.max_completions_per_min)
+registered_user_ids = set()  # users already registered and migrated by this process
+background_tasks = []
+worker_index = None  # set in worker processes of the supervisor mode
+shutdown_coordinator = shutdown.ShutdownCoordinator(user_tasks, config.shutdown_drain_timeout_sec, waiting_tasks=chat_wait_tasks)
+model_router = routing.ModelRouter(config.model_routing_config)
+quotas = quota.QuotaEngine(config.quota_config, quota.QuotaStore(db.quota_usage_collection))
+
+db.profiler.listeners.append(metrics.observe_mongo_call)
+metrics.track_user_state(user_semaphores, user_tasks)
+startup.profile.mark("setup")
+
+USAGE_AGGREGATION_OVERLAP = timedelta(hours=1)
+
+PARSE_MODES = {
+    "html": ParseMode.HTML,
+    "markdown": ParseMode.MARKDOWN
+}
 
 HELP_MESSAGE = """Commands:
 ⚪ /retry – Regenerate last bot answer
@@ -69,53 +107,113 @@ For example: "{bot_username} write a poem about Telegram"
 """
 
 
+def with_unit_of_work(handler):
+    # database writes made while handling an update are committed together when the handler returns
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        with db.unit_of_work():
+            return await handler(*args, **kwargs)
+
+    return wrapper
+
+
+async def run_blocking(fn, *args, **kwargs):
+    # runs a blocking call in a thread, with the current unit of work and trace span
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, fn, *args, **kwargs))
+
+
+async def send_placeholder(update: Update):
+    with tracing.span("send_placeholder"):
+        return await update.message.reply_text("...")
+
+
+async def send_typing_action(update: Update):
+    with tracing.span("send_typing_action"):
+        await update.message.chat.send_action(action="typing")
+
+
 def split_text_into_chunks(text, chunk_size):
     for i in range(0, len(text), chunk_size):
         yield text[i:i + chunk_size]
 
 
 async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User):
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
-            user.id,
-            update.message.chat_id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name= user.last_name
-        )
-        db.start_new_dialog(user.id)
+    if user.id in registered_user_ids:
+        return
 
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
+    with tracing.span("register_user_if_not_exists"):
+        await _register_user(update, user)
+
+
+async def _register_user(update, user: User):
+    user_dict = db.register_user(
+        user.id,
+        update.message.chat_id,
+        username=user.username,
+        first_name=user.first_name,
+        last_name= user.last_name
+    )
+
+    if user_dict.get("current_dialog_id") is None:
         db.start_new_dialog(user.id)
 
     if user.id not in user_semaphores:
         user_semaphores[user.id] = asyncio.Semaphore(1)
 
-    if db.get_user_attribute(user.id, "current_model") is None:
-        db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
-
-    # back compatibility for n_used_tokens field
-    n_used_tokens = db.get_user_attribute(user.id, "n_used_tokens")
-    if isinstance(n_used_tokens, int) or isinstance(n_used_tokens, float):  # old format
-        new_n_used_tokens = {
-            "gpt-3.5-turbo": {
-                "n_input_tokens": 0,
-                "n_output_tokens": n_used_tokens
-            }
-        }
-        db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
+    if user.id not in states:
+        states[user.id] = dialog_keeper.DialogKeeper(user.id)
+        states[user.id].start_new_dialog(user_dict["current_model"], user_dict.get("current_chat_mode"))
 
-    # voice message transcription
-    if db.get_user_attribute(user.id, "n_transcribed_seconds") is None:
-        db.set_user_attribute(user.id, "n_transcribed_seconds", 0.0)
+    registered_user_ids.add(user.id)
 
-    # image generation
-    if db.get_user_attribute(user.id, "n_generated_images") is None:
-        db.set_user_attribute(user.id, "n_generated_images", 0)
 
-    if user.id not in states:
-        states[user.id] = dialog_keeper.DialogKeeper(user.id)
-        states[user.id].start_new_dialog(db.get_user_attribute(user.id, "current_model"), db.get_user_attribute(user.id, "current_chat_mode"))
+def get_current_chat_mode(user_id: int):
+    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    if chat_mode not in config.snapshot.chat_modes:  # the chat mode was removed from chat_modes.yml
+        chat_mode = "assistant"
+    return chat_mode
+
+
+def get_model_name(model_key: str):
+    model = config.snapshot.models.get(model_key)
+    if model is None or model.name is None:  # e.g. removed from models.yml since
+        return model_key
+    return model.name
+
+
+def get_quota_scope(update: Update):
+    # user id, chat id and whether the chat is a group chat with its own quota
+    chat = update.effective_chat
+    return update.effective_user.id, chat.id, chat.type != "private"
+
+
+def bill_completion(update: Update, completion: routing.RoutedCompletion):
+    # every model tried for the answer, not only the one that served it
+    quota_scope = get_quota_scope(update)
+    for model, (n_input_tokens, n_output_tokens) in completion.n_used_tokens.items():
+        db.update_n_used_tokens(quota_scope[0], model, n_input_tokens, n_output_tokens)
+        quotas.record_tokens(*quota_scope, model, n_input_tokens + n_output_tokens)
+
+
+def bill_group_chat_completion(updates: list, completion: routing.RoutedCompletion):
+    # a batched answer is shared by its askers, so are its tokens
+    for model, (n_input_tokens, n_output_tokens) in completion.n_used_tokens.items():
+        for update, n_user_input_tokens, n_user_output_tokens in zip(
+            updates, group_chats.split_evenly(n_input_tokens, len(updates)), group_chats.split_evenly(n_output_tokens, len(updates))
+        ):
+            quota_scope = get_quota_scope(update)
+            db.update_n_used_tokens(quota_scope[0], model, n_user_input_tokens, n_user_output_tokens)
+            quotas.record_tokens(*quota_scope, model, n_user_input_tokens + n_user_output_tokens)
+
+
+async def is_shutting_down(update: Update):
+    if not shutdown_coordinator.is_shutting_down:
+        return False
+
+    text = "🔄 The bot is <b>restarting</b>, please send your message again in a minute"
+    await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+    return True
 
 
 async def is_bot_mentioned(update: Update, context: CallbackContext):
@@ -137,11 +235,14 @@ async def is_bot_mentioned(update: Update, context: CallbackContext):
          return False
 
 
+@tracing.trace_handler
+@metrics.observe_handler
+@with_unit_of_work
 async def start_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
     db.start_new_dialog(user_id)
     states[user_id].start_new_dialog(db.get_user_attribute(user_id, "current_model"), db.get_user_attribute(user_id, "current_chat_mode"))
 
@@ -152,17 +253,21 @@ async def start_handle(update: Update, context: CallbackContext):
     await show_chat_modes_handle(update, context)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
 async def help_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
 async def help_group_chat_handle(update: Update, context: CallbackContext):
      await register_user_if_not_exists(update, context, update.message.from_user)
      user_id = update.message.from_user.id
-     db.set_user_attribute(user_id, "last_interaction", datetime.now())
+     db.set_last_interaction(user_id, datetime.now())
 
      text = HELP_GROUP_CHAT_MESSAGE.format(bot_username="@" + context.bot.username)
 
@@ -170,12 +275,22 @@ async def help_group_chat_handle(update: Update, context: CallbackContext):
      await update.message.reply_video(config.help_group_chat_video_path)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
+@with_unit_of_work
 async def retry_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
+    if await is_shutting_down(update): return
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
+
+    if config.group_chat_config.enable and update.message.chat.type != "private":
+        # answers in group chats are in the shared dialog of the chat, not in the user's dialog
+        text = "🤷‍♂️ /retry is not available in group chats, mention me to ask again"
+        await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+        return
 
     dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
     if len(dialog_messages) == 0:
@@ -188,11 +303,12 @@ async def retry_handle(update: Update, context: CallbackContext):
     await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
+@with_unit_of_work
 async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True):
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    use_new_dialog_timeout = False \
-        if chat_mode == "custom" and config.long_dialog_config.enable else use_new_dialog_timeout
+    received_time = time.perf_counter()  # time to first token includes queueing and coalescing
 
     # check if bot was mentioned (for group chats)
     if not await is_bot_mentioned(update, context):
@@ -210,102 +326,174 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         _message = _message.replace("@" + context.bot.username, "").strip()
 
     await register_user_if_not_exists(update, context, update.message.from_user)
-    if await is_previous_message_not_answered_yet(update, context): return
+    if await is_shutting_down(update): return
+
+    if config.group_chat_config.enable and update.message.chat.type != "private":
+        await group_chat_message_handle(update, context, _message)
+        return
+
+    chat_mode = get_current_chat_mode(user_id)
+    use_new_dialog_timeout = False \
+        if chat_mode == "custom" and config.long_dialog_config.enable else use_new_dialog_timeout
 
     if chat_mode == "artist":
         await generate_image_handle(update, context, message=message)
         return
 
-    async def message_handle_fn():
+    # no await between this check and acquiring the semaphore below
+    if await enqueue_if_previous_message_not_answered_yet(update, _message, received_time): return
+
+    async def message_handle_fn(update: Update, _message: str, received_time: float):
+
         # new dialog timeout
         if use_new_dialog_timeout:
             if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
                 db.start_new_dialog(user_id)
                 states[user_id].start_new_dialog(db.get_user_attribute(user_id, "current_model"), db.get_user_attribute(user_id, "current_chat_mode"))
-                await update.message.reply_text(f"Starting new dialog due to timeout (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅", parse_mode=ParseMode.HTML)
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+                await update.message.reply_text(f"Starting new dialog due to timeout (<b>{config.snapshot.chat_modes[chat_mode].name}</b> mode) ✅", parse_mode=ParseMode.HTML)
+        db.set_last_interaction(user_id, datetime.now())
 
         # in case of CancelledError
         n_input_tokens, n_output_tokens = 0, 0
+        answer = ""
         current_model = db.get_user_attribute(user_id, "current_model")
+        placeholder_task, typing_action_task = None, None
+        completion = None
 
         try:
-            # send placeholder message to user
-            placeholder_message = await update.message.reply_text("...")
-
-            # send typing action
-            await update.message.chat.send_action(action="typing")
-
             if _message is None or len(_message) == 0:
                  await update.message.reply_text("🥲 You sent <b>empty message</b>. Please, try again!", parse_mode=ParseMode.HTML)
                  return
 
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-            parse_mode = {
-                "html": ParseMode.HTML,
-                "markdown": ParseMode.MARKDOWN
-            }[config.chat_modes[chat_mode]["parse_mode"]]
-
-            chatgpt_instance = openai_utils.ChatGPT(model=current_model)
-            if config.enable_message_streaming:
-                gen = chatgpt_instance.send_message_stream(_message, dialog_messages=dialog_messages, chat_mode=chat_mode, dialog_keeper=states[user_id])
-            else:
-                answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = await chatgpt_instance.send_message(
-                    _message,
-                    dialog_messages=dialog_messages,
-                    chat_mode=chat_mode,
-                    dialog_keeper=states[user_id]
+            # checked before the request, so a used up quota costs nothing
+            quota_scope = get_quota_scope(update)
+            allowed_model = quotas.choose_model(*quota_scope, current_model)
+            if allowed_model is None:
+                text = "🥲 You have used up your <b>daily limit</b> of tokens. See /balance for what is left"
+                await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+                return
+            if allowed_model != current_model:
+                text = f"✍️ <i>Note:</i> Your daily limit of <b>{get_model_name(current_model)}</b> tokens is used up, so <b>{get_model_name(allowed_model)}</b> answers instead"
+                await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+                current_model = allowed_model
+
+            # placeholder and typing action are sent while the context is loaded and the completion is requested,
+            # the placeholder is awaited only before the first edit
+            placeholder_task = asyncio.create_task(send_placeholder(update))
+            typing_action_task = asyncio.create_task(send_typing_action(update))
+            placeholder_message = None
+
+            with tracing.span("get_dialog_messages"):
+                dialog_messages = await run_blocking(db.get_dialog_messages, user_id, dialog_id=None)
+            parse_mode = PARSE_MODES[config.snapshot.chat_modes[chat_mode].parse_mode]
+
+            with tracing.span("completion", model=current_model, streaming=config.enable_message_streaming):
+                completion = model_router.new_completion(
+                    current_model, chat_mode,
+                    enable_fallback=db.get_user_attribute(user_id, "enable_model_fallback"),
+                    is_model_allowed=functools.partial(quotas.is_model_allowed, *quota_scope)
                 )
+                if config.enable_message_streaming:
+                    gen = completion.send_message_stream(_message, dialog_messages=dialog_messages, chat_mode=chat_mode, dialog_keeper=states[user_id])
+                else:
+                    answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = await completion.send_message(
+                        _message,
+                        dialog_messages=dialog_messages,
+                        chat_mode=chat_mode,
+                        dialog_keeper=states[user_id]
+                    )
+
+                    async def fake_gen():
+                        yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+                    gen = fake_gen()
+                prev_answer = ""
+                is_first_token_observed = False
+                try:
+                    async for gen_item in gen:
+                        status, answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = gen_item
+                        if answer and not is_first_token_observed:
+                            metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - received_time)
+                            is_first_token_observed = True
 
-                async def fake_gen():
-                    yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                        answer = answer[:4096]  # telegram message limit
 
-                gen = fake_gen()
-            prev_answer = ""
-            async for gen_item in gen:
-                status, answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = gen_item
+                        # update only when 100 new symbols are ready
+                        if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
+                            continue
 
-                answer = answer[:4096]  # telegram message limit
+                        if placeholder_message is None:
+                            placeholder_message = await placeholder_task
+                            await typing_action_task
 
-                # update only when 100 new symbols are ready
-                if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
-                    continue
+                        with tracing.span("telegram_edit", status=status):
+                            try:
+                                await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=parse_mode)
+                            except telegram.error.BadRequest as e:
+                                if str(e).startswith("Message is not modified"):
+                                    continue
+                                else:
+                                    await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id)
 
-                try:
-                    await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=parse_mode)
-                except telegram.error.BadRequest as e:
-                    if str(e).startswith("Message is not modified"):
-                        continue
-                    else:
-                        await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id)
+                        await asyncio.sleep(0.01)  # wait a bit to avoid flooding
 
-                await asyncio.sleep(0.01)  # wait a bit to avoid flooding
+                        prev_answer = answer
+                finally:
+                    await gen.aclose()  # closes the OpenAI connection right away, e.g. on /cancel
 
-                prev_answer = answer
+            if completion.model != current_model:
+                logger.info(f"Answered user {user_id} with {completion.model} instead of {current_model}")
 
             # update user data
-            new_dialog_message = {"user": _message, "bot": answer, "date": datetime.now(), "n_tokens": n_input_tokens + n_output_tokens}
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message]
-            db.set_dialog_messages(
-                user_id,
-                dialog_messages,
-                dialog_id=None
-            )
-            if len(dialog_messages) == 1:  # First message
-                dialog_keeper.prompt_tokens = n_input_tokens
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            with tracing.span("save_dialog"):
+                new_dialog_message = {"user": _message, "bot": answer, "date": datetime.now(), "n_tokens": n_input_tokens + n_output_tokens, "model": completion.model}
+                dialog_messages = db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message]
+                db.set_dialog_messages(
+                    user_id,
+                    dialog_messages,
+                    dialog_id=None
+                )
+                if len(dialog_messages) == 1:  # First message
+                    dialog_keeper.prompt_tokens = n_input_tokens
+                bill_completion(update, completion)
 
         except asyncio.CancelledError:
-            # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            # tokens billed up to the cancellation, including the input of a request without an answer yet
+            if completion is not None:
+                bill_completion(update, completion)
+                n_input_tokens, n_output_tokens = completion.n_used_tokens.get(completion.model, (0, 0))
+
+            # keep what was streamed so far, the user can /retry after restart
+            if answer and (shutdown_coordinator.is_shutting_down or config.save_canceled_answers):
+                new_dialog_message = {"user": _message, "bot": answer, "date": datetime.now(), "n_tokens": n_input_tokens + n_output_tokens, "model": completion.model}
+                db.set_dialog_messages(
+                    user_id,
+                    db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
+                    dialog_id=None
+                )
+                if shutdown_coordinator.is_shutting_down:
+                    shutdown_coordinator.report["n_saved_partial_answers"] += 1
             raise
 
         except Exception as e:
+            if completion is not None:  # input tokens of abandoned attempts
+                bill_completion(update, completion)
+
             error_text = f"Something went wrong during completion. Reason: {e}"
             logger.error(error_text)
             await update.message.reply_text(error_text)
             return
 
+        finally:
+            # on errors the placeholder may still be in flight or failed unnoticed
+            for task in (placeholder_task, typing_action_task):
+                if task is None:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # retrieved, so it is not logged as never retrieved
+
         # send message if some messages were removed from the context
         if n_first_dialog_messages_removed > 0:
             if n_first_dialog_messages_removed == 1:
@@ -315,18 +503,204 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
             await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
     async with user_semaphores[user_id]:
-        task = asyncio.create_task(message_handle_fn())
-        user_tasks[user_id] = task
+        # fragments of a long text arrive as several messages within a moment, they are answered as one
+        batch = [(update, _message, received_time)]
+        if config.message_queue_config.coalesce_window_sec > 0:
+            # registered like the answer, so that /cancel and shutdown see the message from the start
+            wait_task = asyncio.create_task(asyncio.sleep(config.message_queue_config.coalesce_window_sec))
+            user_tasks[user_id] = wait_task
+            try:
+                await wait_task
+            except asyncio.CancelledError:
+                if shutdown_coordinator.is_shutting_down:
+                    await is_shutting_down(update)
+                else:
+                    await update.message.reply_text("✅ Canceled", parse_mode=ParseMode.HTML)
+                return
+            finally:
+                if user_tasks.get(user_id) is wait_task:
+                    del user_tasks[user_id]
+            batch += user_message_queues.pop(user_id, [])
+
+        while batch:
+            if len(batch) > 1:
+                metrics.COALESCED_MESSAGES.inc(len(batch) - 1)
+            batch_update = batch[-1][0]  # answer to the last message, timed from the first one
+            batch_message = "\n".join(text for _, text, _ in batch if text)
+            task = asyncio.create_task(message_handle_fn(batch_update, batch_message, batch[0][2]))
+            user_tasks[user_id] = task
 
-        try:
-            await task
-        except asyncio.CancelledError:
-            await update.message.reply_text("✅ Canceled", parse_mode=ParseMode.HTML)
+            try:
+                await task
+            except asyncio.CancelledError:
+                if shutdown_coordinator.is_shutting_down:
+                    text = "🔄 The bot is <b>restarting</b>, so the answer was interrupted. Send /retry in a minute to regenerate it"
+                    await batch_update.message.reply_text(text, parse_mode=ParseMode.HTML)
+                else:
+                    await batch_update.message.reply_text("✅ Canceled", parse_mode=ParseMode.HTML)
+            else:
+                pass
+            finally:
+                if user_id in user_tasks:
+                    del user_tasks[user_id]
+
+            # messages queued meanwhile
+            batch = user_message_queues.pop(user_id, [])
+            if batch and shutdown_coordinator.is_shutting_down:
+                await is_shutting_down(batch[-1][0])
+                break
+            if batch:
+                # the answer above must not wait for the next one to be saved
+                unit_of_work = database.current_unit_of_work.get()
+                if unit_of_work is not None:
+                    unit_of_work.commit()
+
+
+async def group_chat_message_handle(update: Update, context: CallbackContext, message: str):
+    # mentions of one group chat share its dialog; those arriving within batch_window_sec, or while the chat
+    # waits for its rate limit, are answered by one completion
+    group_chat_config = config.group_chat_config
+    chat_id = update.message.chat_id
+    db.set_last_interaction(update.message.from_user.id, datetime.now())
+
+    if chat_id in chat_semaphores and chat_semaphores[chat_id].locked():
+        chat_message_queue = chat_message_queues.setdefault(chat_id, [])
+        if len(chat_message_queue) >= group_chat_config.max_queue_size:
+            metrics.BUSY_REJECTIONS.inc()
+            text = "⏳ Please <b>wait</b>, there are too many questions in this chat"
+            await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
         else:
-            pass
-        finally:
-            if user_id in user_tasks:
-                del user_tasks[user_id]
+            chat_message_queue.append((update, message))
+            metrics.QUEUED_MESSAGES.inc()
+        return
+
+    async with chat_semaphores.setdefault(chat_id, asyncio.Semaphore(1)):
+        queued_batch = [(update, message)]
+        wait_sec = group_chat_config.batch_window_sec
+        while queued_batch:
+            # registered, so that a shutdown does not wait for it and the mentions waiting are not dropped silently
+            wait_task = asyncio.create_task(wait_for_group_chat_batch(chat_id, wait_sec, queued_batch))
+            chat_wait_tasks[chat_id] = wait_task
+            try:
+                await wait_task
+            except asyncio.CancelledError:
+                return
+            finally:
+                if chat_wait_tasks.get(chat_id) is wait_task:
+                    del chat_wait_tasks[chat_id]
+            wait_sec = 0
+
+            queued_batch += chat_message_queues.pop(chat_id, [])  # mentions that arrived while waiting
+            batch = queued_batch[:group_chat_config.max_batch_size]
+            queued_batch = queued_batch[group_chat_config.max_batch_size:]
+            if len(batch) > 1:
+                metrics.COALESCED_MESSAGES.inc(len(batch) - 1)
+
+            task = asyncio.create_task(group_chat_message_handle_fn(context, batch))
+            user_tasks[chat_id] = task  # ids of group chats are negative, so they never clash with user ids
+            try:
+                await task
+            except asyncio.CancelledError:
+                if shutdown_coordinator.is_shutting_down:
+                    text = "🔄 The bot is <b>restarting</b>, so the answer was interrupted. Please ask again in a minute"
+                    await batch[-1][0].message.reply_text(text, parse_mode=ParseMode.HTML)
+            finally:
+                if chat_id in user_tasks:
+                    del user_tasks[chat_id]
+
+            queued_batch += chat_message_queues.pop(chat_id, [])
+            if queued_batch and shutdown_coordinator.is_shutting_down:
+                await is_shutting_down(queued_batch[-1][0])
+                break
+            if queued_batch:
+                unit_of_work = database.current_unit_of_work.get()
+                if unit_of_work is not None:
+                    unit_of_work.commit()
+
+
+async def wait_for_group_chat_batch(chat_id: int, batch_window_sec: float, queued_batch: list):
+    # the batch window and the rate limit of the chat, canceled right away by a shutdown
+    try:
+        await asyncio.sleep(batch_window_sec)
+        await chat_rate_limiter.acquire(chat_id)
+    except asyncio.CancelledError:
+        if shutdown_coordinator.is_shutting_down:
+            await is_shutting_down((queued_batch + chat_message_queues.pop(chat_id, []))[-1][0])
+        raise
+
+
+async def group_chat_message_handle_fn(context: CallbackContext, batch: list):
+    group_chat_config = config.group_chat_config
+    chat_id = batch[-1][0].message.chat_id
+
+    # askers without quota left are told so and left out
+    answered_batch = []
+    for update, message in batch:
+        if not message:
+            continue
+        if quotas.is_model_allowed(*get_quota_scope(update), group_chat_config.model):
+            answered_batch.append((update, message))
+        else:
+            text = "🥲 You have used up your <b>daily limit</b> of tokens. See /balance for what is left"
+            await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+    if not answered_batch:
+        return
+
+    last_update = answered_batch[-1][0]
+    await last_update.message.chat.send_action(action="typing")
+
+    dialog_messages = db.get_group_chat_messages(chat_id)
+    if dialog_messages and (datetime.now() - dialog_messages[-1]["date"]).total_seconds() > config.new_dialog_timeout:
+        dialog_messages = []
+        db.clear_group_chat_messages(chat_id)
+
+    # one message per answer, streamed edits would quickly hit the limits of Telegram for group chats
+    completion = model_router.new_completion(group_chat_config.model, group_chat_config.chat_mode)
+    try:
+        with tracing.span("completion", model=group_chat_config.model, streaming=False, batch_size=len(answered_batch)):
+            answer, (n_input_tokens, n_output_tokens), _ = await completion.send_message(
+                group_chats.format_batch_request(answered_batch),
+                dialog_messages=dialog_messages,
+                chat_mode=group_chat_config.chat_mode
+            )
+
+        db.add_group_chat_message(chat_id, {
+            "user": group_chats.format_batch(answered_batch), "bot": answer, "date": datetime.now(),
+            "n_tokens": n_input_tokens + n_output_tokens, "model": completion.model
+        }, group_chat_config.max_dialog_messages)
+    except Exception as e:
+        error_text = f"Something went wrong during completion. Reason: {e}"
+        logger.error(error_text)
+        await last_update.message.reply_text(error_text)
+        return
+    finally:
+        bill_group_chat_completion([update for update, _ in answered_batch], completion)
+
+    parse_mode = PARSE_MODES[config.snapshot.chat_modes[group_chat_config.chat_mode].parse_mode]
+    for answer_chunk in split_text_into_chunks(answer, 4096):
+        try:
+            await last_update.message.reply_text(answer_chunk, reply_to_message_id=last_update.message.id, parse_mode=parse_mode)
+        except telegram.error.BadRequest:
+            # answer has invalid characters, so we send it without parse_mode
+            await last_update.message.reply_text(answer_chunk, reply_to_message_id=last_update.message.id)
+
+
+async def enqueue_if_previous_message_not_answered_yet(update: Update, message: str, received_time: float):
+    # returns True if the message was queued or rejected because the queue is full
+    user_id = update.message.from_user.id
+    if not user_semaphores[user_id].locked():
+        return False
+
+    user_message_queue = user_message_queues.setdefault(user_id, [])
+    if len(user_message_queue) >= config.message_queue_config.max_size:
+        metrics.BUSY_REJECTIONS.inc()
+        text = "⏳ Please <b>wait</b> for a reply to the previous messages\n"
+        text += "Or you can /cancel it"
+        await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+    else:
+        user_message_queue.append((update, message, received_time))
+        metrics.QUEUED_MESSAGES.inc()
+    return True
 
 
 async def is_previous_message_not_answered_yet(update: Update, context: CallbackContext):
@@ -334,6 +708,7 @@ async def is_previous_message_not_answered_yet(update: Update, context: Callback
 
     user_id = update.message.from_user.id
     if user_semaphores[user_id].locked():
+        metrics.BUSY_REJECTIONS.inc()
         text = "⏳ Please <b>wait</b> for a reply to the previous message\n"
         text += "Or you can /cancel it"
         await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
@@ -342,16 +717,25 @@ async def is_previous_message_not_answered_yet(update: Update, context: Callback
         return False
 
 
+@tracing.trace_handler
+@metrics.observe_handler
+@with_unit_of_work
 async def voice_message_handle(update: Update, context: CallbackContext):
     # check if bot was mentioned (for group chats)
     if not await is_bot_mentioned(update, context):
         return
 
     await register_user_if_not_exists(update, context, update.message.from_user)
-    if await is_previous_message_not_answered_yet(update, context): return
+    if await is_shutting_down(update): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
+
+    quota_scope = get_quota_scope(update)
+    if not quotas.can_transcribe(*quota_scope):
+        text = "🥲 You have used up your <b>daily limit</b> of voice messages. See /balance for what is left"
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+        return
 
     voice = update.message.voice
     with tempfile.TemporaryDirectory() as tmp_dir:
@@ -363,6 +747,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
         await voice_file.download_to_drive(voice_ogg_path)
 
         # convert to mp3
+        import pydub  # only needed here, prewarmed after startup
         voice_mp3_path = tmp_dir / "voice.mp3"
         pydub.AudioSegment.from_file(voice_ogg_path).export(voice_mp3_path, format="mp3")
 
@@ -377,17 +762,27 @@ async def voice_message_handle(update: Update, context: CallbackContext):
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
     # update n_transcribed_seconds
-    db.set_user_attribute(user_id, "n_transcribed_seconds", voice.duration + db.get_user_attribute(user_id, "n_transcribed_seconds"))
+    db.update_n_transcribed_seconds(user_id, voice.duration)
+    quotas.record_transcription(*quota_scope, voice.duration)
 
     await message_handle(update, context, message=transcribed_text)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
+@with_unit_of_work
 async def generate_image_handle(update: Update, context: CallbackContext, message=None):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
+
+    quota_scope = get_quota_scope(update)
+    if not quotas.can_generate_images(*quota_scope):
+        text = "🥲 You have used up your <b>daily limit</b> of images. See /balance for what is left"
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+        return
 
     await update.message.chat.send_action(action="upload_photo")
 
@@ -404,34 +799,46 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
             raise
 
     # token usage
-    db.set_user_attribute(user_id, "n_generated_images", config.return_n_generated_images + db.get_user_attribute(user_id, "n_generated_images"))
+    db.update_n_generated_images(user_id, config.return_n_generated_images)
+    quotas.record_images(*quota_scope, config.return_n_generated_images)
 
     for i, image_url in enumerate(image_urls):
         await update.message.chat.send_action(action="upload_photo")
         await update.message.reply_photo(image_url, parse_mode=ParseMode.HTML)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
+@with_unit_of_work
 async def new_dialog_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
+
+    if config.group_chat_config.enable and update.message.chat.type != "private":  # the shared dialog of the chat
+        db.clear_group_chat_messages(update.message.chat_id)
+        await update.message.reply_text("Starting new dialog for this chat ✅")
+        return
 
     db.start_new_dialog(user_id)
     states[user_id].start_new_dialog(db.get_user_attribute(user_id, "current_model"), db.get_user_attribute(user_id, "current_chat_mode"))
     await update.message.reply_text("Starting new dialog ✅")
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    await update.message.reply_text(f"{config.chat_modes[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
+    chat_mode = get_current_chat_mode(user_id)
+    await update.message.reply_text(config.snapshot.chat_modes[chat_mode].welcome_message, parse_mode=ParseMode.HTML)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
 async def cancel_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
+    user_message_queues.pop(user_id, None)  # queued messages are canceled too
     if user_id in user_tasks:
         task = user_tasks[user_id]
         task.cancel()
@@ -439,60 +846,122 @@ async def cancel_handle(update: Update, context: CallbackContext):
         await update.message.reply_text("<i>Nothing to cancel...</i>", parse_mode=ParseMode.HTML)
 
 
-def get_chat_mode_menu(page_index: int):
-    n_chat_modes_per_page = config.n_chat_modes_per_page
-    text = f"Select <b>chat mode</b> ({len(config.chat_modes)} modes available):"
+class Menus:
+    # inline keyboards rendered once per config snapshot
+    def __init__(self, snapshot: config.ConfigSnapshot):
+        chat_mode_keys = snapshot.chat_mode_keys
+        n_chat_modes_per_page = config.n_chat_modes_per_page
+        n_pages = max((len(chat_mode_keys) + n_chat_modes_per_page - 1) // n_chat_modes_per_page, 1)
+        self.chat_mode_pages = [
+            self._render_chat_mode_page(snapshot, page_index, n_pages) for page_index in range(n_pages)
+        ]
+        self.settings = {
+            (model_key, enable_model_fallback): self._render_settings(snapshot, model_key, enable_model_fallback)
+            for model_key in snapshot.available_text_models for enable_model_fallback in (False, True)
+        }
+
+    @staticmethod
+    def _render_chat_mode_page(snapshot: config.ConfigSnapshot, page_index: int, n_pages: int):
+        n_chat_modes_per_page = config.n_chat_modes_per_page
+        text = f"Select <b>chat mode</b> ({len(snapshot.chat_modes)} modes available):"
+
+        # buttons
+        chat_mode_keys = snapshot.chat_mode_keys
+        page_chat_mode_keys = chat_mode_keys[page_index * n_chat_modes_per_page:(page_index + 1) * n_chat_modes_per_page]
+
+        keyboard = []
+        for chat_mode_key in page_chat_mode_keys:
+            name = snapshot.chat_modes[chat_mode_key].name
+            keyboard.append([InlineKeyboardButton(name, callback_data=f"set_chat_mode|{chat_mode_key}")])
+
+        # pagination
+        if n_pages > 1:
+            is_first_page = (page_index == 0)
+            is_last_page = (page_index == n_pages - 1)
+
+            if is_first_page:
+                keyboard.append([
+                    InlineKeyboardButton("»", callback_data=f"show_chat_modes|{page_index + 1}")
+                ])
+            elif is_last_page:
+                keyboard.append([
+                    InlineKeyboardButton("«", callback_data=f"show_chat_modes|{page_index - 1}"),
+                ])
+            else:
+                keyboard.append([
+                    InlineKeyboardButton("«", callback_data=f"show_chat_modes|{page_index - 1}"),
+                    InlineKeyboardButton("»", callback_data=f"show_chat_modes|{page_index + 1}")
+                ])
 
-    # buttons
-    chat_mode_keys = list(config.chat_modes.keys())
-    page_chat_mode_keys = chat_mode_keys[page_index * n_chat_modes_per_page:(page_index + 1) * n_chat_modes_per_page]
+        reply_markup = InlineKeyboardMarkup(keyboard)
 
-    keyboard = []
-    for chat_mode_key in page_chat_mode_keys:
-        name = config.chat_modes[chat_mode_key]["name"]
-        keyboard.append([InlineKeyboardButton(name, callback_data=f"set_chat_mode|{chat_mode_key}")])
+        return text, reply_markup
 
-    # pagination
-    if len(chat_mode_keys) > n_chat_modes_per_page:
-        is_first_page = (page_index == 0)
-        is_last_page = ((page_index + 1) * n_chat_modes_per_page >= len(chat_mode_keys))
+    @staticmethod
+    def _render_settings(snapshot: config.ConfigSnapshot, current_model: str, enable_model_fallback: bool):
+        text = snapshot.models[current_model].description
 
-        if is_first_page:
-            keyboard.append([
-                InlineKeyboardButton("»", callback_data=f"show_chat_modes|{page_index + 1}")
-            ])
-        elif is_last_page:
-            keyboard.append([
-                InlineKeyboardButton("«", callback_data=f"show_chat_modes|{page_index - 1}"),
-            ])
-        else:
+        text += "\n\n"
+        for score_key, score_value in snapshot.models[current_model].scores:
+            text += "🟢" * score_value + "⚪️" * (5 - score_value) + f" – {score_key}\n\n"
+
+        text += "\nSelect <b>model</b>:"
+
+        # buttons to choose models
+        buttons = []
+        for model_key in snapshot.available_text_models:
+            title = snapshot.models[model_key].name
+            if model_key == current_model:
+                title = "✅ " + title
+
+            buttons.append(
+                InlineKeyboardButton(title, callback_data=f"set_settings|{model_key}")
+            )
+        keyboard = [buttons]
+
+        if config.model_routing_config.enable:
+            title = "Switch models when busy"
+            if enable_model_fallback:
+                title = "✅ " + title
             keyboard.append([
-                InlineKeyboardButton("«", callback_data=f"show_chat_modes|{page_index - 1}"),
-                InlineKeyboardButton("»", callback_data=f"show_chat_modes|{page_index + 1}")
+                InlineKeyboardButton(title, callback_data=f"set_model_fallback|{int(not enable_model_fallback)}")
             ])
+        reply_markup = InlineKeyboardMarkup(keyboard)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        return text, reply_markup
 
-    return text, reply_markup
 
+@functools.lru_cache(maxsize=1)
+def get_menus(snapshot: config.ConfigSnapshot):
+    return Menus(snapshot)
+
+
+def get_chat_mode_menu(page_index: int):
+    chat_mode_pages = get_menus(config.snapshot).chat_mode_pages
+    return chat_mode_pages[min(page_index, len(chat_mode_pages) - 1)]  # fewer pages after a reload
 
+
+@tracing.trace_handler
+@metrics.observe_handler
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     text, reply_markup = get_chat_mode_menu(0)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
 async def show_chat_modes_callback_handle(update: Update, context: CallbackContext):
      await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
      if await is_previous_message_not_answered_yet(update.callback_query, context): return
 
      user_id = update.callback_query.from_user.id
-     db.set_user_attribute(user_id, "last_interaction", datetime.now())
+     db.set_last_interaction(user_id, datetime.now())
 
      query = update.callback_query
      await query.answer()
@@ -509,6 +978,9 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
              pass
 
 
+@tracing.trace_handler
+@metrics.observe_handler
+@with_unit_of_work
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     user_id = update.callback_query.from_user.id
@@ -517,6 +989,8 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
     await query.answer()
 
     chat_mode = query.data.split("|")[1]
+    if chat_mode not in config.snapshot.chat_modes:  # a button of a menu sent before a reload
+        return
 
     db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
     db.start_new_dialog(user_id)
@@ -524,48 +998,36 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
 
     await context.bot.send_message(
         update.callback_query.message.chat.id,
-        f"{config.chat_modes[chat_mode]['welcome_message']}",
+        config.snapshot.chat_modes[chat_mode].welcome_message,
         parse_mode=ParseMode.HTML
     )
 
 
 def get_settings_menu(user_id: int):
     current_model = db.get_user_attribute(user_id, "current_model")
-    text = config.models["info"][current_model]["description"]
-
-    text += "\n\n"
-    score_dict = config.models["info"][current_model]["scores"]
-    for score_key, score_value in score_dict.items():
-        text += "🟢" * score_value + "⚪️" * (5 - score_value) + f" – {score_key}\n\n"
-
-    text += "\nSelect <b>model</b>:"
-
-    # buttons to choose models
-    buttons = []
-    for model_key in config.models["available_text_models"]:
-        title = config.models["info"][model_key]["name"]
-        if model_key == current_model:
-            title = "✅ " + title
-
-        buttons.append(
-            InlineKeyboardButton(title, callback_data=f"set_settings|{model_key}")
-        )
-    reply_markup = InlineKeyboardMarkup([buttons])
-
-    return text, reply_markup
+    enable_model_fallback = bool(db.get_user_attribute(user_id, "enable_model_fallback"))
+    settings = get_menus(config.snapshot).settings
+    if (current_model, enable_model_fallback) not in settings:  # the model was removed from models.yml
+        current_model = config.snapshot.available_text_models[0]
+    return settings[(current_model, enable_model_fallback)]
 
 
+@tracing.trace_handler
+@metrics.observe_handler
 async def settings_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     text, reply_markup = get_settings_menu(user_id)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
+@with_unit_of_work
 async def set_settings_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     user_id = update.callback_query.from_user.id
@@ -586,17 +1048,71 @@ async def set_settings_handle(update: Update, context: CallbackContext):
             pass
 
 
+@tracing.trace_handler
+@metrics.observe_handler
+@with_unit_of_work
+async def set_model_fallback_handle(update: Update, context: CallbackContext):
+    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
+    user_id = update.callback_query.from_user.id
+
+    query = update.callback_query
+    await query.answer()
+
+    _, enable_model_fallback = query.data.split("|")
+    db.set_user_attribute(user_id, "enable_model_fallback", enable_model_fallback == "1")
+
+    text, reply_markup = get_settings_menu(user_id)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    except telegram.error.BadRequest as e:
+        if str(e).startswith("Message is not modified"):
+            pass
+
+
+def get_recent_usage_text(user_id: int):
+    # from the daily summaries, so it lags behind by up to usage_aggregation.interval_min
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    text = ""
+    for title, day_from in (("Today", today), ("This month", today.replace(day=1))):
+        summaries = db.get_usage_summaries(day_from, user_id=user_id)
+        n_spent_dollars = sum(summary["n_spent_dollars"] for summary in summaries)
+        n_used_tokens = sum(summary["n_input_tokens"] + summary["n_output_tokens"] for summary in summaries)
+        text += f"📅 {title}: <b>{n_spent_dollars:.03f}$</b> / <b>{n_used_tokens} tokens</b>\n"
+    return text
+
+
+def get_remaining_quota_text(update: Update):
+    quota_scope = get_quota_scope(update)
+    current_model = db.get_user_attribute(quota_scope[0], "current_model")
+
+    # None is unlimited
+    n_remaining_tokens = quotas.get_remaining_tokens(*quota_scope, current_model)
+    n_remaining_images = quotas.get_remaining_images(*quota_scope)
+    n_remaining_seconds = quotas.get_remaining_transcription_seconds(*quota_scope)
+
+    text = "⏳ Left today:\n"
+    if n_remaining_tokens is not None:
+        text += f"- {get_model_name(current_model)}: <b>{n_remaining_tokens} tokens</b>\n"
+    if n_remaining_images is not None:
+        text += f"- DALL·E 2 (image generation): <b>{n_remaining_images} images</b>\n"
+    if n_remaining_seconds is not None:
+        text += f"- Whisper (voice recognition): <b>{n_remaining_seconds / 60:.01f} min</b>\n"
+    return text
+
+
+@tracing.trace_handler
+@metrics.observe_handler
 async def show_balance_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.set_last_interaction(user_id, datetime.now())
 
     # count total usage statistics
     total_n_spent_dollars = 0
     total_n_used_tokens = 0
 
-    n_used_tokens_dict = db.get_user_attribute(user_id, "n_used_tokens")
+    n_used_tokens_dict = db.get_n_used_tokens(user_id)
     n_generated_images = db.get_user_attribute(user_id, "n_generated_images")
     n_transcribed_seconds = db.get_user_attribute(user_id, "n_transcribed_seconds")
 
@@ -605,21 +1121,25 @@ async def show_balance_handle(update: Update, context: CallbackContext):
         n_input_tokens, n_output_tokens = n_used_tokens_dict[model_key]["n_input_tokens"], n_used_tokens_dict[model_key]["n_output_tokens"]
         total_n_used_tokens += n_input_tokens + n_output_tokens
 
-        n_input_spent_dollars = config.models["info"][model_key]["price_per_1000_input_tokens"] * (n_input_tokens / 1000)
-        n_output_spent_dollars = config.models["info"][model_key]["price_per_1000_output_tokens"] * (n_output_tokens / 1000)
+        model = config.snapshot.models.get(model_key)
+        if model is None:  # removed from models.yml, its price is unknown now
+            details_text += f"- {model_key} (no longer available): <b>{n_input_tokens + n_output_tokens} tokens</b>\n"
+            continue
+        n_input_spent_dollars = model.price_per_1000_input_tokens * (n_input_tokens / 1000)
+        n_output_spent_dollars = model.price_per_1000_output_tokens * (n_output_tokens / 1000)
         total_n_spent_dollars += n_input_spent_dollars + n_output_spent_dollars
 
         details_text += f"- {model_key}: <b>{n_input_spent_dollars + n_output_spent_dollars:.03f}$</b> / <b>{n_input_tokens + n_output_tokens} tokens</b>\n"
 
     # image generation
-    image_generation_n_spent_dollars = config.models["info"]["dalle-2"]["price_per_1_image"] * n_generated_images
+    image_generation_n_spent_dollars = config.snapshot.models["dalle-2"].price_per_1_image * n_generated_images
     if n_generated_images != 0:
         details_text += f"- DALL·E 2 (image generation): <b>{image_generation_n_spent_dollars:.03f}$</b> / <b>{n_generated_images} generated images</b>\n"
 
     total_n_spent_dollars += image_generation_n_spent_dollars
 
     # voice recognition
-    voice_recognition_n_spent_dollars = config.models["info"]["whisper"]["price_per_1_min"] * (n_transcribed_seconds / 60)
+    voice_recognition_n_spent_dollars = config.snapshot.models["whisper"].price_per_1_min * (n_transcribed_seconds / 60)
     if n_transcribed_seconds != 0:
         details_text += f"- Whisper (voice recognition): <b>{voice_recognition_n_spent_dollars:.03f}$</b> / <b>{n_transcribed_seconds:.01f} seconds</b>\n"
 
@@ -628,11 +1148,17 @@ async def show_balance_handle(update: Update, context: CallbackContext):
 
     text = f"You spent <b>{total_n_spent_dollars:.03f}$</b>\n"
     text += f"You used <b>{total_n_used_tokens}</b> tokens\n\n"
+    if config.usage_aggregation_config.enable:
+        text += get_recent_usage_text(user_id) + "\n"
+    if config.quota_config.enable:
+        text += get_remaining_quota_text(update) + "\n"
     text += details_text
 
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 
+@tracing.trace_handler
+@metrics.observe_handler
 async def edited_message_handle(update: Update, context: CallbackContext):
     if update.edited_message.chat.type == "private":
         text = "🥲 Unfortunately, message <b>editing</b> is not supported"
@@ -640,15 +1166,19 @@ async def edited_message_handle(update: Update, context: CallbackContext):
 
 
 async def error_handle(update: Update, context: CallbackContext) -> None:
-    logger.error(msg="Exception while handling an update:", exc_info=context.error)
+    logger.error(
+        msg=f"Exception while handling an update (trace_id = {getattr(context.error, 'trace_id', tracing.NO_TRACE_ID)}):",
+        exc_info=context.error
+    )
 
     try:
         # collect error message
         tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
         tb_string = "".join(tb_list)
         update_str = update.to_dict() if isinstance(update, Update) else str(update)
+        trace_id = getattr(context.error, "trace_id", tracing.NO_TRACE_ID)
         message = (
-            f"An exception was raised while handling an update\n"
+            f"An exception was raised while handling an update (trace_id = {trace_id})\n"
             f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
             "</pre>\n\n"
             f"<pre>{html.escape(tb_string)}</pre>"
@@ -664,7 +1194,131 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
     except:
         await context.bot.send_message(update.effective_chat.id, "Some error in error handler")
 
+async def archive_dialogs_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            report = await loop.run_in_executor(None, db.archive_dialogs, config.dialog_archival_config.older_than_days)
+            logger.info(manage.format_archival_report(report))
+        except Exception:
+            logger.exception("Dialog archival failed")
+
+        await asyncio.sleep(config.dialog_archival_config.interval_hours * 60 * 60)
+
+
+async def aggregate_usage_periodically():
+    loop = asyncio.get_running_loop()
+    since = datetime.now() - timedelta(days=1)  # also what was logged while the bot was stopped
+    while True:
+        start_time = datetime.now()
+        try:
+            n_summaries = await loop.run_in_executor(None, db.aggregate_usage, since)
+            logger.debug(f"Updated {n_summaries} daily usage summaries")
+            since = start_time - USAGE_AGGREGATION_OVERLAP  # usage is logged with the time of the request, committed later
+        except Exception:
+            logger.exception("Usage aggregation failed")
+
+        await asyncio.sleep(config.usage_aggregation_config.interval_min * 60)
+
+
+async def sync_quotas_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(config.quota_config.sync_interval_sec)
+        try:
+            await loop.run_in_executor(None, quotas.store.sync)
+        except Exception:
+            logger.exception("Failed to sync quota counters")
+
+
+async def flush_last_interactions_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(config.last_interaction_flush_interval_sec)
+        try:
+            await loop.run_in_executor(None, db.flush_last_interactions)
+        except Exception:
+            logger.exception("Failed to flush last interactions")
+
+
+async def reload_config_periodically():
+    loop = asyncio.get_running_loop()
+    mtimes = config.snapshot.mtimes
+    while True:
+        await asyncio.sleep(config.config_reload_interval_sec)
+        try:
+            new_mtimes = await loop.run_in_executor(None, config.get_reloadable_files_mtimes)
+            if new_mtimes == mtimes:
+                continue
+            mtimes = new_mtimes  # a broken file is not reloaded again until it changes
+            snapshot = await loop.run_in_executor(None, config.load_snapshot)
+        except Exception:
+            logger.exception("Failed to reload chat_modes.yml and models.yml, keeping the current ones")
+            continue
+
+        # replaced in the event loop thread, so a handler never sees a half-updated config
+        config.snapshot = snapshot
+        logger.info(f"Reloaded {len(snapshot.chat_modes)} chat modes and {len(snapshot.models)} models")
+
+
+async def finish_startup_in_background():
+    # the work deferred from startup, updates are served meanwhile
+    loop = asyncio.get_running_loop()
+    phases = [
+        ("load_encodings", functools.partial(openai_utils.load_encodings, config.snapshot.available_text_models)),
+        ("import_pydub", functools.partial(importlib.import_module, "pydub")),
+    ]
+    if not worker_index:  # one process is enough
+        phases.insert(0, ("bootstrap_schema", db.bootstrap_schema))
+
+    for phase, fn in phases:
+        try:
+            with startup.profile.background_phase(phase):
+                await loop.run_in_executor(None, fn)
+        except Exception:
+            logger.exception(f"Startup phase {phase} failed")
+            continue
+
+        phase_sec = startup.profile.background_phases[-1][1]
+        metrics.STARTUP_PHASE_SECONDS.labels(phase).set(phase_sec)
+        if config.profile_startup:
+            logger.info(f"Background startup phase {phase}: {phase_sec:.3f} sec")
+
+
 async def post_init(application: Application):
+    startup.profile.mark("initialize")  # Application.initialize(), e.g. getMe
+
+    if worker_index is None:  # workers are stopped by the supervisor
+        shutdown_coordinator.install_signal_handlers(application)
+
+    if config.metrics_config.enable:
+        metrics.start_server(config.metrics_config.host, config.metrics_config.port + (worker_index or 0))
+
+    background_tasks.append(asyncio.create_task(flush_last_interactions_periodically()))
+    if config.quota_config.enable:  # every process, each syncs its own counters
+        background_tasks.append(asyncio.create_task(sync_quotas_periodically()))
+    if config.config_reload_interval_sec:
+        background_tasks.append(asyncio.create_task(reload_config_periodically()))
+
+    if config.dialog_archival_config.enable and not worker_index:  # one process is enough
+        background_tasks.append(asyncio.create_task(archive_dialogs_periodically()))
+    if config.usage_aggregation_config.enable and not worker_index:
+        background_tasks.append(asyncio.create_task(aggregate_usage_periodically()))
+
+    if worker_index is None:
+        await set_bot_commands(application)
+
+    startup.profile.mark("post_init")
+    for phase, phase_sec in startup.profile.phases:
+        metrics.STARTUP_PHASE_SECONDS.labels(phase).set(phase_sec)
+    if config.profile_startup:
+        logger.info(startup.format_startup_report(startup.profile))
+    else:
+        logger.info(f"Ready to serve updates {startup.profile.ready_sec:.3f} sec after start")
+    background_tasks.append(asyncio.create_task(finish_startup_in_background()))
+
+
+async def set_bot_commands(application: Application):
     await application.bot.set_my_commands([
         BotCommand("/new", "Start new dialog"),
         BotCommand("/mode", "Select chat mode"),
@@ -674,17 +1328,52 @@ async def post_init(application: Application):
         BotCommand("/help", "Show help message"),
     ])
 
-def run_bot() -> None:
-    application = (
+async def post_shutdown(application: Application):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+    shutdown_coordinator.flush(states, db)
+    if config.quota_config.enable:
+        try:
+            quotas.store.sync()
+        except Exception:
+            logger.exception("Failed to sync quota counters")
+    logger.info(shutdown.format_shutdown_report(shutdown_coordinator.report))
+
+
+def setup_logging():
+    log_handler = logging.StreamHandler()
+    log_handler.addFilter(tracing.TraceIdLogFilter())
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s [trace_id=%(trace_id)s] %(name)s: %(message)s",
+        handlers=[log_handler]
+    )
+
+
+def build_application(base_url: str = None, n_workers: int = 1) -> Application:
+    # with n_workers > 1 this is one of the worker processes, updates are fed by the supervisor and
+    # the Bot API rate limits are shared between the workers
+    application_builder = (
         ApplicationBuilder()
         .token(config.telegram_token)
         .concurrent_updates(True)
-        .rate_limiter(AIORateLimiter(max_retries=5))
+        .rate_limiter(metrics.InstrumentedRateLimiter(
+            overall_max_rate=30 / n_workers,
+            group_max_rate=20 / n_workers,
+            max_retries=5
+        ))
         .http_version("1.1")
         .get_updates_http_version("1.1")
         .post_init(post_init)
-        .build()
+        .post_shutdown(post_shutdown)
     )
+    if base_url is not None:  # e.g. a local Bot API server
+        application_builder = application_builder.base_url(base_url)
+    if n_workers > 1:
+        application_builder = application_builder.updater(None)
+    application = application_builder.build()
 
     # add handlers
     user_filter = filters.ALL
@@ -712,14 +1401,97 @@ def run_bot() -> None:
 
     application.add_handler(CommandHandler("settings", settings_handle, filters=user_filter))
     application.add_handler(CallbackQueryHandler(set_settings_handle, pattern="^set_settings"))
+    application.add_handler(CallbackQueryHandler(set_model_fallback_handle, pattern="^set_model_fallback"))
 
     application.add_handler(CommandHandler("balance", show_balance_handle, filters=user_filter))
 
     application.add_error_handler(error_handle)
 
-    # start the bot
+    startup.profile.mark("build_application")
+    return application
+
+
+def run_worker(index: int, update_queue) -> None:
+    # entry point of a worker process, mirrors Application.run_polling without the updater
+    global worker_index
+    worker_index = index
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole process group, the supervisor handles it
+
+    setup_logging()
+    application = build_application(n_workers=config.n_workers)
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(application.initialize())
+        loop.run_until_complete(application.post_init(application))
+        loop.run_until_complete(application.start())
+        sharding.start_update_feeder(
+            loop, application, update_queue,
+            on_stop=lambda: shutdown_coordinator.request_stop(application)
+        )
+        logger.info(f"Worker {worker_index} started")
+        loop.run_forever()
+    finally:
+        if application.running:
+            loop.run_until_complete(application.stop())
+        loop.run_until_complete(application.shutdown())
+        loop.run_until_complete(application.post_shutdown(application))
+
+
+def run_supervisor() -> None:
+    # fetches updates and routes every user to the worker process owning its shard,
+    # per-user ordering holds because the front handles updates one by one and a user always maps to one worker
+    worker_pool = sharding.WorkerPool(
+        config.n_workers, run_worker, route_group_chats_by_chat=config.group_chat_config.enable
+    )
+    supervisor_tasks = []
+
+    async def route_update(update: Update, context: CallbackContext):
+        worker_pool.route(update)
+
+    async def restart_dead_workers_periodically():
+        while True:
+            await asyncio.sleep(5)
+            worker_pool.restart_dead_workers()
+
+    async def supervisor_post_init(application: Application):
+        worker_pool.start()
+        supervisor_tasks.append(asyncio.create_task(restart_dead_workers_periodically()))
+        await set_bot_commands(application)
+
+    async def supervisor_post_stop(application: Application):
+        for task in supervisor_tasks:
+            task.cancel()
+        await asyncio.gather(*supervisor_tasks, return_exceptions=True)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, worker_pool.stop, config.shutdown_drain_timeout_sec + 5)
+
+    application = (
+        ApplicationBuilder()
+        .token(config.telegram_token)
+        .get_updates_http_version("1.1")
+        .post_init(supervisor_post_init)
+        .post_stop(supervisor_post_stop)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, route_update))
+
+    logger.info(f"Starting supervisor with {config.n_workers} workers")
     application.run_polling()
 
 
+def run_bot() -> None:
+    setup_logging()
+    if config.n_workers > 1:
+        run_supervisor()
+        return
+
+    application = build_application()
+
+    # start the bot, stop signals are handled by shutdown_coordinator
+    application.run_polling(stop_signals=None)
+
+
 if __name__ == "__main__":
     run_bot()
@@ -1,6 +1,21 @@
+import os
 import yaml
 import dotenv
 from pathlib import Path
+from typing import NamedTuple, Optional, Tuple
+
+
+class RetrievalConfiguration:
+    def __init__(self, config_data):
+        self.enable = config_data.get("enable", False)
+        self.embedder = config_data.get("embedder", "hashing")
+        self.hashing_dim = config_data.get("hashing_dim", 256)
+        self.openai_model = config_data.get("openai_model", "text-embedding-ada-002")
+        self.top_k = config_data.get("top_k", 3)
+        self.max_tokens = config_data.get("max_tokens", 500)
+        self.min_score = config_data.get("min_score", 0.2)
+        self.max_indexed_turns = config_data.get("max_indexed_turns", 1000)
+        self.embedding_batch_size = config_data.get("embedding_batch_size", 100)
 
 
 class LongDialogConfiguration:
@@ -17,8 +32,195 @@ class LongDialogConfiguration:
 
         self.save_all_timeout_min = config_data["save_all_timeout_min"]
 
+        self.retrieval = RetrievalConfiguration(config_data.get("retrieval", {}))
+
+
+class MessageQueueConfiguration:
+    def __init__(self, config_data):
+        self.max_size = config_data.get("max_size", 5)
+        self.coalesce_window_sec = config_data.get("coalesce_window_sec", 0)
+
+
+class LLMProviderConfiguration:
+    def __init__(self, config_data):
+        self.type = config_data.get("type", "openai")
+        self.mock_options = config_data.get("mock", {})
+
+
+class HedgingConfiguration:
+    def __init__(self, config_data):
+        self.enable = config_data.get("enable", False)
+        self.delay_percentile = config_data.get("delay_percentile", 95)
+        self.default_delay_sec = config_data.get("default_delay_sec", 5)
+        self.min_delay_sec = config_data.get("min_delay_sec", 1)
+        self.max_input_tokens = config_data.get("max_input_tokens", 1000)
+
+
+class ModelRoutingConfiguration:
+    def __init__(self, config_data):
+        self.enable = config_data.get("enable", False)
+        self.first_token_timeout_sec = config_data.get("first_token_timeout_sec", 15)
+        self.slow_first_token_sec = config_data.get("slow_first_token_sec", 5)
+        self.max_error_rate = config_data.get("max_error_rate", 0.3)
+        self.max_in_flight_per_model = config_data.get("max_in_flight_per_model", 50)
+        self.probe_interval_sec = config_data.get("probe_interval_sec", 30)
+        self.moving_average_weight = config_data.get("moving_average_weight", 0.2)
+
+
+class GroupChatConfiguration:
+    def __init__(self, config_data):
+        self.enable = config_data.get("enable", False)
+        self.chat_mode = config_data.get("chat_mode", "assistant")
+        self.model = config_data.get("model", "gpt-3.5-turbo")
+        self.batch_window_sec = config_data.get("batch_window_sec", 3)
+        self.max_batch_size = config_data.get("max_batch_size", 10)
+        self.max_queue_size = config_data.get("max_queue_size", 20)
+        self.max_completions_per_min = config_data.get("max_completions_per_min", 4)
+        self.max_dialog_messages = config_data.get("max_dialog_messages", 30)
+
+
+class MongoDBConfiguration:
+    def __init__(self, config_data):
+        self.slow_query_threshold_ms = config_data.get("slow_query_threshold_ms", 100)
+        self.archived_dialog_ttl_days = config_data.get("archived_dialog_ttl_days", None)
+        self.use_transactions = config_data.get("use_transactions", False)
+
+
+class UsageAggregationConfiguration:
+    def __init__(self, config_data):
+        self.enable = config_data.get("enable", False)
+        self.interval_min = config_data.get("interval_min", 10)
+        self.usage_log_ttl_days = config_data.get("usage_log_ttl_days", 90)
+
+
+class QuotaLimits:
+    def __init__(self, config_data):
+        tokens_per_day = config_data.get("tokens_per_day", None)
+        if tokens_per_day is None or isinstance(tokens_per_day, (int, float)):
+            tokens_per_day = {"default": tokens_per_day}
+        self.tokens_per_day = tokens_per_day  # model -> limit, "default" for other models
+        self.images_per_day = config_data.get("images_per_day", None)
+        self.transcription_min_per_day = config_data.get("transcription_min_per_day", None)
+
+    def get_tokens_per_day(self, model):
+        return self.tokens_per_day.get(model, self.tokens_per_day.get("default", None))
 
-config_dir = Path(__file__).parent.parent.resolve() / "config"
+
+class QuotaConfiguration:
+    def __init__(self, config_data):
+        self.enable = config_data.get("enable", False)
+        self.downgrade_model = config_data.get("downgrade_model", None)
+        self.sync_interval_sec = config_data.get("sync_interval_sec", 10)
+        self.user_limits = QuotaLimits(config_data.get("user", {}))
+        self.group_chat_limits = QuotaLimits(config_data.get("group_chat", {}))
+
+
+class MetricsConfiguration:
+    def __init__(self, config_data):
+        self.enable = config_data.get("enable", False)
+        self.host = config_data.get("host", "0.0.0.0")
+        self.port = config_data.get("port", 9090)
+
+
+class TracingConfiguration:
+    def __init__(self, config_data):
+        self.enable = config_data.get("enable", False)
+        self.service_name = config_data.get("service_name", "chatgpt_telegram_bot")
+        self.file_path = config_data.get("file_path", None)
+        self.collector_url = config_data.get("collector_url", None)
+
+
+class DialogArchivalConfiguration:
+    def __init__(self, config_data):
+        self.enable = config_data.get("enable", False)
+        self.older_than_days = config_data.get("older_than_days", 30)
+        self.interval_hours = config_data.get("interval_hours", 24)
+
+
+class ChatMode(NamedTuple):
+    key: str
+    name: str
+    welcome_message: str
+    prompt_start: Optional[str]
+    parse_mode: str  # "html" or "markdown"
+
+
+class Model(NamedTuple):
+    key: str
+    type: str
+    name: Optional[str]
+    description: Optional[str]
+    price_per_1000_input_tokens: float
+    price_per_1000_output_tokens: float
+    price_per_1_image: float
+    price_per_1_min: float
+    scores: Tuple[Tuple[str, int], ...]
+
+    def get_cost(self, n_input_tokens=0, n_output_tokens=0, n_images=0, n_transcribed_seconds=0.0):
+        return (
+            self.price_per_1000_input_tokens * (n_input_tokens / 1000)
+            + self.price_per_1000_output_tokens * (n_output_tokens / 1000)
+            + self.price_per_1_image * n_images
+            + self.price_per_1_min * (n_transcribed_seconds / 60)
+        )
+
+
+class ConfigSnapshot:
+    # chat modes and models compiled from chat_modes.yml and models.yml,
+    # a reload builds a new snapshot and replaces the old one as a whole
+    def __init__(self, chat_modes_data, models_data, mtimes=None):
+        self.chat_modes = {
+            key: ChatMode(
+                key=key,
+                name=data["name"],
+                welcome_message=data["welcome_message"],
+                prompt_start=data.get("prompt_start", None),
+                parse_mode=data.get("parse_mode", "html")
+            )
+            for key, data in chat_modes_data.items()
+        }
+        self.chat_mode_keys = tuple(self.chat_modes.keys())
+
+        self.models = {
+            key: Model(
+                key=key,
+                type=data["type"],
+                name=data.get("name", None),
+                description=data.get("description", None),
+                price_per_1000_input_tokens=data.get("price_per_1000_input_tokens", 0),
+                price_per_1000_output_tokens=data.get("price_per_1000_output_tokens", 0),
+                price_per_1_image=data.get("price_per_1_image", 0),
+                price_per_1_min=data.get("price_per_1_min", 0),
+                scores=tuple(data.get("scores", {}).items())
+            )
+            for key, data in models_data["info"].items()
+        }
+        self.available_text_models = tuple(models_data["available_text_models"])
+        for key in self.available_text_models + ("dalle-2", "whisper"):
+            if key not in self.models:
+                raise ValueError(f"Model {key} is not described in models.yml")
+        for chat_mode in self.chat_modes.values():
+            if chat_mode.parse_mode not in {"html", "markdown"}:
+                raise ValueError(f"Unknown parse_mode of {chat_mode.key} chat mode: {chat_mode.parse_mode}")
+
+        self.mtimes = mtimes
+
+
+def get_reloadable_files_mtimes():
+    return tuple(os.stat(path).st_mtime_ns for path in (config_dir / "chat_modes.yml", config_dir / "models.yml"))
+
+
+def load_snapshot():
+    # raises on invalid files, the caller keeps the current snapshot then
+    mtimes = get_reloadable_files_mtimes()
+    with open(config_dir / "chat_modes.yml", 'r') as f:
+        chat_modes_data = yaml.safe_load(f)
+    with open(config_dir / "models.yml", 'r') as f:
+        models_data = yaml.safe_load(f)
+    return ConfigSnapshot(chat_modes_data, models_data, mtimes=mtimes)
+
+
+config_dir = Path(os.environ.get("BOT_CONFIG_DIR", Path(__file__).parent.parent.resolve() / "config"))
 
 # load yaml config
 with open(config_dir / "config.yml", 'r') as f:
@@ -33,19 +235,31 @@ openai_api_key = config_yaml["openai_api_key"]
 openai_api_base = config_yaml.get("openai_api_base", None)
 allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
 new_dialog_timeout = config_yaml["new_dialog_timeout"]
+last_interaction_flush_interval_sec = config_yaml.get("last_interaction_flush_interval_sec", 5)
+shutdown_drain_timeout_sec = config_yaml.get("shutdown_drain_timeout_sec", 20)
+profile_startup = config_yaml.get("profile_startup", False)
+n_workers = config_yaml.get("n_workers", 1)
 enable_message_streaming = config_yaml.get("enable_message_streaming", True)
+save_canceled_answers = config_yaml.get("save_canceled_answers", False)
 long_dialog_config = LongDialogConfiguration(config_yaml['long_dialog'])
+message_queue_config = MessageQueueConfiguration(config_yaml.get("message_queue", {}))
+llm_provider_config = LLMProviderConfiguration(config_yaml.get("llm_provider", {}))
+hedging_config = HedgingConfiguration(config_yaml.get("hedging", {}))
+group_chat_config = GroupChatConfiguration(config_yaml.get("group_chat", {}))
+model_routing_config = ModelRoutingConfiguration(config_yaml.get("model_routing", {}))
 return_n_generated_images = config_yaml.get("return_n_generated_images", 1)
 n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 5)
-mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
-
-# chat_modes
-with open(config_dir / "chat_modes.yml", 'r') as f:
-    chat_modes = yaml.safe_load(f)
+config_reload_interval_sec = config_yaml.get("config_reload_interval_sec", 5)
+mongodb_uri = config_env.get("MONGODB_URI", f"mongodb://mongo:{config_env['MONGODB_PORT']}")
+mongodb_config = MongoDBConfiguration(config_yaml.get("mongodb", {}))
+dialog_archival_config = DialogArchivalConfiguration(config_yaml.get("dialog_archival", {}))
+quota_config = QuotaConfiguration(config_yaml.get("quota", {}))
+usage_aggregation_config = UsageAggregationConfiguration(config_yaml.get("usage_aggregation", {}))
+metrics_config = MetricsConfiguration(config_yaml.get("metrics", {}))
+tracing_config = TracingConfiguration(config_yaml.get("tracing", {}))
 
-# models
-with open(config_dir / "models.yml", 'r') as f:
-    models = yaml.safe_load(f)
+# chat modes and models, reloaded by the bot when the files change
+snapshot = load_snapshot()
 
 # files
 help_group_chat_video_path = Path(__file__).parent.parent.resolve() / "static" / "help_group_chat.mp4"
@@ -1,20 +1,356 @@
 from typing import Optional, Any
 
+import contextvars
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import bson
 import pymongo
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 import uuid
-from datetime import datetime
+import zlib
+from datetime import datetime, timedelta
 
 import config
 
 
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# collection name -> indexes declared at startup (create_indexes is idempotent)
+INDEXES = {
+    "user": [
+        IndexModel([("last_interaction", DESCENDING)], name="last_interaction"),
+    ],
+    "dialog": [
+        IndexModel([("user_id", ASCENDING), ("start_time", DESCENDING)], name="user_id_start_time"),
+        IndexModel([("start_time", ASCENDING)], name="start_time"),
+    ],
+    "archived_dialog": [
+        IndexModel([("user_id", ASCENDING), ("start_time", DESCENDING)], name="user_id_start_time"),
+    ],
+    "usage_log": [
+        IndexModel([("time", ASCENDING), ("user_id", ASCENDING)], name="time_user_id"),
+    ],
+    "usage_daily": [
+        IndexModel([("day", ASCENDING), ("user_id", ASCENDING)], name="day_user_id"),
+        IndexModel([("user_id", ASCENDING), ("day", ASCENDING)], name="user_id_day"),
+    ],
+}
+ARCHIVED_DIALOG_TTL_INDEX_NAME = "archived_at_ttl"
+USAGE_LOG_TTL_INDEX_NAME = "time_ttl"
+QUOTA_USAGE_TTL_INDEX_NAME = "day_ttl"
+QUOTA_USAGE_TTL_DAYS = 7
+USAGE_FIELDS = ("n_input_tokens", "n_output_tokens", "n_images", "n_transcribed_seconds", "n_spent_dollars")
+USAGE_AGGREGATION_BATCH_SIZE = 500
+ARCHIVE_BATCH_SIZE = 100
+ARCHIVE_COMPRESSION_LEVEL = 9
+MIGRATION_BATCH_SIZE = 500
+EXPORT_BATCH_SIZE = 100
+IMPORT_BATCH_SIZE = 500
+DUPLICATE_KEY_ERROR_CODE = 11000
+UNIT_OF_WORK_COLLECTION_ORDER = {"dialog": 0, "user": 1}
+MODEL_KEY_DOT = "\uff0e"  # stands for "." in the model keys of n_used_tokens, a dot would split the path of $inc
+
+current_unit_of_work = contextvars.ContextVar("current_unit_of_work", default=None)
+
+
+def _query_shape(value):
+    # replaces values with their type names, so that queries differing only in values look the same
+    if isinstance(value, dict):
+        return {key: _query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_query_shape(item) for item in value[:1]]
+    return type(value).__name__
+
+
+class QueryProfiler:
+    def __init__(self, slow_query_threshold_ms: Optional[float]):
+        self.slow_query_threshold_ms = slow_query_threshold_ms
+        self.listeners = []  # callables receiving (method_name, elapsed_seconds) of every top-level call
+        self._local = threading.local()
+
+    @contextmanager
+    def track(self, method_name: str):
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            self._local.queries = []
+        self._local.depth = depth + 1
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                elapsed_seconds = time.perf_counter() - start_time
+                for listener in self.listeners:
+                    listener(method_name, elapsed_seconds)
+
+                elapsed_ms = elapsed_seconds * 1000
+                if self.slow_query_threshold_ms is not None and elapsed_ms >= self.slow_query_threshold_ms:
+                    logger.warning(
+                        "Slow database call: Database.%s took %.1f ms, queries: %s",
+                        method_name, elapsed_ms, self._local.queries
+                    )
+
+    def record(self, collection_name: str, operation: str, args: tuple, kwargs: dict):
+        if getattr(self._local, "depth", 0) == 0:
+            return
+
+        spec = args[0] if args else kwargs.get("filter")
+        if isinstance(spec, list):  # bulk_write / insert_many
+            shape = [type(item).__name__ for item in spec]
+        else:
+            shape = _query_shape(spec)
+        self._local.queries.append(f"{collection_name}.{operation}({shape})")
+
+
+class ProfiledCollection:
+    # thin proxy that reports every collection call to the profiler
+    def __init__(self, collection, profiler: QueryProfiler):
+        self._collection = collection
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def wrapper(*args, **kwargs):
+            self._profiler.record(self._collection.name, name, args, kwargs)
+            return attr(*args, **kwargs)
+
+        return wrapper
+
+
+def compress_messages(messages: list) -> bson.Binary:
+    return bson.Binary(zlib.compress(bson.encode({"messages": messages}), ARCHIVE_COMPRESSION_LEVEL))
+
+
+def decompress_messages(data: bytes) -> list:
+    return bson.decode(zlib.decompress(data))["messages"]
+
+
+def unarchive_dialog(archived_dialog: dict) -> dict:
+    dialog_dict = {
+        key: value for key, value in archived_dialog.items()
+        if key not in {"archived_at", "n_messages", "messages_zlib"}
+    }
+    dialog_dict["messages"] = decompress_messages(archived_dialog["messages_zlib"])
+    return dialog_dict
+
+
+def encode_model_key(model: str) -> str:
+    return model.replace(".", MODEL_KEY_DOT)
+
+
+def decode_model_key(key: str) -> str:
+    return key.replace(MODEL_KEY_DOT, ".")
+
+
+def _migrate_user_to_v1(user_dict: dict) -> dict:
+    # back compatibility for fields added after the first release
+    updates = {}
+
+    n_used_tokens = user_dict.get("n_used_tokens")
+    if isinstance(n_used_tokens, int) or isinstance(n_used_tokens, float):  # old format
+        updates["n_used_tokens"] = {
+            "gpt-3.5-turbo": {
+                "n_input_tokens": 0,
+                "n_output_tokens": n_used_tokens
+            }
+        }
+    elif n_used_tokens is None:
+        updates["n_used_tokens"] = {}
+
+    if user_dict.get("current_model") is None:
+        updates["current_model"] = config.snapshot.available_text_models[0]
+
+    # voice message transcription
+    if user_dict.get("n_transcribed_seconds") is None:
+        updates["n_transcribed_seconds"] = 0.0
+
+    # image generation
+    if user_dict.get("n_generated_images") is None:
+        updates["n_generated_images"] = 0
+
+    return updates
+
+
+def _migrate_user_to_v2(user_dict: dict) -> dict:
+    # model routing is opt-in
+    if user_dict.get("enable_model_fallback") is None:
+        return {"enable_model_fallback": False}
+    return {}
+
+
+def _migrate_user_to_v3(user_dict: dict) -> dict:
+    # model keys of n_used_tokens are escaped, so that update_n_used_tokens can $inc them
+    n_used_tokens = user_dict.get("n_used_tokens") or {}
+    if not any("." in model for model in n_used_tokens):
+        return {}
+
+    escaped_n_used_tokens = {}
+    for model, model_n_used_tokens in n_used_tokens.items():
+        # a key can be there both escaped and not if tokens were added before the migration
+        escaped_model_n_used_tokens = escaped_n_used_tokens.setdefault(
+            encode_model_key(model), {"n_input_tokens": 0, "n_output_tokens": 0}
+        )
+        for name in ("n_input_tokens", "n_output_tokens"):
+            escaped_model_n_used_tokens[name] += model_n_used_tokens.get(name, 0)
+    return {"n_used_tokens": escaped_n_used_tokens}
+
+
+# (schema version, migration) pairs in ascending order, each migration returns fields to $set
+USER_MIGRATIONS = [
+    (1, _migrate_user_to_v1),
+    (2, _migrate_user_to_v2),
+    (3, _migrate_user_to_v3),
+]
+USER_SCHEMA_VERSION = USER_MIGRATIONS[-1][0]
+
+
+def get_user_migration_updates(user_dict: dict) -> dict:
+    schema_version = user_dict.get("schema_version", 0)
+
+    updates = {}
+    for version, migration in USER_MIGRATIONS:
+        if version > schema_version:
+            user_updates = migration({**user_dict, **updates})
+            updates.update(user_updates)
+    updates["schema_version"] = USER_SCHEMA_VERSION
+    return updates
+
+
+class UnitOfWork:
+    def __init__(self, database, use_transaction: bool = False):
+        self.database = database
+        self.use_transaction = use_transaction
+
+        self._requests = {}  # collection name -> (collection, write requests in order)
+
+        # pending state, so that reads inside the unit of work see its own writes
+        self.user_updates = {}  # user_id -> {key: value}
+        self.user_increments = {}  # user_id -> {key: amount}, added to the value after user_updates
+        self.dialog_messages = {}  # dialog_id -> messages
+        self.n_used_tokens_increments = {}  # user_id -> {model: (n_input_tokens, n_output_tokens)}
+
+    def add(self, collection, request):
+        self._requests.setdefault(collection.name, (collection, []))[1].append(request)
+
+    def commit(self):
+        requests = self._requests
+        self._requests = {}
+        self.user_updates = {}
+        self.user_increments = {}
+        self.dialog_messages = {}
+        self.n_used_tokens_increments = {}
+
+        if not requests:
+            return
+
+        # dialogs are written before the users that reference them
+        collection_names = sorted(requests.keys(), key=lambda name: UNIT_OF_WORK_COLLECTION_ORDER.get(name, 0))
+
+        def write(session=None):
+            for collection_name in collection_names:
+                collection, collection_requests = requests[collection_name]
+                collection.bulk_write(collection_requests, ordered=True, session=session)
+
+        with self.database.profiler.track("commit_unit_of_work"):
+            if self.use_transaction:
+                with self.database.client.start_session() as session:
+                    session.with_transaction(write)
+            else:
+                write()
+
+
+def profiled(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.profiler.track(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
 class Database:
-    def __init__(self):
+    def __init__(self, bootstrap: bool = True):
+        # bootstrap=False leaves bootstrap_schema() to the caller, it needs a round trip to MongoDB per index
         self.client = pymongo.MongoClient(config.mongodb_uri)
         self.db = self.client["chatgpt_telegram_bot"]
+        self.profiler = QueryProfiler(config.mongodb_config.slow_query_threshold_ms)
+
+        self.user_collection = ProfiledCollection(self.db["user"], self.profiler)
+        self.dialog_collection = ProfiledCollection(self.db["dialog"], self.profiler)
+        self.archived_dialog_collection = ProfiledCollection(self.db["archived_dialog"], self.profiler)
+        self.usage_log_collection = ProfiledCollection(self.db["usage_log"], self.profiler)  # one document per billed request
+        self.usage_daily_collection = ProfiledCollection(self.db["usage_daily"], self.profiler)  # sums per day, user and model
+        self.quota_usage_collection = ProfiledCollection(self.db["quota_usage"], self.profiler)  # counters of quota.QuotaStore
+        self.group_chat_collection = ProfiledCollection(self.db["group_chat"], self.profiler)  # shared dialog of every group chat
+
+        # last_interaction values waiting for flush_last_interactions
+        self._pending_last_interactions = {}
+        self._pending_last_interactions_lock = threading.Lock()
+
+        if bootstrap:
+            self.bootstrap_schema()
+
+    def bootstrap_schema(self):
+        for collection_name, indexes in INDEXES.items():
+            self.db[collection_name].create_indexes(indexes)
 
-        self.user_collection = self.db["user"]
-        self.dialog_collection = self.db["dialog"]
+        self._ensure_ttl_index("archived_dialog", "archived_at", ARCHIVED_DIALOG_TTL_INDEX_NAME, config.mongodb_config.archived_dialog_ttl_days)
+        self._ensure_ttl_index("usage_log", "time", USAGE_LOG_TTL_INDEX_NAME, config.usage_aggregation_config.usage_log_ttl_days)
+        self._ensure_ttl_index("quota_usage", "day", QUOTA_USAGE_TTL_INDEX_NAME, QUOTA_USAGE_TTL_DAYS)
 
+    def _ensure_ttl_index(self, collection_name: str, field: str, index_name: str, ttl_days: Optional[float]):
+        collection = self.db[collection_name]
+        if ttl_days is None:
+            if index_name in collection.index_information():
+                collection.drop_index(index_name)
+            return
+
+        expire_after_seconds = int(ttl_days * SECONDS_PER_DAY)
+        try:
+            collection.create_index(
+                [(field, ASCENDING)],
+                name=index_name,
+                expireAfterSeconds=expire_after_seconds
+            )
+        except OperationFailure:  # index exists with another ttl
+            self.db.command(
+                "collMod", collection.name,
+                index={"name": index_name, "expireAfterSeconds": expire_after_seconds}
+            )
+
+    @contextmanager
+    def unit_of_work(self, use_transaction: Optional[bool] = None):
+        # collects writes made inside the block and commits them on exit, nested blocks join the outer one
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None:
+            yield unit_of_work
+            return
+
+        if use_transaction is None:
+            use_transaction = config.mongodb_config.use_transactions
+        unit_of_work = UnitOfWork(self, use_transaction=use_transaction)
+        token = current_unit_of_work.set(unit_of_work)
+        try:
+            yield unit_of_work
+        finally:
+            current_unit_of_work.reset(token)
+            # writes queued before an exception are committed too, as they would have been without the unit of work
+            unit_of_work.commit()
+
+    @profiled
     def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
         if self.user_collection.count_documents({"_id": user_id}) > 0:
             return True
@@ -24,7 +360,7 @@ class Database:
             else:
                 return False
 
-    def add_new_user(
+    def _new_user_dict(
         self,
         user_id: int,
         chat_id: int,
@@ -32,8 +368,9 @@ class Database:
         first_name: str = "",
         last_name: str = "",
     ):
-        user_dict = {
+        return {
             "_id": user_id,
+            "schema_version": USER_SCHEMA_VERSION,
             "chat_id": chat_id,
 
             "username": username,
@@ -45,7 +382,8 @@ class Database:
 
             "current_dialog_id": None,
             "current_chat_mode": "assistant",
-            "current_model": config.models["available_text_models"][0],
+            "current_model": config.snapshot.available_text_models[0],
+            "enable_model_fallback": False,
 
             "n_used_tokens": {},
 
@@ -53,22 +391,86 @@ class Database:
             "n_transcribed_seconds": 0.0  # voice message transcription
         }
 
+    @profiled
+    def add_new_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ):
+        user_dict = self._new_user_dict(user_id, chat_id, username=username, first_name=first_name, last_name=last_name)
+
         if not self.check_if_user_exists(user_id):
             self.user_collection.insert_one(user_dict)
 
+    @profiled
+    def register_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ):
+        # inserts the user if needed and returns its document in a single round trip
+        user_dict = self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            {"$setOnInsert": self._new_user_dict(user_id, chat_id, username=username, first_name=first_name, last_name=last_name)},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+        # users not covered by migrate_users yet
+        if user_dict.get("schema_version", 0) < USER_SCHEMA_VERSION:
+            updates = get_user_migration_updates(user_dict)
+            self.user_collection.update_one({"_id": user_id}, {"$set": updates})
+            user_dict.update(updates)
+
+        return user_dict
+
+    @profiled
+    def migrate_users(self):
+        n_migrated_users = 0
+
+        requests = []
+        cursor = self.user_collection.find(
+            {"schema_version": {"$not": {"$gte": USER_SCHEMA_VERSION}}},
+            batch_size=MIGRATION_BATCH_SIZE
+        )
+        for user_dict in cursor:
+            requests.append(UpdateOne({"_id": user_dict["_id"]}, {"$set": get_user_migration_updates(user_dict)}))
+            if len(requests) >= MIGRATION_BATCH_SIZE:
+                n_migrated_users += self.user_collection.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if requests:
+            n_migrated_users += self.user_collection.bulk_write(requests, ordered=False).modified_count
+
+        return n_migrated_users
+
+    @profiled
     def start_new_dialog(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        user_dict = self._get_user_attributes(user_id, ["current_chat_mode", "current_model"])
 
         dialog_id = str(uuid.uuid4())
         dialog_dict = {
             "_id": dialog_id,
             "user_id": user_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "chat_mode": user_dict.get("current_chat_mode"),
             "start_time": datetime.now(),
-            "model": self.get_user_attribute(user_id, "current_model"),
+            "model": user_dict.get("current_model"),
             "messages": []
         }
 
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None:
+            unit_of_work.add(self.dialog_collection, InsertOne(dialog_dict))
+            unit_of_work.add(self.user_collection, UpdateOne({"_id": user_id}, {"$set": {"current_dialog_id": dialog_id}}))
+            unit_of_work.dialog_messages[dialog_id] = []
+            unit_of_work.user_updates.setdefault(user_id, {})["current_dialog_id"] = dialog_id
+            return dialog_id
+
         # add new dialog
         self.dialog_collection.insert_one(dialog_dict)
 
@@ -80,49 +482,414 @@ class Database:
 
         return dialog_id
 
+    def _get_user_attributes(self, user_id: int, keys: list):
+        # reads several attributes with one query, taking writes pending in the unit of work into account
+        user_dict = self.user_collection.find_one({"_id": user_id}, {key: 1 for key in keys})
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
+
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None:
+            user_dict.update(unit_of_work.user_updates.get(user_id, {}))
+
+        return user_dict
+
+    @profiled
     def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+        if key == "last_interaction":
+            with self._pending_last_interactions_lock:
+                last_interaction = self._pending_last_interactions.get(user_id)
+            if last_interaction is not None:
+                return last_interaction
 
-        if key not in user_dict:
-            return None
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None and key in unit_of_work.user_updates.get(user_id, {}):
+            value = unit_of_work.user_updates[user_id][key]
+        else:
+            self.check_if_user_exists(user_id, raise_exception=True)
+            user_dict = self.user_collection.find_one({"_id": user_id})
+            value = user_dict.get(key)
+
+        if unit_of_work is not None and key in unit_of_work.user_increments.get(user_id, {}):
+            value = (value or 0) + unit_of_work.user_increments[user_id][key]
 
-        return user_dict[key]
+        return value
 
+    @profiled
     def set_user_attribute(self, user_id: int, key: str, value: Any):
         self.check_if_user_exists(user_id, raise_exception=True)
+
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None:
+            unit_of_work.add(self.user_collection, UpdateOne({"_id": user_id}, {"$set": {key: value}}))
+            unit_of_work.user_updates.setdefault(user_id, {})[key] = value
+            unit_of_work.user_increments.get(user_id, {}).pop(key, None)
+            return
+
         self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
 
+    def _increment_user_attribute(self, user_id: int, key: str, amount: float):
+        # $inc, so that increments of handlers overlapping for one user add up
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None:
+            unit_of_work.add(self.user_collection, UpdateOne({"_id": user_id}, {"$inc": {key: amount}}))
+            increments = unit_of_work.user_increments.setdefault(user_id, {})
+            increments[key] = increments.get(key, 0) + amount
+            return
+
+        self.user_collection.update_one({"_id": user_id}, {"$inc": {key: amount}})
+
+    def set_last_interaction(self, user_id: int, last_interaction: datetime):
+        # buffered in memory, written by flush_last_interactions
+        with self._pending_last_interactions_lock:
+            self._pending_last_interactions[user_id] = last_interaction
+
+    @profiled
+    def flush_last_interactions(self):
+        # pending values stay readable by get_user_attribute until they are written,
+        # so a read during the write or after a failed one doesn't see the older value in MongoDB
+        with self._pending_last_interactions_lock:
+            pending_last_interactions = dict(self._pending_last_interactions)
+
+        if not pending_last_interactions:
+            return 0
+
+        requests = [
+            UpdateOne({"_id": user_id}, {"$max": {"last_interaction": last_interaction}})
+            for user_id, last_interaction in pending_last_interactions.items()
+        ]
+        self.user_collection.bulk_write(requests, ordered=False)
+
+        # values set during the write are left for the next flush
+        with self._pending_last_interactions_lock:
+            for user_id, last_interaction in pending_last_interactions.items():
+                if self._pending_last_interactions.get(user_id) == last_interaction:
+                    del self._pending_last_interactions[user_id]
+
+        return len(requests)
+
+    @profiled
     def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
+        # $inc, so that the tokens of handlers overlapping for one user add up
+        model_key = encode_model_key(model)
+        update = {"$inc": {
+            f"n_used_tokens.{model_key}.n_input_tokens": n_input_tokens,
+            f"n_used_tokens.{model_key}.n_output_tokens": n_output_tokens
+        }}
 
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None:
+            unit_of_work.add(self.user_collection, UpdateOne({"_id": user_id}, update))
+            increments = unit_of_work.n_used_tokens_increments.setdefault(user_id, {})
+            prev_n_input_tokens, prev_n_output_tokens = increments.get(model, (0, 0))
+            increments[model] = (prev_n_input_tokens + n_input_tokens, prev_n_output_tokens + n_output_tokens)
         else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens
-            }
+            self.user_collection.update_one({"_id": user_id}, update)
+
+        self.log_usage(user_id, model, n_input_tokens=n_input_tokens, n_output_tokens=n_output_tokens)
+
+    @profiled
+    def update_n_transcribed_seconds(self, user_id: int, n_transcribed_seconds: float):
+        self._increment_user_attribute(user_id, "n_transcribed_seconds", n_transcribed_seconds)
+        self.log_usage(user_id, "whisper", n_transcribed_seconds=n_transcribed_seconds)
+
+    @profiled
+    def update_n_generated_images(self, user_id: int, n_generated_images: int):
+        self._increment_user_attribute(user_id, "n_generated_images", n_generated_images)
+        self.log_usage(user_id, "dalle-2", n_images=n_generated_images)
+
+    @profiled
+    def get_n_used_tokens(self, user_id: int) -> dict:
+        # model -> {"n_input_tokens": ..., "n_output_tokens": ...}, with the increments pending in the unit of work
+        n_used_tokens_dict = {
+            decode_model_key(model_key): dict(model_n_used_tokens)
+            for model_key, model_n_used_tokens in (self.get_user_attribute(user_id, "n_used_tokens") or {}).items()
+        }
+
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None:
+            for model, (n_input_tokens, n_output_tokens) in unit_of_work.n_used_tokens_increments.get(user_id, {}).items():
+                model_n_used_tokens = n_used_tokens_dict.setdefault(model, {"n_input_tokens": 0, "n_output_tokens": 0})
+                model_n_used_tokens["n_input_tokens"] += n_input_tokens
+                model_n_used_tokens["n_output_tokens"] += n_output_tokens
+
+        return n_used_tokens_dict
+
+    def log_usage(
+        self,
+        user_id: int,
+        model: str,
+        n_input_tokens: int = 0,
+        n_output_tokens: int = 0,
+        n_images: int = 0,
+        n_transcribed_seconds: float = 0.0
+    ):
+        # the cost is computed now, with the prices in effect
+        if not config.usage_aggregation_config.enable:
+            return
+
+        model_info = config.snapshot.models.get(model)
+        usage_dict = {
+            "user_id": user_id,
+            "time": datetime.now(),
+            "model": model,
+            "n_input_tokens": n_input_tokens,
+            "n_output_tokens": n_output_tokens,
+            "n_images": n_images,
+            "n_transcribed_seconds": n_transcribed_seconds,
+            "n_spent_dollars": 0.0 if model_info is None else model_info.get_cost(
+                n_input_tokens=n_input_tokens,
+                n_output_tokens=n_output_tokens,
+                n_images=n_images,
+                n_transcribed_seconds=n_transcribed_seconds
+            ),
+        }
+
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None:
+            unit_of_work.add(self.usage_log_collection, InsertOne(usage_dict))
+            return
+
+        self.usage_log_collection.insert_one(usage_dict)
+
+    @profiled
+    def aggregate_usage(self, since: datetime):
+        # recomputes the daily summaries of every day from the one of since up to today, so reruns are harmless
+        day = since.replace(hour=0, minute=0, second=0, microsecond=0)
+        n_summaries = 0
+        while day <= datetime.now():
+            next_day = day + timedelta(days=1)
+            pipeline = [
+                {"$match": {"time": {"$gte": day, "$lt": next_day}}},
+                {"$group": {
+                    "_id": {"user_id": "$user_id", "model": "$model"},
+                    **{field: {"$sum": f"${field}"} for field in USAGE_FIELDS}
+                }},
+            ]
+
+            requests = []
+            for group in self.usage_log_collection.aggregate(pipeline, allowDiskUse=True):
+                user_id, model = group["_id"]["user_id"], group["_id"]["model"]
+                summary = {
+                    "day": day,
+                    "user_id": user_id,
+                    "model": model,
+                    **{field: group[field] for field in USAGE_FIELDS}
+                }
+                requests.append(UpdateOne({"_id": f"{day:%Y-%m-%d}:{user_id}:{model}"}, {"$set": summary}, upsert=True))
+                if len(requests) >= USAGE_AGGREGATION_BATCH_SIZE:
+                    self.usage_daily_collection.bulk_write(requests, ordered=False)
+                    n_summaries += len(requests)
+                    requests = []
+            if requests:
+                self.usage_daily_collection.bulk_write(requests, ordered=False)
+                n_summaries += len(requests)
+
+            day = next_day
 
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+        return n_summaries
 
+    @profiled
+    def get_usage_summaries(
+        self,
+        day_from: datetime,
+        day_to: Optional[datetime] = None,
+        user_id: Optional[int] = None,
+        group_by: str = "model",
+        limit: Optional[int] = None
+    ):
+        # sums of the daily summaries of [day_from, day_to) by "model" or "user_id", most expensive first
+        match = {"day": {"$gte": day_from}}
+        if day_to is not None:
+            match["day"]["$lt"] = day_to
+        if user_id is not None:
+            match["user_id"] = user_id
+
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": f"${group_by}", **{field: {"$sum": f"${field}"} for field in USAGE_FIELDS}}},
+            {"$sort": {"n_spent_dollars": DESCENDING}},
+        ]
+        if limit is not None:
+            pipeline.append({"$limit": limit})
+
+        return list(self.usage_daily_collection.aggregate(pipeline))
+
+    @profiled
     def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
         self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
             dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
 
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None and dialog_id in unit_of_work.dialog_messages:
+            return list(unit_of_work.dialog_messages[dialog_id])
+
         dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        if dialog_dict is None:
+            dialog_dict = self._rehydrate_dialog(user_id, dialog_id)
         return dialog_dict["messages"]
 
+    @profiled
     def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
         self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
             dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
 
-        self.dialog_collection.update_one(
+        unit_of_work = current_unit_of_work.get()
+        if unit_of_work is not None:
+            # the dialog was read (and rehydrated if archived) by get_dialog_messages before
+            unit_of_work.add(
+                self.dialog_collection,
+                UpdateOne({"_id": dialog_id, "user_id": user_id}, {"$set": {"messages": dialog_messages}})
+            )
+            unit_of_work.dialog_messages[dialog_id] = list(dialog_messages)
+            return
+
+        result = self.dialog_collection.update_one(
             {"_id": dialog_id, "user_id": user_id},
             {"$set": {"messages": dialog_messages}}
         )
+        if result.matched_count == 0:
+            self._rehydrate_dialog(user_id, dialog_id)
+            self.dialog_collection.update_one(
+                {"_id": dialog_id, "user_id": user_id},
+                {"$set": {"messages": dialog_messages}}
+            )
+
+    @profiled
+    def get_group_chat_messages(self, chat_id: int):
+        group_chat_dict = self.group_chat_collection.find_one({"_id": chat_id})
+        return [] if group_chat_dict is None else group_chat_dict["messages"]
+
+    @profiled
+    def add_group_chat_message(self, chat_id: int, dialog_message: dict, max_messages: int):
+        # only the last max_messages are kept
+        self.group_chat_collection.update_one(
+            {"_id": chat_id},
+            {"$push": {"messages": {"$each": [dialog_message], "$slice": -max_messages}}},
+            upsert=True
+        )
+
+    @profiled
+    def clear_group_chat_messages(self, chat_id: int):
+        self.group_chat_collection.update_one({"_id": chat_id}, {"$set": {"messages": []}}, upsert=True)
+
+    @profiled
+    def archive_dialogs(self, older_than_days: float):
+        # compresses old dialogs that are not current for any user into the archived_dialog collection
+        cutoff = datetime.now() - timedelta(days=older_than_days)
+        current_dialog_ids = set(self.user_collection.distinct("current_dialog_id"))
+        report = {"n_archived_dialogs": 0, "n_bytes_before": 0, "n_bytes_after": 0}
+
+        def flush(archived_dialogs):
+            if not archived_dialogs:
+                return
+            try:
+                self.archived_dialog_collection.insert_many(archived_dialogs, ordered=False)
+            except BulkWriteError as e:
+                # archived by a run that stopped before deleting them from dialog, or rehydrated
+                # and continued since: the archived copies are replaced with the current dialogs
+                write_errors = e.details["writeErrors"]
+                if any(error["code"] != DUPLICATE_KEY_ERROR_CODE for error in write_errors):
+                    raise
+                self.archived_dialog_collection.bulk_write([
+                    ReplaceOne({"_id": archived_dialogs[error["index"]]["_id"]}, archived_dialogs[error["index"]])
+                    for error in write_errors
+                ], ordered=False)
+            self.dialog_collection.delete_many({"_id": {"$in": [dialog["_id"] for dialog in archived_dialogs]}})
+
+        archived_dialogs = []
+        cursor = self.dialog_collection.find({"start_time": {"$lt": cutoff}}, batch_size=ARCHIVE_BATCH_SIZE)
+        for dialog_dict in cursor:
+            if dialog_dict["_id"] in current_dialog_ids:
+                continue
+
+            messages = dialog_dict.pop("messages")
+            archived_dialog = {
+                **dialog_dict,
+                "archived_at": datetime.now(),
+                "n_messages": len(messages),
+                "messages_zlib": compress_messages(messages),
+            }
+            archived_dialogs.append(archived_dialog)
+
+            report["n_archived_dialogs"] += 1
+            report["n_bytes_before"] += len(bson.encode({**dialog_dict, "messages": messages}))
+            report["n_bytes_after"] += len(bson.encode(archived_dialog))
+
+            if len(archived_dialogs) >= ARCHIVE_BATCH_SIZE:
+                flush(archived_dialogs)
+                archived_dialogs = []
+        flush(archived_dialogs)
+
+        report["n_bytes_reclaimed"] = report["n_bytes_before"] - report["n_bytes_after"]
+        return report
+
+    def iter_dialogs(self, user_id: Optional[int] = None, start_time_from: Optional[datetime] = None, start_time_to: Optional[datetime] = None):
+        # current and archived dialogs one by one from cursors, archived ones decompressed but left in the archive
+        query = {}
+        if user_id is not None:
+            query["user_id"] = user_id
+        if start_time_from is not None or start_time_to is not None:
+            query["start_time"] = {}
+            if start_time_from is not None:
+                query["start_time"]["$gte"] = start_time_from
+            if start_time_to is not None:
+                query["start_time"]["$lt"] = start_time_to
+
+        yield from self.dialog_collection.find(query, batch_size=EXPORT_BATCH_SIZE)
+
+        for archived_dialog in self.archived_dialog_collection.find(query, batch_size=EXPORT_BATCH_SIZE):
+            yield unarchive_dialog(archived_dialog)
+
+    @profiled
+    def import_dialogs(self, dialogs, batch_size: int = IMPORT_BATCH_SIZE):
+        # inserts dialogs in batches, dialogs that already exist are skipped, so an import can be repeated;
+        # the export has archived dialogs unarchived, they must not come back next to their archived copy
+        report = {"n_imported_dialogs": 0, "n_skipped_dialogs": 0}
+
+        def flush(batch):
+            if not batch:
+                return
+            archived_dialog_ids = {
+                archived_dialog["_id"] for archived_dialog in self.archived_dialog_collection.find(
+                    {"_id": {"$in": [dialog_dict["_id"] for dialog_dict in batch]}}, {"_id": 1}
+                )
+            }
+            if archived_dialog_ids:
+                report["n_skipped_dialogs"] += len(archived_dialog_ids)
+                batch = [dialog_dict for dialog_dict in batch if dialog_dict["_id"] not in archived_dialog_ids]
+                if not batch:
+                    return
+            try:
+                report["n_imported_dialogs"] += len(self.dialog_collection.insert_many(batch, ordered=False).inserted_ids)
+            except BulkWriteError as e:
+                write_errors = e.details["writeErrors"]
+                if any(error["code"] != DUPLICATE_KEY_ERROR_CODE for error in write_errors):
+                    raise
+                report["n_imported_dialogs"] += e.details["nInserted"]
+                report["n_skipped_dialogs"] += len(write_errors)
+
+        batch = []
+        for dialog_dict in dialogs:
+            batch.append(dialog_dict)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        flush(batch)
+
+        return report
+
+    def _rehydrate_dialog(self, user_id: int, dialog_id: str):
+        archived_dialog = self.archived_dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        if archived_dialog is None:
+            raise ValueError(f"Dialog {dialog_id} of user {user_id} does not exist")
+
+        dialog_dict = unarchive_dialog(archived_dialog)
+
+        self.dialog_collection.insert_one(dialog_dict)
+        self.archived_dialog_collection.delete_one({"_id": dialog_id})
+        return dialog_dict
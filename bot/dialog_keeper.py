@@ -1,10 +1,11 @@
 import config
+import openai_utils
+import retrieval
 import datetime
 from enum import Enum
 from pathlib import Path
 import re
 
-import tiktoken
 import yaml
 
 
@@ -18,6 +19,7 @@ REQUEST_SUMMARY_MESSAGE_FORMAT = \
     "Then summarize as follows:\n{summary_format}.\n" \
     "You must end with 'That's it. Is that right? Let't continue!'."
 DEFAULT_SUMMARY_FORMAT = "Use bullet points."
+RECALLED_MESSAGES_HEADER = "Earlier messages of this conversation that may be relevant:"
 
 TOKEN_LIMIT = {
     "text-davinci-003": 4097,
@@ -25,6 +27,7 @@ TOKEN_LIMIT = {
     "gpt-3.5-turbo": 4096,
     "gpt-4": 8192
 }
+DEFAULT_TOKEN_LIMIT = 4096  # context size assumed for the models not listed above
 
 
 class UserKeywords(Enum):
@@ -34,6 +37,12 @@ class UserKeywords(Enum):
     ADD_TO_IMPORTANT_MESSAGES = "_IM"
 
 
+# alternations of literals, the regex engine only tries the positions of their first characters, so one scan is linear
+KEYWORD_PATTERN = re.compile("(?:" + "|".join(re.escape(keyword.value) for keyword in UserKeywords) + r")(?!\w)")
+CUSTOM_SETTINGS_SECTIONS = ("PROMPT:", "PREV:", "SUMMARY_FORMAT:")
+CUSTOM_SETTINGS_SECTION_PATTERN = re.compile("|".join(re.escape(section) for section in CUSTOM_SETTINGS_SECTIONS))
+
+
 class DialogKeeper:
     def __init__(self, user_id):
         self._is_new_dialog_set = False
@@ -44,7 +53,6 @@ class DialogKeeper:
         # Metadata
         self._user_id = user_id
         self._model = None
-        self._encoding = None
         self._chat_mode = None
 
         self._temperature = 0.7
@@ -68,6 +76,15 @@ class DialogKeeper:
         # Long dialog
         self._long_dialog_token_limit = None
         self._long_dialog_update_summary_n_tokens = None
+        retrieval_config = config.long_dialog_config.retrieval
+        self._memory = None
+        if config.long_dialog_config.enable and retrieval_config.enable:
+            self._memory = retrieval.DialogMemory(
+                retrieval.default_embedder,
+                max_n_turns=retrieval_config.max_indexed_turns,
+                embedding_batch_size=retrieval_config.embedding_batch_size
+            )
+        self._recalled_turns = []  # (score, turn index in memory) for the current message
 
         # Save metadata to file
         # TODO: Add Redis option.
@@ -83,6 +100,11 @@ class DialogKeeper:
         self._last_complete_data_save_datetime = None
         self._unsaved_dialog = []
 
+    @property
+    def _encoding(self):
+        # loaded when first needed, not when a keeper is created for every user after a restart
+        return openai_utils.get_encoding(self._model)
+
     @property
     def is_new_dialog_set(self):
         return self._is_new_dialog_set
@@ -92,7 +114,7 @@ class DialogKeeper:
         self._system_message_n_tokens += len(self._encoding.encode(message))
         if (
             self._system_message_n_tokens + self._important_messages_n_tokens
-            > config.long_dialog_config.system_and_important_max_tokens * TOKEN_LIMIT[self._model]
+            > config.long_dialog_config.system_and_important_max_tokens * TOKEN_LIMIT.get(self._model, DEFAULT_TOKEN_LIMIT)
         ):
             # TODO: Tell user, summarize or remove the oldest ones.
             raise NotImplementedError("Handling too many system messages is not implemented yet. "
@@ -103,7 +125,7 @@ class DialogKeeper:
         self._important_messages_n_tokens += len(self._encoding.encode(message))
         if (
             self._system_message_n_tokens + self._important_messages_n_tokens
-            > config.long_dialog_config.system_and_important_max_tokens * TOKEN_LIMIT[self._model]
+            > config.long_dialog_config.system_and_important_max_tokens * TOKEN_LIMIT.get(self._model, DEFAULT_TOKEN_LIMIT)
         ):
             # TODO: Tell user, summarize or remove the oldest ones.
             raise NotImplementedError("Handling too many important messages is not implemented yet. "
@@ -154,10 +176,10 @@ class DialogKeeper:
                 self._add_important_message(message)
             self._set_request_summary_message(yaml_data["request_summary_message"])
 
-    def _save_to_file(self):
+    def _save_to_file(self, force=False):
         now_time = datetime.datetime.now()
-        if (
-            self._last_metadata_save_datetime is None or
+        if self._metadata_file_path is not None and (
+            force or self._last_metadata_save_datetime is None or
             (now_time - self._last_metadata_save_datetime).total_seconds() > config.long_dialog_config.save_timeout_min * 60
         ):
             with open(self._metadata_file_path, 'w') as yaml_file:
@@ -177,7 +199,7 @@ class DialogKeeper:
             self._last_metadata_save_datetime = now_time
 
         if (
-            self._unsaved_dialog and(self._last_complete_data_save_datetime is None or
+            self._complete_data_file_path is not None and self._unsaved_dialog and (force or self._last_complete_data_save_datetime is None or
             (now_time - self._last_complete_data_save_datetime).total_seconds() > config.long_dialog_config.save_all_timeout_min * 60)
         ):
             dialog = []
@@ -192,6 +214,15 @@ class DialogKeeper:
             self._unsaved_dialog = []
             self._last_complete_data_save_datetime = now_time
 
+    def flush(self):
+        # saves metadata and unsaved dialog ignoring save timeouts, returns the number of saved dialog messages
+        if self._last_metadata_save_datetime is None and not self._unsaved_dialog:
+            return 0  # nothing was ever saved or collected, e.g. long dialog is off
+
+        n_unsaved_messages = len(self._unsaved_dialog)
+        self._save_to_file(force=True)
+        return n_unsaved_messages
+
     def _update_date(self):
         today = datetime.datetime.now().strftime('%Y-%m-%d')
         if today == self._last_date:
@@ -203,10 +234,9 @@ class DialogKeeper:
 
     def _set_model(self, model):
         self._model = model
-        self._encoding = tiktoken.encoding_for_model(model)
 
         # Long dialog
-        self._long_dialog_token_limit = TOKEN_LIMIT[self._model] - self._max_tokens
+        self._long_dialog_token_limit = TOKEN_LIMIT.get(self._model, DEFAULT_TOKEN_LIMIT) - self._max_tokens
         self._long_dialog_update_summary_n_tokens = self._long_dialog_token_limit * config.long_dialog_config.update_summary_when_tokens_reach
 
         # Recount tokens
@@ -259,6 +289,57 @@ class DialogKeeper:
         self._request_summary_message_n_tokens = 0
         self._n_tokens_since_summary_request = 0
 
+        if self._memory is not None:
+            self._memory.clear()
+        self._recalled_turns = []
+
+    def _collect_recalled_message(self, dialog_messages, n_recent_dialog_messages):
+        # a system message with the most relevant turns older than the trimmed dialog, None if there are none
+        retrieval_config = config.long_dialog_config.retrieval
+        turn_index_offset = self._memory.n_turns - len(dialog_messages)  # first turns may be dropped on retry
+        n_old_dialog_messages = len(dialog_messages) - n_recent_dialog_messages
+
+        recalled_dialog_indices, n_tokens = [], 0
+        for _, turn_index in self._recalled_turns:
+            dm_i = turn_index - turn_index_offset
+            if not 0 <= dm_i < n_old_dialog_messages:
+                continue
+            dialog_message = dialog_messages[dm_i]
+            dialog_message_n_tokens = len(self._encoding.encode(dialog_message["user"])) + len(self._encoding.encode(dialog_message["bot"]))
+            if n_tokens + dialog_message_n_tokens > retrieval_config.max_tokens:
+                continue
+            recalled_dialog_indices.append(dm_i)
+            n_tokens += dialog_message_n_tokens
+            if len(recalled_dialog_indices) == retrieval_config.top_k:
+                break
+
+        if not recalled_dialog_indices:
+            return None
+        content = RECALLED_MESSAGES_HEADER
+        for dm_i in sorted(recalled_dialog_indices):  # in dialog order
+            content += f"\n\nUser: {dialog_messages[dm_i]['user']}\nAssistant: {dialog_messages[dm_i]['bot']}"
+        return {"role": "system", "content": content}
+
+    def _count_recent_dialog_messages(self, dialog_messages, n_tokens):
+        # number of last dialog messages that fit into the long dialog token limit with n_tokens used by the rest
+        n_recent_dialog_messages = 0
+        for dm_i in range(len(dialog_messages) - 1, 0, -1):
+            n_tokens += dialog_messages[dm_i]["n_tokens"]
+            if n_tokens >= self._long_dialog_token_limit:
+                break
+            n_recent_dialog_messages += 1
+        return n_recent_dialog_messages
+
+    async def recall(self, message, dialog_messages):
+        # finds past turns relevant to the message for _collect_long_dialog,
+        # called before generate_api_options because embedders may call an API
+        self._recalled_turns = []
+        if self._memory is None or not self._is_new_dialog_set:
+            return
+
+        await self._memory.update(dialog_messages)
+        self._recalled_turns = await self._memory.search(message, config.long_dialog_config.retrieval.min_score)
+
     def _collect_long_dialog(self, message, dialog_messages):
         # Uses summarization method
         # Returns messages for API and a value: True when user message is used, False when user message is replaced
@@ -270,25 +351,28 @@ class DialogKeeper:
             self._n_tokens_since_summary_request = 0
             is_user_message_used = False  # TODO: Add the current summary to system message
 
-        # trimmed dialog
-        message_n_tokens = len(self._encoding.encode(message))
+        # trimmed dialog; recalled turns older than the dialog that fits without them are added,
+        # and the dialog is trimmed again to leave room for them
         n_tokens = self._system_message_n_tokens + self._important_messages_n_tokens
-        messages = []
-        for dm_i in range(len(dialog_messages) - 1, 0, -1):
-            dialog_message = dialog_messages[dm_i]
-            if (
-                is_user_message_used
-                and (n_tokens + dialog_message["n_tokens"] + message_n_tokens >= self._long_dialog_token_limit)
-                or not is_user_message_used
-                and (n_tokens + dialog_message["n_tokens"] + self._request_summary_message_n_tokens >= self._long_dialog_token_limit)
-            ):
-                break
+        if is_user_message_used:
+            n_tokens += len(self._encoding.encode(message))
+        else:
+            n_tokens += self._request_summary_message_n_tokens
+        n_recent_dialog_messages = self._count_recent_dialog_messages(dialog_messages, n_tokens)
+        recalled_message = None
+        if self._recalled_turns:
+            recalled_message = self._collect_recalled_message(dialog_messages, n_recent_dialog_messages)
+            if recalled_message is not None:
+                n_tokens += len(self._encoding.encode(recalled_message["content"]))
+                n_recent_dialog_messages = self._count_recent_dialog_messages(dialog_messages, n_tokens)
 
+        messages = []
+        for dm_i in range(len(dialog_messages) - 1, len(dialog_messages) - 1 - n_recent_dialog_messages, -1):
             # reversed order
-            messages.append({"role": "assistant", "content": dialog_message["bot"]})
-            messages.append({"role": "user", "content": dialog_message["user"]})
-            n_tokens += dialog_message["n_tokens"]
-
+            messages.append({"role": "assistant", "content": dialog_messages[dm_i]["bot"]})
+            messages.append({"role": "user", "content": dialog_messages[dm_i]["user"]})
+        if recalled_message is not None:
+            messages.append(recalled_message)
         messages.extend(self._important_messages)
         messages.extend(self._system_messages)
         messages.reverse()
@@ -333,18 +417,18 @@ class DialogKeeper:
 
     def generate_api_options(self, message, dialog_messages):
         self._update_date()
-        keywords, message = parse_keywords(message) if self._enable_keywords else None
+        message, keywords = parse_keywords(message) if self._enable_keywords else (message, set())
         if not message:  # TODO: Handle empty messages.
             message = 'Sending an empty message...'
-        if keywords is not None and UserKeywords.ADD_TO_SYSTEM_MESSAGES in keywords and UserKeywords.ADD_TO_IMPORTANT_MESSAGES in keywords:
+        if UserKeywords.ADD_TO_SYSTEM_MESSAGES in keywords and UserKeywords.ADD_TO_IMPORTANT_MESSAGES in keywords:
             raise ValueError("Cannot add to both system and important messages.")
-        if keywords is not None and UserKeywords.UPDATE_FROM_FILE in keywords:
+        if UserKeywords.UPDATE_FROM_FILE in keywords:
             self._update_from_file()
         if self._complete_data_file_path is not None and dialog_messages:
             self._unsaved_dialog.append(dialog_messages[-1])
 
         messages, is_user_message_used = self._collect_dialog(message, dialog_messages)
-        if is_user_message_used and keywords is not None:
+        if is_user_message_used:
             if UserKeywords.ADD_TO_SYSTEM_MESSAGES in keywords:
                 self._add_system_message(message)
             elif UserKeywords.ADD_TO_IMPORTANT_MESSAGES in keywords:
@@ -357,23 +441,30 @@ class DialogKeeper:
 
 
 def parse_keywords(message):
+    # returns the message without its keywords and the keywords, found in one pass;
+    # a keyword is a separate word, e.g. _IM in "_IMPORTANT" or "my_IM" is text
     keywords = set()
-    for keyword in UserKeywords:
-        if re.search(re.escape(keyword.value), message):
-            keywords.add(keyword)
-            message.replace(keyword.value, '')
-    return message, keywords
 
+    def remove_keyword(match):
+        start = match.start()
+        if start > 0 and (message[start - 1].isalnum() or message[start - 1] == "_"):
+            return match.group()
+        keywords.add(UserKeywords(match.group()))
+        return ""
 
-def parse_custom_settings(message):
-    prompt_pattern = r'PROMPT:\s*([\s\S]*?)(?:PREV:|SUMMARY_FORMAT:|$)'
-    prev_pattern = r'PREV:\s*([\s\S]*?)(?:SUMMARY_FORMAT:|$)'
-    summary_format_pattern = r'SUMMARY_FORMAT:\s*([\s\S]*)$'
+    message = KEYWORD_PATTERN.sub(remove_keyword, message)
+    return (message.strip() if keywords else message), keywords
 
-    prompt_match = re.search(prompt_pattern, message)
-    prev_match = re.search(prev_pattern, message)
-    summary_format_match = re.search(summary_format_pattern, message)
 
-    return (prompt_match.group(1).strip() if prompt_match else None,
-            prev_match.group(1).strip() if prev_match else None,
-            summary_format_match.group(1).strip() if summary_format_match else None)
+def parse_custom_settings(message):
+    # returns prompt, prev and summary format, None if missing; sections may come in any order,
+    # each runs until the next one and only the first of repeated sections is used
+    sections = {}
+    matches = list(CUSTOM_SETTINGS_SECTION_PATTERN.finditer(message))
+    for i, match in enumerate(matches):
+        if match.group() in sections:
+            continue
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(message)
+        sections[match.group()] = message[match.end():end].strip()
+
+    return tuple(sections.get(section) for section in CUSTOM_SETTINGS_SECTIONS)
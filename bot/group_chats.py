@@ -0,0 +1,57 @@
+import asyncio
+import collections
+import time
+
+from telegram import User
+
+
+BATCH_REQUEST_FORMAT = \
+    "Several members of the group chat wrote to you. Answer each of them in one message, " \
+    "addressing them by name:\n\n{messages}"
+
+
+class ChatRateLimiter:
+    # at most max_completions in any period_sec for every chat
+    def __init__(self, max_completions: int, period_sec: float = 60.0):
+        self.max_completions = max_completions
+        self.period_sec = period_sec
+        self._start_times = {}  # chat_id -> monotonic times of the completions in the last period
+
+    def get_wait_sec(self, chat_id: int) -> float:
+        start_times = self._start_times.setdefault(chat_id, collections.deque())
+        now = time.monotonic()
+        while start_times and now - start_times[0] >= self.period_sec:
+            start_times.popleft()
+
+        if len(start_times) < self.max_completions:
+            return 0.0
+        return start_times[0] + self.period_sec - now
+
+    async def acquire(self, chat_id: int):
+        while True:
+            wait_sec = self.get_wait_sec(chat_id)
+            if wait_sec <= 0:
+                break
+            await asyncio.sleep(wait_sec)
+        self._start_times[chat_id].append(time.monotonic())
+
+
+def get_author_name(user: User) -> str:
+    return user.first_name or user.username or str(user.id)
+
+
+def format_batch(batch) -> str:
+    # the messages of a batch, one per line with the name of the author
+    return "\n".join(f"{get_author_name(update.message.from_user)}: {message}" for update, message in batch)
+
+
+def format_batch_request(batch) -> str:
+    if len(batch) == 1:
+        return format_batch(batch)
+    return BATCH_REQUEST_FORMAT.format(messages=format_batch(batch))
+
+
+def split_evenly(n: int, n_parts: int) -> list:
+    # integer shares that sum up to n
+    share, remainder = divmod(n, n_parts)
+    return [share + 1 if i < remainder else share for i in range(n_parts)]
@@ -0,0 +1,111 @@
+import asyncio
+import random
+import zlib
+from typing import NamedTuple, Optional, Tuple
+
+import aiohttp
+import openai
+
+import config
+
+
+REQUEST_TIMEOUT_SEC = 60.0
+MOCK_WORDS = (
+    "the bot answers every question with a short deterministic text so that "
+    "load tests and benchmarks can run without any network access at all"
+).split()
+
+
+class CompletionChunk(NamedTuple):
+    text: str
+    usage: Optional[Tuple[int, int]] = None  # input and output tokens, if the backend reports them
+
+
+class LLMProvider:
+    # a completion backend. complete() yields the answer as text chunks, one chunk with the whole answer
+    # if stream is False; messages are used for chat models and prompt for completion models
+    async def complete(self, model, messages=None, prompt=None, stream=True, **options):
+        raise NotImplementedError
+        yield
+
+
+class OpenAIProvider(LLMProvider):
+    # OpenAI or any server with an OpenAI-compatible API at api_base
+    def __init__(self, api_key: str, api_base: Optional[str] = None, request_timeout_sec: float = REQUEST_TIMEOUT_SEC):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.request_timeout_sec = request_timeout_sec
+
+    async def _acreate(self, api_resource, session, **kwargs):
+        # the request runs in our session, closing it drops the connection even while the answer is streamed
+        token = openai.aiosession.set(session)
+        try:
+            return await api_resource.acreate(
+                api_key=self.api_key, api_base=self.api_base, request_timeout=self.request_timeout_sec, **kwargs
+            )
+        finally:
+            openai.aiosession.reset(token)
+
+    async def complete(self, model, messages=None, prompt=None, stream=True, **options):
+        # leaving this generator, also by /cancel or aclose(), closes the connection, so generation stops
+        async with aiohttp.ClientSession() as session:
+            if messages is not None:
+                r = await self._acreate(openai.ChatCompletion, session, model=model, messages=messages, stream=stream, **options)
+                if not stream:
+                    yield CompletionChunk(r.choices[0].message["content"], (r.usage.prompt_tokens, r.usage.completion_tokens))
+                    return
+
+                async for r_item in r:
+                    delta = r_item.choices[0].delta
+                    if "content" in delta:
+                        yield CompletionChunk(delta.content)
+            else:
+                r = await self._acreate(openai.Completion, session, engine=model, prompt=prompt, stream=stream, **options)
+                if not stream:
+                    yield CompletionChunk(r.choices[0].text, (r.usage.prompt_tokens, r.usage.completion_tokens))
+                    return
+
+                async for r_item in r:
+                    yield CompletionChunk(r_item.choices[0].text)
+
+
+class MockProvider(LLMProvider):
+    # answers without network, the same request always gets the same answer;
+    # for development without an API key and for offline benchmarks of the whole pipeline
+    def __init__(self, first_token_latency_sec: float = 0.5, tokens_per_sec: float = 50.0, n_answer_tokens: int = 200):
+        self.first_token_latency_sec = first_token_latency_sec
+        self.tokens_per_sec = tokens_per_sec
+        self.n_answer_tokens = n_answer_tokens
+
+    def generate_answer_words(self, model, messages=None, prompt=None, max_tokens=None):
+        request_text = messages[-1]["content"] if messages is not None else prompt
+        rng = random.Random(zlib.crc32(f"{model}\n{request_text}".encode()))
+
+        n_words = self.n_answer_tokens if max_tokens is None else min(self.n_answer_tokens, max_tokens)
+        return [rng.choice(MOCK_WORDS) for _ in range(n_words)]
+
+    async def complete(self, model, messages=None, prompt=None, stream=True, **options):
+        words = self.generate_answer_words(model, messages=messages, prompt=prompt, max_tokens=options.get("max_tokens"))
+
+        await asyncio.sleep(self.first_token_latency_sec)
+        if not stream:
+            await asyncio.sleep(len(words) / self.tokens_per_sec)
+            yield CompletionChunk(" ".join(words))
+            return
+
+        for i, word in enumerate(words):
+            if i > 0:
+                await asyncio.sleep(1 / self.tokens_per_sec)
+            yield CompletionChunk(word if i == 0 else " " + word)
+
+
+def create_provider(provider_config: config.LLMProviderConfiguration) -> LLMProvider:
+    if provider_config.type == "openai":
+        return OpenAIProvider(config.openai_api_key, api_base=config.openai_api_base)
+    elif provider_config.type == "mock":
+        return MockProvider(**provider_config.mock_options)
+    else:
+        raise ValueError(f"Unknown LLM provider: {provider_config.type}")
+
+
+default_provider = create_provider(config.llm_provider_config)
@@ -0,0 +1,133 @@
+import argparse
+import gzip
+import logging
+from datetime import datetime, timedelta
+
+from bson import json_util
+
+import config
+import database
+
+
+# dates and other BSON types survive the round trip as {"$date": ...} and alike
+JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS
+
+
+def archive_dialogs_command(args):
+    db = database.Database()
+    report = db.archive_dialogs(args.older_than_days)
+    print(format_archival_report(report))
+
+
+def migrate_users_command(args):
+    db = database.Database()
+    n_migrated_users = db.migrate_users()
+    print(f"Migrated {n_migrated_users} users to schema version {database.USER_SCHEMA_VERSION}")
+
+
+def export_dialogs_command(args):
+    db = database.Database()
+    n_dialogs = 0
+    with gzip.open(args.output, "wt", encoding="utf-8") as f:
+        for dialog_dict in db.iter_dialogs(user_id=args.user_id, start_time_from=args.start_time_from, start_time_to=args.start_time_to):
+            f.write(json_util.dumps(dialog_dict, json_options=JSON_OPTIONS, ensure_ascii=False) + "\n")
+            n_dialogs += 1
+    print(f"Exported {n_dialogs} dialogs to {args.output}")
+
+
+def import_dialogs_command(args):
+    db = database.Database()
+    with gzip.open(args.input, "rt", encoding="utf-8") as f:
+        dialogs = (json_util.loads(line, json_options=JSON_OPTIONS) for line in f if line.strip())
+        report = db.import_dialogs(dialogs, batch_size=args.batch_size)
+    print(f"Imported {report['n_imported_dialogs']} dialogs, skipped {report['n_skipped_dialogs']} existing ones")
+
+
+def aggregate_usage_command(args):
+    db = database.Database()
+    n_summaries = db.aggregate_usage(datetime.now() - timedelta(days=args.days))
+    print(f"Updated {n_summaries} daily usage summaries")
+
+
+def usage_report_command(args):
+    db = database.Database()
+    day_from = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=args.days - 1)
+    totals = db.get_usage_summaries(day_from, group_by="model")
+    top_spenders = db.get_usage_summaries(day_from, group_by="user_id", limit=args.top)
+
+    user_ids = [summary["_id"] for summary in top_spenders]
+    usernames = {
+        user_dict["_id"]: user_dict.get("username")
+        for user_dict in db.user_collection.find({"_id": {"$in": user_ids}}, {"username": 1})
+    }
+    print(format_usage_report(args.days, totals, top_spenders, usernames))
+
+
+def format_usage_report(n_days, totals, top_spenders, usernames):
+    lines = [f"Usage over the last {n_days} days (from daily summaries)", ""]
+    lines.append(f"Total: {sum(summary['n_spent_dollars'] for summary in totals):.3f}$")
+    for summary in totals:
+        lines.append(
+            f"  {summary['_id']}: {summary['n_spent_dollars']:.3f}$, "
+            f"{summary['n_input_tokens']} input / {summary['n_output_tokens']} output tokens, "
+            f"{summary['n_images']} images, {summary['n_transcribed_seconds'] / 60:.1f} min"
+        )
+
+    lines += ["", "Top spenders:"]
+    for i, summary in enumerate(top_spenders, 1):
+        username = usernames.get(summary["_id"]) or "-"
+        lines.append(f"  {i}. {summary['_id']} (@{username}): {summary['n_spent_dollars']:.3f}$")
+    return "\n".join(lines)
+
+
+def parse_date(value):
+    return datetime.fromisoformat(value)
+
+
+def format_archival_report(report):
+    return (
+        f"Archived {report['n_archived_dialogs']} dialogs: "
+        f"{report['n_bytes_before']} -> {report['n_bytes_after']} bytes, "
+        f"{report['n_bytes_reclaimed']} bytes reclaimed"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the bot database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    archive_parser = subparsers.add_parser("archive_dialogs", help="Compress old dialogs into the archive")
+    archive_parser.add_argument("--older-than-days", type=float, default=config.dialog_archival_config.older_than_days)
+    archive_parser.set_defaults(func=archive_dialogs_command)
+
+    migrate_parser = subparsers.add_parser("migrate_users", help="Upgrade all user documents to the current schema version")
+    migrate_parser.set_defaults(func=migrate_users_command)
+
+    export_parser = subparsers.add_parser("export_dialogs", help="Write dialogs, archived ones too, to a gzipped JSON Lines file")
+    export_parser.add_argument("--output", required=True, help="e.g. dialogs.jsonl.gz")
+    export_parser.add_argument("--user-id", type=int, help="only dialogs of this user")
+    export_parser.add_argument("--from", dest="start_time_from", type=parse_date, help="only dialogs started at or after this date, e.g. 2023-07-01")
+    export_parser.add_argument("--to", dest="start_time_to", type=parse_date, help="only dialogs started before this date")
+    export_parser.set_defaults(func=export_dialogs_command)
+
+    import_parser = subparsers.add_parser("import_dialogs", help="Insert dialogs from a file written by export_dialogs")
+    import_parser.add_argument("--input", required=True)
+    import_parser.add_argument("--batch-size", type=int, default=database.IMPORT_BATCH_SIZE)
+    import_parser.set_defaults(func=import_dialogs_command)
+
+    aggregate_usage_parser = subparsers.add_parser("aggregate_usage", help="Recompute daily usage summaries from the usage log")
+    aggregate_usage_parser.add_argument("--days", type=float, default=1, help="recompute the days of this many last days")
+    aggregate_usage_parser.set_defaults(func=aggregate_usage_command)
+
+    usage_report_parser = subparsers.add_parser("usage_report", help="Show spend by model and top spenders")
+    usage_report_parser.add_argument("--days", type=int, default=30, help="this many last days, today included")
+    usage_report_parser.add_argument("--top", type=int, default=10)
+    usage_report_parser.set_defaults(func=usage_report_command)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
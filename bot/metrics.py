@@ -0,0 +1,112 @@
+import functools
+import time
+
+import prometheus_client
+from prometheus_client import Counter, Gauge, Histogram
+from telegram.error import RetryAfter
+from telegram.ext import AIORateLimiter
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_latency_seconds", "Time spent in a Telegram update handler",
+    ["handler"], buckets=LATENCY_BUCKETS
+)
+COMPLETION_TIME_TO_FIRST_TOKEN = Histogram(
+    "openai_completion_time_to_first_token_seconds", "Time from a completion request to its first token",
+    ["model"], buckets=LATENCY_BUCKETS
+)
+COMPLETION_TIME = Histogram(
+    "openai_completion_seconds", "Total completion time",
+    ["model"], buckets=LATENCY_BUCKETS
+)
+IN_FLIGHT_COMPLETIONS = Gauge(
+    "openai_in_flight_completions", "Running completion requests",
+    ["model"]
+)
+MODEL_FALLBACKS = Counter(
+    "openai_model_fallbacks_total", "Completions given up before the first token and retried with another model",
+    ["model"]
+)
+HEDGED_COMPLETIONS = Counter(
+    "openai_hedged_completions_total", "Completions sent a second time because the first token was late",
+    ["model"]
+)
+HEDGED_COMPLETION_WINS = Counter(
+    "openai_hedged_completion_wins_total", "Hedged completions answered by the second request",
+    ["model"]
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "bot_time_to_first_token_seconds", "Time from receiving a message to the first token of its answer",
+    buckets=LATENCY_BUCKETS
+)
+MONGO_CALL_LATENCY = Histogram(
+    "mongo_call_latency_seconds", "Time spent in a Database method",
+    ["method"], buckets=LATENCY_BUCKETS
+)
+TELEGRAM_REQUESTS = Counter(
+    "telegram_requests_total", "Telegram Bot API requests, including message edits",
+    ["endpoint"]
+)
+TELEGRAM_RATE_LIMITED = Counter(
+    "telegram_rate_limited_total", "Telegram Bot API requests rejected with 429 Too Many Requests",
+    ["endpoint"]
+)
+BUSY_REJECTIONS = Counter(
+    "bot_busy_rejections_total", "Messages rejected because the previous one was not answered yet"
+)
+QUEUED_MESSAGES = Counter(
+    "bot_queued_messages_total", "Messages queued until the previous one is answered"
+)
+COALESCED_MESSAGES = Counter(
+    "bot_coalesced_messages_total", "Messages answered together with another message, without a completion of their own"
+)
+STARTUP_PHASE_SECONDS = Gauge(
+    "bot_startup_phase_seconds", "Duration of a phase of the last startup",
+    ["phase"]
+)
+LOCKED_USER_SEMAPHORES = Gauge(
+    "bot_locked_user_semaphores", "Users whose previous message is still being answered"
+)
+IN_FLIGHT_USER_TASKS = Gauge(
+    "bot_in_flight_user_tasks", "Running message generation tasks"
+)
+
+
+def track_user_state(user_semaphores, user_tasks):
+    LOCKED_USER_SEMAPHORES.set_function(lambda: sum(semaphore.locked() for semaphore in list(user_semaphores.values())))
+    IN_FLIGHT_USER_TASKS.set_function(lambda: len(user_tasks))
+
+
+def observe_mongo_call(method_name, elapsed_seconds):
+    MONGO_CALL_LATENCY.labels(method_name).observe(elapsed_seconds)
+
+
+def observe_handler(handler):
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            HANDLER_LATENCY.labels(handler.__name__).observe(time.perf_counter() - start_time)
+
+    return wrapper
+
+
+class InstrumentedRateLimiter(AIORateLimiter):
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        async def instrumented_callback(*callback_args, **callback_kwargs):
+            TELEGRAM_REQUESTS.labels(endpoint).inc()
+            try:
+                return await callback(*callback_args, **callback_kwargs)
+            except RetryAfter:
+                TELEGRAM_RATE_LIMITED.labels(endpoint).inc()
+                raise
+
+        return await super().process_request(instrumented_callback, args, kwargs, endpoint, data, rate_limit_args)
+
+
+def start_server(host, port):
+    prometheus_client.start_http_server(port, addr=host)
@@ -1,4 +1,12 @@
 import config
+import metrics
+import tracing
+import llm_providers
+
+import asyncio
+import collections
+import functools
+import time
 
 import tiktoken
 import openai
@@ -10,7 +18,6 @@ if config.openai_api_base is not None:
     openai.api_base = config.openai_api_base
 
 
-OPENAI_COMPLETION_REQUEST_TIMEOUT = 60.0
 OPENAI_COMPLETION_DEFAULT_OPTIONS = {
     "temperature": 0.7,
     "max_tokens": 1000,
@@ -18,116 +25,240 @@ OPENAI_COMPLETION_DEFAULT_OPTIONS = {
     "frequency_penalty": 0,
     "presence_penalty": 0,
 }
+DEFAULT_ENCODING = "cl100k_base"  # for models unknown to tiktoken, e.g. self-hosted ones
+DEFAULT_MODEL_TYPE = "chat_completion"
 
 
-class ChatGPT:
-    def __init__(self, model="gpt-3.5-turbo-16k"):
-        assert model in {"text-davinci-003", "gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4"}, f"Unknown model: {model}"
-        self.model = model
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    # loading an encoding reads (or downloads) its whole vocabulary, so it is done once per model
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
 
-    async def send_message(self, message, dialog_messages=[], chat_mode="assistant", dialog_keeper=None):
-        if chat_mode not in config.chat_modes.keys():
-            raise ValueError(f"Chat mode {chat_mode} is not supported")
-        if chat_mode == "custom" and dialog_keeper is None:
-            raise ValueError(f"User state must be provided for {chat_mode} mode.")
 
-        n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4"}:
-                    messages, other_options = self._generate_api_options(message, dialog_messages, chat_mode, dialog_keeper)
-                    r = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        request_timeout=OPENAI_COMPLETION_REQUEST_TIMEOUT,
-                        **(OPENAI_COMPLETION_DEFAULT_OPTIONS if other_options is None else other_options)
-                    )
-                    answer = r.choices[0].message["content"]
-                elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r = await openai.Completion.acreate(
-                        engine=self.model,
-                        prompt=prompt,
-                        request_timeout=OPENAI_COMPLETION_REQUEST_TIMEOUT,
-                        **OPENAI_COMPLETION_DEFAULT_OPTIONS
-                    )
-                    answer = r.choices[0].text
-                else:
-                    raise ValueError(f"Unknown model: {self.model}")
+def load_encodings(models):
+    for model in models:
+        get_encoding(model)
 
-                answer = self._postprocess_answer(answer)
-                n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+class FirstTokenLatencies:
+    # recent times to first token of every model, for the hedging delay
+    def __init__(self, max_samples=200, min_samples=20):
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self._samples = {}
 
-        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+    def add(self, model, time_to_first_token_sec):
+        if model not in self._samples:
+            self._samples[model] = collections.deque(maxlen=self.max_samples)
+        self._samples[model].append(time_to_first_token_sec)
 
-        return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+    def get_percentile(self, model, percentile):
+        samples = self._samples.get(model)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        samples = sorted(samples)
+        return samples[min(int(len(samples) * percentile / 100), len(samples) - 1)]
 
-    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant", dialog_keeper=None):
-        if chat_mode not in config.chat_modes.keys():
+
+first_token_latencies = FirstTokenLatencies()
+
+
+def get_hedging_delay_sec(model):
+    delay_sec = first_token_latencies.get_percentile(model, config.hedging_config.delay_percentile)
+    if delay_sec is None:
+        delay_sec = config.hedging_config.default_delay_sec
+    return max(delay_sec, config.hedging_config.min_delay_sec)
+
+
+class ChatGPT:
+    def __init__(self, model="gpt-3.5-turbo-16k", provider=None):
+        self.model = model
+        self.provider = llm_providers.default_provider if provider is None else provider
+        self.n_used_tokens = (0, 0)  # input and output tokens of the last request so far, also after cancellation
+        self._n_hedge_input_tokens = 0  # input of the duplicate requests of hedging
+        self._n_hedge_output_tokens = 0  # output streamed by the requests that lost the race
+        self._is_hedged = False  # the hedged completion records the first token latencies of its requests itself
+
+    def _generate_request(self, message, dialog_messages, chat_mode, dialog_keeper):
+        # returns messages for chat models or prompt for completion models, and the completion options
+        model_info = config.snapshot.models.get(self.model)
+        model_type = DEFAULT_MODEL_TYPE if model_info is None else model_info.type
+        if model_type == "chat_completion":
+            with tracing.span("generate_api_options", chat_mode=chat_mode):
+                messages, other_options = self._generate_api_options(message, dialog_messages, chat_mode, dialog_keeper)
+            return messages, None, (OPENAI_COMPLETION_DEFAULT_OPTIONS if other_options is None else other_options)
+        elif model_type == "completion":
+            prompt = self._generate_prompt(message, dialog_messages, chat_mode)
+            return None, prompt, OPENAI_COMPLETION_DEFAULT_OPTIONS
+        else:
+            raise ValueError(f"Model {self.model} of type {model_type} can't complete text")
+
+    def _count_tokens(self, messages, prompt, answer):
+        if messages is not None:
+            return self._count_tokens_from_messages(messages, answer, model=self.model)
+        return self._count_tokens_from_prompt(prompt, answer, model=self.model)
+
+    def _set_n_used_tokens(self, n_request_tokens):
+        n_input_tokens, n_output_tokens = n_request_tokens
+        self.n_used_tokens = (n_input_tokens + self._n_hedge_input_tokens, n_output_tokens + self._n_hedge_output_tokens)
+
+    def _complete(self, messages, prompt, options, stream):
+        hedging_config = config.hedging_config
+        self._is_hedged = False
+        if hedging_config.enable and stream:
+            n_input_tokens = self._count_tokens(messages, prompt, "")[0]
+            if n_input_tokens <= hedging_config.max_input_tokens:  # a duplicate of a short prompt is cheap
+                self._is_hedged = True
+                return self._complete_hedged(n_input_tokens, messages=messages, prompt=prompt, stream=stream, **options)
+        return self.provider.complete(self.model, messages=messages, prompt=prompt, stream=stream, **options)
+
+    async def _complete_hedged(self, n_input_tokens, **kwargs):
+        # a second identical request is sent if the first one has no token after the hedging delay,
+        # the answer is streamed from whichever responds first and the other request is closed
+        attempts = []
+        first_chunk_tasks = {}
+        start_times = {}
+
+        def start_attempt():
+            attempt = self.provider.complete(self.model, **kwargs)
+            attempts.append(attempt)
+            first_chunk_tasks[asyncio.ensure_future(attempt.__anext__())] = attempt
+            start_times[attempt] = time.perf_counter()
+
+        def on_first_chunk(attempt, task):
+            # the time to first token of every request from when it was sent, not from the first request
+            if task.cancelled() or task.exception() is not None:
+                return
+            first_token_latencies.add(self.model, time.perf_counter() - start_times[attempt])
+            if attempt is not winner:  # the output a loser streamed before it was closed is billed too
+                chunk = task.result()
+                self._n_hedge_output_tokens += chunk.usage[1] if chunk.usage is not None else len(get_encoding(self.model).encode(chunk.text))
+
+        winner, winner_task = None, None
+        errors = []
+        try:
+            start_attempt()
+            done, _ = await asyncio.wait(first_chunk_tasks, timeout=get_hedging_delay_sec(self.model))
+            if not done:
+                start_attempt()
+                metrics.HEDGED_COMPLETIONS.labels(self.model).inc()
+
+            while winner is None and first_chunk_tasks:
+                done, _ = await asyncio.wait(first_chunk_tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt = first_chunk_tasks.pop(task)
+                    if task.exception() is not None and not isinstance(task.exception(), StopAsyncIteration):
+                        errors.append(task.exception())
+                    elif winner is None:
+                        winner, winner_task = attempt, task
+                    on_first_chunk(attempt, task)
+            if winner is None:
+                raise errors[0]
+            if winner is not attempts[0]:
+                metrics.HEDGED_COMPLETION_WINS.labels(self.model).inc()
+        finally:
+            # losers, also when canceled before the first token
+            for task in first_chunk_tasks:
+                task.cancel()
+            if first_chunk_tasks:
+                await asyncio.wait(first_chunk_tasks)
+                for task, attempt in first_chunk_tasks.items():  # a first chunk may have come meanwhile
+                    on_first_chunk(attempt, task)
+            for attempt in attempts:
+                if attempt is not winner:
+                    await attempt.aclose()
+
+            # the input of every request sent is billed, the first one is counted by the caller
+            self._n_hedge_input_tokens += n_input_tokens * max(len(attempts) - 1 - len(errors), 0)
+
+        try:
+            if winner_task.exception() is not None:  # empty answer
+                return
+            yield winner_task.result()
+            async for chunk in winner:
+                yield chunk
+        finally:
+            await winner.aclose()
+
+    async def _generate(self, message, dialog_messages, chat_mode, dialog_keeper, stream):
+        # yields (status, answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed),
+        # "not_finished" items only if stream is set
+        if chat_mode not in config.snapshot.chat_modes:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
         if chat_mode == "custom" and dialog_keeper is None:
             raise ValueError(f"User state must be provided for {chat_mode} mode.")
 
+        if chat_mode == "custom":
+            with tracing.span("recall"):
+                await dialog_keeper.recall(message, dialog_messages)
+
         n_dialog_messages_before = len(dialog_messages)
+        self.n_used_tokens = (0, 0)
+        self._n_hedge_input_tokens = 0
+        self._n_hedge_output_tokens = 0
         answer = None
         while answer is None:
+            start_time = time.perf_counter()
+            messages, prompt = None, None
+            n_request_tokens = None
+            n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
             try:
-                if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4"}:
-                    messages, other_options = self._generate_api_options(message, dialog_messages, chat_mode, dialog_keeper)
-
-                    r_gen = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        request_timeout=OPENAI_COMPLETION_REQUEST_TIMEOUT,
-                        **(OPENAI_COMPLETION_DEFAULT_OPTIONS if other_options is None else other_options)
-                    )
-
-                    answer = ""
-                    async for r_item in r_gen:
-                        delta = r_item.choices[0].delta
-                        if "content" in delta:
-                            answer += delta.content
-                            n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
-                            n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-                elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode, dialog_keeper)
-                    r_gen = await openai.Completion.acreate(
-                        engine=self.model,
-                        prompt=prompt,
-                        stream=True,
-                        request_timeout=OPENAI_COMPLETION_REQUEST_TIMEOUT,
-                        **OPENAI_COMPLETION_DEFAULT_OPTIONS
-                    )
-
-                    answer = ""
-                    async for r_item in r_gen:
-                        answer += r_item.choices[0].text
-                        n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer, model=self.model)
-                        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                        yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                messages, prompt, options = self._generate_request(message, dialog_messages, chat_mode, dialog_keeper)
+
+                answer = ""
+                chunks = self._complete(messages, prompt, options, stream)
+                try:
+                    async for chunk in chunks:
+                        # without streaming the first chunk is the whole answer
+                        if n_request_tokens is None and stream:
+                            time_to_first_token_sec = time.perf_counter() - start_time
+                            metrics.COMPLETION_TIME_TO_FIRST_TOKEN.labels(self.model).observe(time_to_first_token_sec)
+                            if not self._is_hedged:
+                                first_token_latencies.add(self.model, time_to_first_token_sec)
+                        answer += chunk.text
+                        n_request_tokens = chunk.usage if chunk.usage is not None else self._count_tokens(messages, prompt, answer)
+                        self._set_n_used_tokens(n_request_tokens)
+                        if stream:
+                            yield "not_finished", answer, n_request_tokens, n_first_dialog_messages_removed
+                finally:
+                    await chunks.aclose()  # closes the connection right away, e.g. on /cancel
 
                 answer = self._postprocess_answer(answer)
+                metrics.COMPLETION_TIME.labels(self.model).observe(time.perf_counter() - start_time)
 
+            except (asyncio.CancelledError, GeneratorExit):
+                # a canceled request is still billed for its input
+                if n_request_tokens is None and (messages is not None or prompt is not None):
+                    self._set_n_used_tokens((self._count_tokens(messages, prompt, "")[0], 0))
+                raise
             except openai.error.InvalidRequestError as e:  # too many tokens
                 if len(dialog_messages) == 0:
-                    raise e
+                    if stream:
+                        raise e
+                    raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
 
                 # forget first message in dialog_messages
                 dialog_messages = dialog_messages[1:]
+                answer = None
+
+        yield "finished", answer, n_request_tokens, n_first_dialog_messages_removed
 
-        yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed  # sending final answer
+    async def send_message(self, message, dialog_messages=[], chat_mode="assistant", dialog_keeper=None):
+        async for _, answer, n_used_tokens, n_first_dialog_messages_removed in self._generate(
+            message, dialog_messages, chat_mode, dialog_keeper, stream=False
+        ):
+            pass
+
+        return answer, n_used_tokens, n_first_dialog_messages_removed
+
+    def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant", dialog_keeper=None):
+        return self._generate(message, dialog_messages, chat_mode, dialog_keeper, stream=True)
 
     def _generate_prompt(self, message, dialog_messages, chat_mode):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
+        prompt = config.snapshot.chat_modes[chat_mode].prompt_start
         prompt += "\n\n"
 
         # add chat context
@@ -144,7 +275,7 @@ class ChatGPT:
         return prompt
 
     def _generate_api_options(self, message, dialog_messages, chat_mode, dialog_keeper):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
+        prompt = config.snapshot.chat_modes[chat_mode].prompt_start
 
         if chat_mode == "custom":
             return dialog_keeper.generate_api_options(message, dialog_messages)
@@ -162,19 +293,14 @@ class ChatGPT:
         return answer
 
     def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
-        encoding = tiktoken.encoding_for_model(model)
+        encoding = get_encoding(model)
 
-        if model == "gpt-3.5-turbo-16k":
+        if model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo"}:
             tokens_per_message = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
             tokens_per_name = -1  # if there's a name, the role is omitted
-        elif model == "gpt-3.5-turbo":
-            tokens_per_message = 4
-            tokens_per_name = -1
-        elif model == "gpt-4":
+        else:  # gpt-4 and the models we know nothing about
             tokens_per_message = 3
             tokens_per_name = 1
-        else:
-            raise ValueError(f"Unknown model: {model}")
 
         # input
         n_input_tokens = 0
@@ -193,7 +319,7 @@ class ChatGPT:
         return n_input_tokens, n_output_tokens
 
     def _count_tokens_from_prompt(self, prompt, answer, model="text-davinci-003"):
-        encoding = tiktoken.encoding_for_model(model)
+        encoding = get_encoding(model)
 
         n_input_tokens = len(encoding.encode(prompt)) + 1
         n_output_tokens = len(encoding.encode(answer))
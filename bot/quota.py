@@ -0,0 +1,175 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Optional
+
+from pymongo import UpdateOne
+
+import config
+import database
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_tokens_field(model: str) -> str:
+    return "n_tokens_" + database.encode_model_key(model)  # no dots in field names, escaped as in n_used_tokens
+
+
+class QuotaStore:
+    # today's usage counters, read from memory and synced to the quota_usage collection:
+    # local increments are written with $inc and the counters are refreshed with the totals of all processes
+    def __init__(self, collection):
+        self._collection = collection
+        self._counters = {}  # counter id -> {field: amount}, including increments not synced yet
+        self._pending = {}  # counter id -> {field: amount} not synced yet
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_counter_id(scope: str, scope_id: int, day: Optional[datetime] = None):
+        day = day or datetime.now()
+        return f"{day:%Y-%m-%d}:{scope}:{scope_id}"
+
+    def get(self, counter_id: str, field: str) -> float:
+        with self._lock:
+            counter = self._counters.get(counter_id)
+        if counter is None:  # first use today in this process
+            counter_dict = self._collection.find_one({"_id": counter_id}) or {}
+            with self._lock:
+                counter = self._counters.setdefault(counter_id, {
+                    key: value for key, value in counter_dict.items() if key.startswith("n_")
+                })
+        return counter.get(field, 0)
+
+    def add(self, counter_id: str, amounts: dict):
+        with self._lock:
+            counter = self._counters.setdefault(counter_id, {})
+            pending = self._pending.setdefault(counter_id, {})
+            for field, amount in amounts.items():
+                counter[field] = counter.get(field, 0) + amount
+                pending[field] = pending.get(field, 0) + amount
+
+    def sync(self):
+        today_prefix = datetime.now().strftime("%Y-%m-%d:")
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            counter_ids = [counter_id for counter_id in self._counters if counter_id.startswith(today_prefix)]
+
+        try:
+            if pending:
+                self._collection.bulk_write([
+                    UpdateOne(
+                        {"_id": counter_id},
+                        {"$inc": amounts, "$setOnInsert": {"day": datetime.strptime(counter_id[:10], "%Y-%m-%d")}},
+                        upsert=True
+                    )
+                    for counter_id, amounts in pending.items()
+                ], ordered=False)
+        except Exception:
+            with self._lock:  # retried with the next sync
+                for counter_id, amounts in pending.items():
+                    counter_pending = self._pending.setdefault(counter_id, {})
+                    for field, amount in amounts.items():
+                        counter_pending[field] = counter_pending.get(field, 0) + amount
+            raise
+
+        counter_dicts = {
+            counter_dict["_id"]: counter_dict
+            for counter_dict in self._collection.find({"_id": {"$in": counter_ids}})
+        }
+        with self._lock:
+            counters = {}
+            for counter_id in counter_ids:  # counters of past days are dropped
+                counter = {key: value for key, value in counter_dicts.get(counter_id, {}).items() if key.startswith("n_")}
+                for field, amount in self._pending.get(counter_id, {}).items():  # added during the sync
+                    counter[field] = counter.get(field, 0) + amount
+                counters[counter_id] = counter
+            self._counters = counters
+
+        return len(pending)
+
+
+class QuotaEngine:
+    # daily limits per user and per group chat, checked before a request is sent to OpenAI;
+    # a request is allowed while some budget is left, so a limit can be exceeded by the last request
+    def __init__(self, quota_config: config.QuotaConfiguration, store: QuotaStore):
+        self.config = quota_config
+        self.store = store
+
+    def _get_scopes(self, user_id: int, chat_id: int, is_group_chat: bool):
+        scopes = [(self.store.get_counter_id("user", user_id), self.config.user_limits)]
+        if is_group_chat:
+            scopes.append((self.store.get_counter_id("chat", chat_id), self.config.group_chat_limits))
+        return scopes
+
+    def _get_remaining(self, scopes, field, get_limit):
+        remaining = None
+        for counter_id, limits in scopes:
+            limit = get_limit(limits)
+            if limit is None:
+                continue
+            scope_remaining = max(limit - self.store.get(counter_id, field), 0)
+            remaining = scope_remaining if remaining is None else min(remaining, scope_remaining)
+        return remaining  # None if unlimited
+
+    def get_remaining_tokens(self, user_id: int, chat_id: int, is_group_chat: bool, model: str):
+        return self._get_remaining(
+            self._get_scopes(user_id, chat_id, is_group_chat), get_tokens_field(model),
+            lambda limits: limits.get_tokens_per_day(model)
+        )
+
+    def get_remaining_images(self, user_id: int, chat_id: int, is_group_chat: bool):
+        return self._get_remaining(
+            self._get_scopes(user_id, chat_id, is_group_chat), "n_images",
+            lambda limits: limits.images_per_day
+        )
+
+    def get_remaining_transcription_seconds(self, user_id: int, chat_id: int, is_group_chat: bool):
+        return self._get_remaining(
+            self._get_scopes(user_id, chat_id, is_group_chat), "n_transcribed_seconds",
+            lambda limits: None if limits.transcription_min_per_day is None else limits.transcription_min_per_day * 60
+        )
+
+    def is_model_allowed(self, user_id: int, chat_id: int, is_group_chat: bool, model: str):
+        if not self.config.enable:
+            return True
+        remaining = self.get_remaining_tokens(user_id, chat_id, is_group_chat, model)
+        return remaining is None or remaining > 0
+
+    def choose_model(self, user_id: int, chat_id: int, is_group_chat: bool, model: str):
+        # the model to answer with: the requested one, the downgrade model or None if both are used up
+        if self.is_model_allowed(user_id, chat_id, is_group_chat, model):
+            return model
+
+        downgrade_model = self.config.downgrade_model
+        if downgrade_model is not None and downgrade_model != model \
+                and self.is_model_allowed(user_id, chat_id, is_group_chat, downgrade_model):
+            return downgrade_model
+        return None
+
+    def can_generate_images(self, user_id: int, chat_id: int, is_group_chat: bool):
+        if not self.config.enable:
+            return True
+        remaining = self.get_remaining_images(user_id, chat_id, is_group_chat)
+        return remaining is None or remaining > 0
+
+    def can_transcribe(self, user_id: int, chat_id: int, is_group_chat: bool):
+        if not self.config.enable:
+            return True
+        remaining = self.get_remaining_transcription_seconds(user_id, chat_id, is_group_chat)
+        return remaining is None or remaining > 0
+
+    def _record(self, user_id: int, chat_id: int, is_group_chat: bool, amounts: dict):
+        if not self.config.enable:
+            return
+        for counter_id, _ in self._get_scopes(user_id, chat_id, is_group_chat):
+            self.store.add(counter_id, amounts)
+
+    def record_tokens(self, user_id: int, chat_id: int, is_group_chat: bool, model: str, n_tokens: int):
+        self._record(user_id, chat_id, is_group_chat, {get_tokens_field(model): n_tokens})
+
+    def record_images(self, user_id: int, chat_id: int, is_group_chat: bool, n_images: int):
+        self._record(user_id, chat_id, is_group_chat, {"n_images": n_images})
+
+    def record_transcription(self, user_id: int, chat_id: int, is_group_chat: bool, n_seconds: float):
+        self._record(user_id, chat_id, is_group_chat, {"n_transcribed_seconds": n_seconds})
@@ -0,0 +1,169 @@
+import array
+import asyncio
+import hashlib
+import math
+import operator
+import re
+from typing import List, Tuple
+
+import openai
+
+import config
+
+
+QUANTIZATION_SCALE = 127  # vectors are stored as int8
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class Embedder:
+    # turns texts into vectors of one dimension, compared by cosine similarity
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+
+class HashingEmbedder(Embedder):
+    # local and free: words and pairs of words hashed into dim signed buckets,
+    # finds turns sharing words with the message, not synonyms
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _add_feature(self, vector, feature):
+        digest = hashlib.md5(feature.encode()).digest()
+        bucket = int.from_bytes(digest[:4], "little") % self.dim
+        vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+
+    def embed_text(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        words = WORD_PATTERN.findall(text.lower())
+        for word in words:
+            self._add_feature(vector, word)
+        for prev_word, word in zip(words, words[1:]):
+            self._add_feature(vector, f"{prev_word} {word}")
+        return vector
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_text(text) for text in texts]
+
+    async def embed(self, texts):
+        # hashing is CPU-bound, so it is done in a thread not to block the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self.embed_texts, texts)
+
+
+class OpenAIEmbedder(Embedder):
+    def __init__(self, model: str = "text-embedding-ada-002"):
+        self.model = model
+
+    async def embed(self, texts):
+        r = await openai.Embedding.acreate(
+            model=self.model, input=texts, api_key=config.openai_api_key, api_base=config.openai_api_base
+        )
+        return [item["embedding"] for item in sorted(r["data"], key=lambda item: item["index"])]
+
+
+def quantize(vector: List[float]) -> array.array:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return array.array("b", (max(-QUANTIZATION_SCALE, min(QUANTIZATION_SCALE, round(x / norm * QUANTIZATION_SCALE))) for x in vector))
+
+
+class VectorIndex:
+    # normalized vectors quantized to int8 in one array, dim bytes per vector; searched by brute force,
+    # which is fast enough for the turns of one dialog
+    def __init__(self):
+        self._vectors = array.array("b")
+        self._dim = None
+
+    def __len__(self):
+        return len(self._vectors) // self._dim if self._dim else 0
+
+    def add(self, vector: List[float]):
+        if self._dim is None:
+            self._dim = len(vector)
+        elif len(vector) != self._dim:
+            raise ValueError(f"Vector of dimension {len(vector)} added to an index of dimension {self._dim}")
+        self._vectors.extend(quantize(vector))
+
+    def truncate(self, n_vectors: int):
+        if self._dim is not None:
+            del self._vectors[n_vectors * self._dim:]
+
+    def remove_first(self, n_vectors: int):
+        if self._dim is not None:
+            del self._vectors[:n_vectors * self._dim]
+
+    def search(self, vector: List[float]) -> List[Tuple[float, int]]:
+        # (cosine similarity, index) of all vectors, the most similar first
+        if not len(self):
+            return []
+        query = quantize(vector)
+        dim, scale = self._dim, QUANTIZATION_SCALE * QUANTIZATION_SCALE
+        scores = [
+            (sum(map(operator.mul, query, self._vectors[start:start + dim])) / scale, start // dim)
+            for start in range(0, len(self._vectors), dim)
+        ]
+        scores.sort(reverse=True)
+        return scores
+
+
+class DialogMemory:
+    # index of the last max_n_turns turns of the current dialog of one user,
+    # turn first_turn_index + i of the dialog is vector i
+    def __init__(self, embedder: Embedder, max_n_turns: int = 1000, embedding_batch_size: int = 100):
+        self._embedder = embedder
+        self._max_n_turns = max_n_turns
+        self._embedding_batch_size = embedding_batch_size
+        self._index = VectorIndex()
+        self._first_turn_index = 0
+
+    @property
+    def n_turns(self):
+        # turns of the dialog seen so far, including the ones no longer indexed
+        return self._first_turn_index + len(self._index)
+
+    def clear(self, first_turn_index: int = 0):
+        self._index = VectorIndex()
+        self._first_turn_index = first_turn_index
+
+    async def update(self, dialog_messages: list):
+        if len(dialog_messages) < self.n_turns:  # e.g. /retry removed the last turn
+            if len(dialog_messages) < self._first_turn_index:
+                self.clear()
+            else:
+                self._index.truncate(len(dialog_messages) - self._first_turn_index)
+
+        first_new_turn_index = max(self.n_turns, len(dialog_messages) - self._max_n_turns)
+        if first_new_turn_index > self.n_turns:  # all indexed turns are too old, e.g. a long dialog loaded at once
+            self.clear(first_new_turn_index)
+
+        # in batches, an API request of the whole dialog could be too large
+        for start in range(first_new_turn_index, len(dialog_messages), self._embedding_batch_size):
+            vectors = await self._embedder.embed([
+                f"{dialog_message['user']}\n{dialog_message['bot']}"
+                for dialog_message in dialog_messages[start:start + self._embedding_batch_size]
+            ])
+            for vector in vectors:
+                self._index.add(vector)
+
+        n_old_turns = len(self._index) - self._max_n_turns
+        if n_old_turns > 0:
+            self._index.remove_first(n_old_turns)
+            self._first_turn_index += n_old_turns
+
+    async def search(self, text: str, min_score: float) -> List[Tuple[float, int]]:
+        if not len(self._index):
+            return []
+        vector, = await self._embedder.embed([text])
+        # brute force search is CPU-bound, so it is done in a thread not to block the event loop
+        scores = await asyncio.get_running_loop().run_in_executor(None, self._index.search, vector)
+        return [(score, self._first_turn_index + i) for score, i in scores if score >= min_score]
+
+
+def create_embedder(retrieval_config: config.RetrievalConfiguration) -> Embedder:
+    if retrieval_config.embedder == "hashing":
+        return HashingEmbedder(retrieval_config.hashing_dim)
+    elif retrieval_config.embedder == "openai":
+        return OpenAIEmbedder(retrieval_config.openai_model)
+    else:
+        raise ValueError(f"Unknown embedder: {retrieval_config.embedder}")
+
+
+default_embedder = create_embedder(config.long_dialog_config.retrieval)
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+import openai
+
+import config
+import metrics
+import openai_utils
+from dialog_keeper import DEFAULT_TOKEN_LIMIT, TOKEN_LIMIT
+
+
+logger = logging.getLogger(__name__)
+
+# errors after which another model is tried, as long as nothing was shown to the user yet
+FALLBACK_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    asyncio.TimeoutError,
+    aiohttp.ClientError,
+)
+
+
+class ModelStats:
+    def __init__(self):
+        self.time_to_first_token_sec = None  # moving average
+        self.error_rate = 0.0  # moving average
+        self.n_in_flight = 0
+        self.last_attempt_time = None
+
+
+class ModelRouter:
+    # live latency, error rate and in-flight requests of every model, shared by all users of the process
+    def __init__(self, routing_config: config.ModelRoutingConfiguration):
+        self.config = routing_config
+        self.stats = {}
+
+    def _get_stats(self, model: str) -> ModelStats:
+        if model not in self.stats:
+            self.stats[model] = ModelStats()
+        return self.stats[model]
+
+    def _update_average(self, average, value):
+        if average is None:
+            return value
+        weight = self.config.moving_average_weight
+        return weight * value + (1 - weight) * average
+
+    def is_healthy(self, model: str) -> bool:
+        stats = self._get_stats(model)
+        if stats.n_in_flight >= self.config.max_in_flight_per_model:
+            return False
+
+        # an avoided model gets no requests, so its averages are refreshed by a probe from time to time
+        if stats.last_attempt_time is None or time.monotonic() - stats.last_attempt_time > self.config.probe_interval_sec:
+            return True
+
+        is_slow = stats.time_to_first_token_sec is not None and stats.time_to_first_token_sec > self.config.slow_first_token_sec
+        return not is_slow and stats.error_rate <= self.config.max_error_rate
+
+    def _get_load_score(self, model: str) -> float:
+        stats = self._get_stats(model)
+        return (stats.time_to_first_token_sec or 0.0) * (1 + stats.n_in_flight)
+
+    def get_candidates(self, preferred_model: str, chat_mode: str):
+        # the preferred model first unless it is unhealthy, then the others of the same type by load
+        snapshot = config.snapshot
+        if preferred_model not in snapshot.models:
+            return [preferred_model]
+
+        model_type = snapshot.models[preferred_model].type
+        fallback_models = [
+            model for model in snapshot.available_text_models
+            if model != preferred_model and snapshot.models[model].type == model_type
+        ]
+        if chat_mode == "custom":  # long dialogs are sized for the token limit of the preferred model
+            fallback_models = [model for model in fallback_models if TOKEN_LIMIT.get(model, DEFAULT_TOKEN_LIMIT) >= TOKEN_LIMIT.get(preferred_model, DEFAULT_TOKEN_LIMIT)]
+        fallback_models.sort(key=self._get_load_score)
+
+        candidates = [preferred_model] + fallback_models
+        return sorted(candidates, key=lambda model: not self.is_healthy(model))
+
+    def new_completion(self, preferred_model: str, chat_mode: str, enable_fallback: bool = False, is_model_allowed=None):
+        # is_model_allowed filters the fallback models, e.g. by the quotas of the user
+        if self.config.enable and enable_fallback:
+            candidates = self.get_candidates(preferred_model, chat_mode)
+            if is_model_allowed is not None:
+                candidates = [model for model in candidates if model == preferred_model or is_model_allowed(model)]
+        else:
+            candidates = [preferred_model]
+        return RoutedCompletion(self, candidates)
+
+    def on_attempt_start(self, model: str):
+        stats = self._get_stats(model)
+        stats.n_in_flight += 1
+        stats.last_attempt_time = time.monotonic()
+        metrics.IN_FLIGHT_COMPLETIONS.labels(model).inc()
+
+    def on_first_token(self, model: str, time_to_first_token_sec: float):
+        stats = self._get_stats(model)
+        stats.time_to_first_token_sec = self._update_average(stats.time_to_first_token_sec, time_to_first_token_sec)
+
+    def on_attempt_end(self, model: str, is_error: bool):
+        stats = self._get_stats(model)
+        stats.n_in_flight -= 1
+        stats.error_rate = self._update_average(stats.error_rate, 1.0 if is_error else 0.0)
+        metrics.IN_FLIGHT_COMPLETIONS.labels(model).dec()
+
+
+class RoutedCompletion:
+    # one answer, given by the first candidate that does not fail before its first token;
+    # model is the one that served the answer, n_used_tokens also has the tokens of abandoned attempts
+    def __init__(self, router: ModelRouter, candidates: list):
+        self.router = router
+        self.candidates = candidates
+        self.model = candidates[0]
+        self._attempts = []
+
+    @property
+    def n_used_tokens(self) -> dict:
+        n_used_tokens = {}
+        for model, chatgpt_instance in self._attempts:
+            n_input_tokens, n_output_tokens = chatgpt_instance.n_used_tokens
+            n_model_input_tokens, n_model_output_tokens = n_used_tokens.get(model, (0, 0))
+            n_used_tokens[model] = (n_model_input_tokens + n_input_tokens, n_model_output_tokens + n_output_tokens)
+        return n_used_tokens
+
+    def _new_attempt(self, model: str):
+        chatgpt_instance = openai_utils.ChatGPT(model=model)
+        self._attempts.append((model, chatgpt_instance))
+        return chatgpt_instance
+
+    def _on_fallback(self, model: str, e: Exception):
+        logger.warning(f"Completion with {model} failed before the first token, falling back to another model: {e!r}")
+        metrics.MODEL_FALLBACKS.labels(model).inc()
+
+    async def send_message(self, message, **kwargs):
+        for model in self.candidates:
+            chatgpt_instance = self._new_attempt(model)
+            self.router.on_attempt_start(model)
+            is_error = False
+            try:
+                # the time of a whole answer is not a time to first token, so it is not recorded
+                result = await chatgpt_instance.send_message(message, **kwargs)
+                self.model = model
+                return result
+            except FALLBACK_ERRORS as e:
+                is_error = True
+                if model == self.candidates[-1]:
+                    raise
+                self._on_fallback(model, e)
+            except Exception:
+                is_error = True
+                raise
+            finally:
+                self.router.on_attempt_end(model, is_error)
+
+    async def send_message_stream(self, message, **kwargs):
+        for model in self.candidates:
+            is_last_candidate = model == self.candidates[-1]
+            gen = self._new_attempt(model).send_message_stream(message, **kwargs)
+            self.router.on_attempt_start(model)
+            is_error = False
+            try:
+                try:
+                    start_time = time.perf_counter()
+                    timeout = None if is_last_candidate else self.router.config.first_token_timeout_sec
+                    gen_item = await asyncio.wait_for(gen.__anext__(), timeout)
+                    self.router.on_first_token(model, time.perf_counter() - start_time)
+                except FALLBACK_ERRORS as e:
+                    is_error = True
+                    if is_last_candidate:
+                        raise
+                    self._on_fallback(model, e)
+                    continue
+
+                # the answer is being shown, so later errors are not retried with another model
+                self.model = model
+                yield gen_item
+                async for gen_item in gen:
+                    yield gen_item
+                return
+            except Exception:
+                is_error = True
+                raise
+            finally:
+                await gen.aclose()
+                self.router.on_attempt_end(model, is_error)
@@ -0,0 +1,116 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import threading
+import time
+
+from telegram import Update
+
+
+logger = logging.getLogger(__name__)
+
+N_VIRTUAL_NODES = 512
+STOP_WORKER = None  # sentinel put into a worker queue to stop it
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    # consistent hashing, changing the number of shards moves only ~1/n of the keys
+    def __init__(self, n_shards: int, n_virtual_nodes: int = N_VIRTUAL_NODES):
+        ring = sorted(
+            (_hash(f"{shard_index}:{node_index}"), shard_index)
+            for shard_index in range(n_shards) for node_index in range(n_virtual_nodes)
+        )
+        self._hashes = [node_hash for node_hash, _ in ring]
+        self._shard_indices = [shard_index for _, shard_index in ring]
+
+    def get_shard(self, key: int) -> int:
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._shard_indices[index]
+
+
+def is_group_chat_message(update: Update) -> bool:
+    message = update.message
+    return (
+        message is not None and message.chat.type != "private"
+        and message.text is not None and not message.text.startswith("/")
+    )
+
+
+def get_routing_key(update: Update, route_group_chats_by_chat: bool = False) -> int:
+    # user id, so that all updates of a user (messages, commands, button callbacks) go to the same worker;
+    # chat id for the mentions of group chats with a shared dialog, whose batching and rate limits are kept by one worker,
+    # commands sent in group chats (/mode, /settings, /new, /cancel, ...) change the user and go to the user's worker
+    if route_group_chats_by_chat and is_group_chat_message(update):
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return 0
+
+
+class WorkerPool:
+    # worker processes of the supervisor mode, each gets the updates of its shard through its own queue;
+    # queues outlive the processes, so a restarted worker continues with the updates routed to it meanwhile
+    def __init__(self, n_workers: int, target, route_group_chats_by_chat: bool = False):
+        self._context = multiprocessing.get_context("spawn")  # no forking of MongoClient and event loop state
+        self._target = target
+        self._route_group_chats_by_chat = route_group_chats_by_chat
+        self.ring = HashRing(n_workers)
+        self.queues = [self._context.Queue() for _ in range(n_workers)]
+        self.processes = [None] * n_workers
+
+    def _start_worker(self, worker_index: int):
+        process = self._context.Process(
+            target=self._target, args=(worker_index, self.queues[worker_index]),
+            name=f"bot-worker-{worker_index}", daemon=True
+        )
+        process.start()
+        self.processes[worker_index] = process
+
+    def start(self):
+        for worker_index in range(len(self.queues)):
+            self._start_worker(worker_index)
+
+    def restart_dead_workers(self):
+        for worker_index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"Worker {worker_index} exited with code {process.exitcode}, restarting it")
+                self._start_worker(worker_index)
+
+    def route(self, update: Update):
+        routing_key = get_routing_key(update, self._route_group_chats_by_chat)
+        self.queues[self.ring.get_shard(routing_key)].put(update.to_dict())
+
+    def stop(self, timeout_sec: float):
+        for queue in self.queues:
+            queue.put(STOP_WORKER)
+        deadline = time.monotonic() + timeout_sec  # workers drain in parallel
+        for worker_index, process in enumerate(self.processes):
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.error(f"Worker {worker_index} did not stop in {timeout_sec} sec, terminating it")
+                process.terminate()
+                process.join()
+
+
+def start_update_feeder(loop, application, queue, on_stop):
+    # worker side: moves updates from the supervisor queue to application.update_queue,
+    # a daemon thread because the blocking get must not keep the process alive
+    def feed():
+        while True:
+            update_data = queue.get()
+            if update_data is STOP_WORKER:
+                loop.call_soon_threadsafe(on_stop)
+                return
+            update = Update.de_json(update_data, application.bot)
+            loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+
+    thread = threading.Thread(target=feed, name="update-feeder", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import signal
+import time
+from typing import Optional
+
+from telegram.ext import Application
+
+
+logger = logging.getLogger(__name__)
+
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGABRT)
+CANCEL_TIMEOUT_SEC = 2.0
+
+
+class ShutdownCoordinator:
+    # on a stop signal: stops fetching updates, lets in-flight user tasks finish until the drain deadline,
+    # cancels the rest (their handlers save partial answers) and then stops the event loop,
+    # so that Application.stop() and post_shutdown() run without waiting for long completions;
+    # waiting tasks (e.g. of group chat batch windows and rate limits) have no answer to finish and are canceled first
+    def __init__(self, user_tasks: dict, drain_timeout_sec: float, waiting_tasks: Optional[dict] = None):
+        self.user_tasks = user_tasks
+        self.waiting_tasks = {} if waiting_tasks is None else waiting_tasks
+        self.drain_timeout_sec = drain_timeout_sec
+        self.is_shutting_down = False
+        self.report = {
+            "n_drained_tasks": 0,
+            "n_cancelled_tasks": 0,
+            "n_cancelled_waits": 0,
+            "n_saved_partial_answers": 0,
+            "n_flushed_dialog_keepers": 0,
+            "n_flushed_dialog_messages": 0,
+            "n_flushed_last_interactions": 0,
+            "drain_time_sec": 0.0,
+        }
+        self._shutdown_task = None
+
+    def install_signal_handlers(self, application: Application):
+        # replaces the signal handling of run_polling, which must be called with stop_signals=None
+        loop = asyncio.get_running_loop()
+        for sig in STOP_SIGNALS:
+            try:
+                loop.add_signal_handler(sig, self.request_stop, application)
+            except NotImplementedError:  # Windows, KeyboardInterrupt still stops the bot but without draining
+                logger.warning(f"Could not add a handler for {sig!r}, in-flight answers will not be drained")
+
+    def request_stop(self, application: Application):
+        if self._shutdown_task is None:
+            self._shutdown_task = asyncio.create_task(self.drain(application))
+        else:
+            logger.warning("Stop signal received again, stopping without waiting for in-flight answers")
+            asyncio.get_running_loop().stop()
+
+    async def drain(self, application: Application):
+        self.is_shutting_down = True
+        start_time = time.monotonic()
+        logger.info(f"Shutting down, waiting up to {self.drain_timeout_sec} sec for {len(self.user_tasks)} in-flight answers")
+
+        try:
+            if application.updater is not None and application.updater.running:
+                await application.updater.stop()
+
+            waiting_tasks = list(self.waiting_tasks.values())
+            for task in waiting_tasks:
+                task.cancel()
+            if waiting_tasks:
+                await asyncio.wait(waiting_tasks, timeout=CANCEL_TIMEOUT_SEC)  # they tell their users to ask again
+            self.report["n_cancelled_waits"] = len(waiting_tasks)
+
+            tasks = list(self.user_tasks.values())
+            if tasks:
+                timeout = max(self.drain_timeout_sec - (time.monotonic() - start_time), 0)
+                done, pending = await asyncio.wait(tasks, timeout=timeout)
+                self.report["n_drained_tasks"] = len(done)
+                self.report["n_cancelled_tasks"] = len(pending)
+
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.wait(pending, timeout=CANCEL_TIMEOUT_SEC)
+        except Exception:
+            logger.exception("Failed to drain in-flight answers")
+        finally:
+            self.report["drain_time_sec"] = time.monotonic() - start_time
+            asyncio.get_running_loop().stop()  # run_polling continues with Application.stop() and post_shutdown()
+
+    def flush(self, dialog_keepers: dict, db):
+        for keeper in dialog_keepers.values():
+            try:
+                n_messages = keeper.flush()
+            except Exception:
+                logger.exception("Failed to flush a dialog keeper")
+                continue
+            if n_messages > 0:
+                self.report["n_flushed_dialog_keepers"] += 1
+            self.report["n_flushed_dialog_messages"] += n_messages
+
+        self.report["n_flushed_last_interactions"] += db.flush_last_interactions()
+
+
+def format_shutdown_report(report: dict):
+    return (
+        f"Shutdown: {report['n_drained_tasks']} answers finished and {report['n_cancelled_tasks']} cancelled "
+        f"in {report['drain_time_sec']:.1f} sec ({report['n_saved_partial_answers']} partial answers saved, "
+        f"{report['n_cancelled_waits']} waits for a batch cancelled), "
+        f"flushed {report['n_flushed_dialog_keepers']} dialog keepers with {report['n_flushed_dialog_messages']} messages "
+        f"and {report['n_flushed_last_interactions']} last interactions"
+    )
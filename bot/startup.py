@@ -0,0 +1,40 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupProfile:
+    # durations of the startup phases: the serial ones until the bot serves updates,
+    # and the background ones started after post_init
+    def __init__(self):
+        self.start_time = time.perf_counter()  # when this module was imported, before the other bot modules
+        self._last_mark_time = self.start_time
+        self.phases = []  # (name, sec)
+        self.background_phases = []  # (name, sec)
+
+    def mark(self, phase: str):
+        # the phase took the time since the previous mark
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last_mark_time))
+        self._last_mark_time = now
+
+    @property
+    def ready_sec(self):
+        return self._last_mark_time - self.start_time
+
+    @contextmanager
+    def background_phase(self, phase: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.background_phases.append((phase, time.perf_counter() - start_time))
+
+
+def format_startup_report(profile: StartupProfile) -> str:
+    text = f"Ready to serve updates {profile.ready_sec:.3f} sec after start"
+    for phase, sec in profile.phases:
+        text += f"\n  {phase}: {sec:.3f} sec"
+    return text
+
+
+profile = StartupProfile()
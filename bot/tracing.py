@@ -0,0 +1,154 @@
+import contextvars
+import functools
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from pathlib import Path
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+COLLECTOR_BATCH_SIZE = 100
+NO_TRACE_ID = "-"
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, tags=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.tags = dict(tags or {})
+        self.start_time = time.time()
+        self.duration = None
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+
+    def finish(self):
+        self.duration = time.time() - self.start_time
+
+    def to_zipkin(self):
+        # Zipkin v2 span, timestamps in microseconds
+        span_dict = {
+            "traceId": self.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": int(self.start_time * 1_000_000),
+            "duration": max(1, int(self.duration * 1_000_000)),
+            "localEndpoint": {"serviceName": config.tracing_config.service_name},
+            "tags": {key: str(value) for key, value in self.tags.items()},
+        }
+        if self.parent_id is not None:
+            span_dict["parentId"] = self.parent_id
+        return span_dict
+
+
+class SpanExporter:
+    # writes finished spans to a JSON lines file and/or posts them to a Zipkin-compatible collector
+    def __init__(self, file_path=None, collector_url=None):
+        self.file_path = Path(file_path) if file_path is not None else None
+        self.collector_url = collector_url
+
+        self._file = None
+        self._file_lock = threading.Lock()
+        self._queue = queue.Queue()
+        if self.file_path is not None:
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.file_path, "a", buffering=1)  # line buffered
+        if self.collector_url is not None:
+            threading.Thread(target=self._send_to_collector, name="span-exporter", daemon=True).start()
+
+    def export(self, span):
+        span_dict = span.to_zipkin()
+        if self._file is not None:
+            with self._file_lock:
+                self._file.write(json.dumps(span_dict, ensure_ascii=False) + "\n")
+        if self.collector_url is not None:
+            self._queue.put(span_dict)
+
+    def _send_to_collector(self):
+        while True:
+            spans = [self._queue.get()]
+            while len(spans) < COLLECTOR_BATCH_SIZE and not self._queue.empty():
+                spans.append(self._queue.get_nowait())
+
+            request = urllib.request.Request(
+                self.collector_url,
+                data=json.dumps(spans).encode(),
+                headers={"Content-Type": "application/json"}
+            )
+            try:
+                urllib.request.urlopen(request, timeout=10).close()
+            except Exception as e:
+                logger.warning("Failed to send %d spans to %s: %s", len(spans), self.collector_url, e)
+
+
+exporter = SpanExporter(config.tracing_config.file_path, config.tracing_config.collector_url) \
+    if config.tracing_config.enable else None
+
+
+@contextmanager
+def span(name, **tags):
+    if exporter is None:
+        yield None
+        return
+
+    parent = current_span.get()
+    if parent is None:
+        new_span = Span(name, secrets.token_hex(16), tags=tags)
+    else:
+        new_span = Span(name, parent.trace_id, parent_id=parent.span_id, tags=tags)
+
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.set_tag("error", type(e).__name__)
+        # error_handle runs after the span is closed, so the trace id travels with the exception
+        if not hasattr(e, "trace_id"):
+            try:
+                e.trace_id = new_span.trace_id
+            except AttributeError:
+                pass
+        raise
+    finally:
+        current_span.reset(token)
+        new_span.finish()
+        exporter.export(new_span)
+
+
+def get_current_trace_id():
+    current = current_span.get()
+    return current.trace_id if current is not None else NO_TRACE_ID
+
+
+def trace_handler(handler):
+    # a span per handler call, the outermost one is the root span of the update
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        tags = {}
+        if getattr(update, "update_id", None) is not None:
+            tags["update_id"] = update.update_id
+        if getattr(update, "effective_user", None) is not None:
+            tags["user_id"] = update.effective_user.id
+
+        with span(handler.__name__, **tags):
+            return await handler(update, context, *args, **kwargs)
+
+    return wrapper
+
+
+class TraceIdLogFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = get_current_trace_id()
+        return True
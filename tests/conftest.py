@@ -0,0 +1,128 @@
+import asyncio
+import itertools
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import mongomock
+import openai
+import pymongo
+import pytest
+import telegram
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bench"))
+import common
+
+
+# bot modules read the config when they are imported, so it is written before the test modules import them
+config_dir = tempfile.TemporaryDirectory()
+common.write_bot_config(config_dir.name)
+common.use_bot_config(config_dir.name)
+
+
+@pytest.fixture
+def snapshot_data():
+    # chat_modes.yml and models.yml, to be changed and compiled by a test
+    import config
+
+    with open(config.config_dir / "chat_modes.yml") as f:
+        chat_modes_data = yaml.safe_load(f)
+    with open(config.config_dir / "models.yml") as f:
+        models_data = yaml.safe_load(f)
+    return chat_modes_data, models_data
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # a Database on an empty in-memory MongoDB
+    monkeypatch.setattr(pymongo, "MongoClient", lambda *args, **kwargs: mongomock.MongoClient())
+
+    import database
+    return database.Database()
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    # the bot module on an in-memory MongoDB, imported once for all tests
+    monkeypatch.setattr(pymongo, "MongoClient", lambda *args, **kwargs: mongomock.MongoClient())
+
+    import bot
+    return bot
+
+
+class FakeTelegramBot(telegram.Bot):
+    # answers the Bot API calls of the handlers without network and keeps them for the checks
+    def __init__(self):
+        super().__init__("123456:TEST")
+        self._api_requests = []  # (method, data)
+        self._message_ids = itertools.count(1)
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        self._api_requests.append((endpoint, data))
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bot", "username": "test_bot"}
+        if endpoint in {"sendMessage", "editMessageText"}:
+            return {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(data["chat_id"]), "type": "private" if int(data["chat_id"]) > 0 else "group"},
+                "text": data["text"],
+            }
+        return True
+
+    def get_texts(self, method="sendMessage"):
+        return [data["text"] for endpoint, data in self._api_requests if endpoint == method]
+
+
+@pytest.fixture
+def telegram_bot():
+    return FakeTelegramBot()
+
+
+class ScriptedProvider:
+    # answers "answer to <message>" after first_token_latency_sec, then n_more_chunks " more" every chunk_interval_sec;
+    # reports the usage, so no encodings are loaded
+    def __init__(self):
+        self.first_token_latency_sec = 0.0
+        self.n_more_chunks = 0
+        self.chunk_interval_sec = 0.0
+        self.failing_models = set()  # fail with RateLimitError before the first token
+        self.requests = []  # last messages of the requests
+
+    async def complete(self, model, messages=None, prompt=None, stream=True, **options):
+        import llm_providers
+
+        request_text = messages[-1]["content"] if messages is not None else prompt
+        self.requests.append(request_text)
+        await asyncio.sleep(self.first_token_latency_sec)
+        if model in self.failing_models:
+            raise openai.error.RateLimitError("The model is overloaded")
+
+        yield llm_providers.CompletionChunk(f"answer to {request_text}", usage=(10, 5))
+        for i in range(self.n_more_chunks):
+            await asyncio.sleep(self.chunk_interval_sec)
+            yield llm_providers.CompletionChunk(" more", usage=(10, 6 + i))
+
+
+@pytest.fixture
+def llm_provider(monkeypatch):
+    import llm_providers
+
+    provider = ScriptedProvider()
+    monkeypatch.setattr(llm_providers, "default_provider", provider)
+    return provider
+
+
+class WordEncoding:
+    # one token per word, so no tiktoken vocabulary is needed
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture
+def word_encoding(monkeypatch):
+    import openai_utils
+
+    monkeypatch.setattr(openai_utils, "get_encoding", lambda model: WordEncoding())
@@ -0,0 +1,157 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import pytest
+from prometheus_client import REGISTRY
+from telegram import Update
+
+import load_test
+import shutdown
+
+update_ids = itertools.count(1)
+
+
+def make_update(telegram_bot, user_id, text, chat_id=None):
+    update_data = load_test.make_text_update(next(update_ids), user_id, text)
+    if chat_id is not None:
+        update_data["message"]["chat"] = {"id": chat_id, "type": "supergroup"}
+    return Update.de_json(update_data, telegram_bot)
+
+
+def send_messages(bot, telegram_bot, user_id, messages, handler=None, chat_id=None):
+    # (delay_sec, text) pairs, handled concurrently like with concurrent_updates
+    context = SimpleNamespace(bot=telegram_bot)
+
+    async def send(delay_sec, text):
+        await asyncio.sleep(delay_sec)
+        update = make_update(telegram_bot, user_id, text, chat_id=chat_id)
+        if text == "/cancel":
+            await bot.cancel_handle(update, context)
+        else:
+            await (handler or bot.message_handle)(update, context)
+
+    async def main():
+        await telegram_bot.initialize()  # the username, for the mentions in group chats
+        await asyncio.gather(*(send(delay_sec, text) for delay_sec, text in messages))
+
+    asyncio.run(main())
+
+
+def test_messages_sent_during_an_answer_are_answered_together(bot, telegram_bot, llm_provider):
+    llm_provider.first_token_latency_sec = 0.2
+    send_messages(bot, telegram_bot, 37001, [(0, "first"), (0.05, "second"), (0.1, "third")])
+
+    assert llm_provider.requests == ["first", "second\nthird"]
+    assert [dialog_message["user"] for dialog_message in bot.db.get_dialog_messages(37001)] == ["first", "second\nthird"]
+    assert not any("Please wait" in text for text in telegram_bot.get_texts())
+
+
+def test_full_queue_rejects_messages(bot, telegram_bot, llm_provider, monkeypatch):
+    monkeypatch.setattr(bot.config.message_queue_config, "max_size", 1)
+    llm_provider.first_token_latency_sec = 0.2
+    send_messages(bot, telegram_bot, 37002, [(0, "first"), (0.05, "second"), (0.1, "third")])
+
+    assert llm_provider.requests == ["first", "second"]
+    assert sum("Please <b>wait</b>" in text for text in telegram_bot.get_texts()) == 1
+
+
+def test_fragments_are_coalesced(bot, telegram_bot, llm_provider, monkeypatch):
+    monkeypatch.setattr(bot.config.message_queue_config, "coalesce_window_sec", 0.1)
+    send_messages(bot, telegram_bot, 37003, [(0, "first"), (0.05, "second")])
+
+    assert llm_provider.requests == ["first\nsecond"]
+
+
+def test_cancel_during_coalescing_window(bot, telegram_bot, llm_provider, monkeypatch):
+    monkeypatch.setattr(bot.config.message_queue_config, "coalesce_window_sec", 0.3)
+    send_messages(bot, telegram_bot, 37004, [(0, "first"), (0.1, "/cancel")])
+
+    assert llm_provider.requests == []
+    assert "✅ Canceled" in telegram_bot.get_texts()
+    assert bot.db.get_dialog_messages(37004) == []
+    assert 37004 not in bot.user_tasks
+
+
+def get_sample_value(name):
+    return REGISTRY.get_sample_value(name) or 0.0
+
+
+def test_time_to_first_token_is_observed_at_the_first_chunk(bot, telegram_bot, llm_provider):
+    # the first edit waits for 100 characters, which come long after the first token here
+    llm_provider.first_token_latency_sec = 0.05
+    llm_provider.n_more_chunks, llm_provider.chunk_interval_sec = 30, 0.02
+    count_before = get_sample_value("bot_time_to_first_token_seconds_count")
+    sum_before = get_sample_value("bot_time_to_first_token_seconds_sum")
+
+    send_messages(bot, telegram_bot, 38001, [(0, "hi")])
+
+    assert get_sample_value("bot_time_to_first_token_seconds_count") == count_before + 1
+    assert 0.05 <= get_sample_value("bot_time_to_first_token_seconds_sum") - sum_before < 0.3
+
+
+def test_balance_after_model_is_removed(bot, telegram_bot, monkeypatch, snapshot_data):
+    user_id = 40001
+    bot.db.add_new_user(user_id, user_id)
+    bot.db.set_user_attribute(user_id, "current_model", "gpt-4")
+    bot.db.update_n_used_tokens(user_id, "gpt-4", 1000, 1000)
+    bot.db.update_n_used_tokens(user_id, "gpt-3.5-turbo", 1000, 1000)
+
+    # gpt-4 removed from models.yml by a reload
+    chat_modes_data, models_data = snapshot_data
+    models_data["available_text_models"].remove("gpt-4")
+    del models_data["info"]["gpt-4"]
+    monkeypatch.setattr(bot.config, "snapshot", bot.config.ConfigSnapshot(chat_modes_data, models_data))
+    monkeypatch.setattr(bot.config.quota_config, "enable", True)
+    monkeypatch.setattr(bot.config.quota_config, "user_limits", bot.config.QuotaLimits({"tokens_per_day": 5000}))
+
+    send_messages(bot, telegram_bot, user_id, [(0, "/balance")], handler=bot.show_balance_handle)
+
+    text, = telegram_bot.get_texts()
+    assert "You used <b>4000</b> tokens" in text
+    assert "gpt-4 (no longer available): <b>2000 tokens</b>" in text
+    assert "- gpt-4: <b>5000 tokens</b>" in text  # left today of the current model
+
+
+@pytest.fixture
+def group_chat(bot, monkeypatch):
+    monkeypatch.setattr(bot.config.group_chat_config, "enable", True)
+    monkeypatch.setattr(bot.config.group_chat_config, "batch_window_sec", 5)
+
+
+def test_retry_is_refused_in_group_chats(bot, telegram_bot, llm_provider, group_chat):
+    send_messages(bot, telegram_bot, 48001, [(0, "hi")])
+    send_messages(bot, telegram_bot, 48001, [(0, "/retry")], handler=bot.retry_handle, chat_id=-48001)
+
+    assert llm_provider.requests == ["hi"]  # not answered again, and in public
+    assert [dialog_message["user"] for dialog_message in bot.db.get_dialog_messages(48001)] == ["hi"]
+    assert "not available in group chats" in telegram_bot.get_texts()[-1]
+
+
+def test_shutdown_does_not_wait_for_group_chat_batch(bot, telegram_bot, llm_provider, group_chat, monkeypatch):
+    coordinator = shutdown.ShutdownCoordinator(bot.user_tasks, 10, waiting_tasks=bot.chat_wait_tasks)
+    monkeypatch.setattr(bot, "shutdown_coordinator", coordinator)
+    context = SimpleNamespace(bot=telegram_bot)
+    handler_tasks = []
+
+    async def main():
+        await telegram_bot.initialize()
+        for user_id in [48002, 48003]:
+            update = make_update(telegram_bot, user_id, "@test_bot hi", chat_id=-48002)
+            handler_tasks.append(asyncio.create_task(bot.message_handle(update, context)))
+        await asyncio.sleep(0.1)  # both mentions wait for the batch window
+        coordinator.request_stop(SimpleNamespace(updater=None))
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.create_task(main())
+        loop.run_forever()  # until drained
+        loop.run_until_complete(asyncio.gather(*handler_tasks))
+    finally:
+        loop.close()
+
+    assert llm_provider.requests == []
+    assert coordinator.report["n_cancelled_waits"] == 1
+    assert coordinator.report["drain_time_sec"] < 1
+    assert any("restarting" in text for text in telegram_bot.get_texts())
+    assert bot.chat_wait_tasks == {} and bot.chat_message_queues == {}
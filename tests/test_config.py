@@ -0,0 +1,32 @@
+import pytest
+
+import config
+
+
+def test_snapshot(snapshot_data):
+    snapshot = config.ConfigSnapshot(*snapshot_data)
+    assert snapshot.available_text_models[0] in snapshot.models
+    assert snapshot.models["gpt-4"].type == "chat_completion"
+    assert snapshot.models["gpt-4"].get_cost(n_input_tokens=1000) == snapshot.models["gpt-4"].price_per_1000_input_tokens
+    assert "assistant" in snapshot.chat_mode_keys
+
+
+def test_snapshot_rejects_undescribed_model(snapshot_data):
+    chat_modes_data, models_data = snapshot_data
+    models_data["available_text_models"].append("gpt-5")
+    with pytest.raises(ValueError, match="gpt-5"):
+        config.ConfigSnapshot(chat_modes_data, models_data)
+
+
+def test_snapshot_rejects_unknown_parse_mode(snapshot_data):
+    chat_modes_data, models_data = snapshot_data
+    chat_modes_data["assistant"]["parse_mode"] = "rst"
+    with pytest.raises(ValueError, match="parse_mode"):
+        config.ConfigSnapshot(chat_modes_data, models_data)
+
+
+def test_snapshot_requires_model_type(snapshot_data):
+    chat_modes_data, models_data = snapshot_data
+    del models_data["info"]["gpt-4"]["type"]
+    with pytest.raises(KeyError):
+        config.ConfigSnapshot(chat_modes_data, models_data)
@@ -0,0 +1,312 @@
+import logging
+from datetime import datetime, timedelta
+
+from types import SimpleNamespace
+
+import pytest
+
+import config
+import database
+
+
+def test_bootstrap_schema_creates_indexes(db):
+    db.bootstrap_schema()  # a second time, e.g. by a restarted bot
+    for collection_name, indexes in database.INDEXES.items():
+        index_names = db.db[collection_name].index_information().keys()
+        for index in indexes:
+            assert index.document["name"] in index_names
+    assert database.USAGE_LOG_TTL_INDEX_NAME in db.db["usage_log"].index_information()
+
+
+def test_ttl_index_is_dropped_when_disabled(db):
+    db._ensure_ttl_index("archived_dialog", "archived_at", database.ARCHIVED_DIALOG_TTL_INDEX_NAME, 30)
+    assert database.ARCHIVED_DIALOG_TTL_INDEX_NAME in db.db["archived_dialog"].index_information()
+
+    db._ensure_ttl_index("archived_dialog", "archived_at", database.ARCHIVED_DIALOG_TTL_INDEX_NAME, None)
+    assert database.ARCHIVED_DIALOG_TTL_INDEX_NAME not in db.db["archived_dialog"].index_information()
+
+
+def test_slow_database_call_is_logged_with_query_shape(db, caplog):
+    db.add_new_user(1, 1)
+    db.profiler.slow_query_threshold_ms = 0
+
+    with caplog.at_level(logging.WARNING, logger="database"):
+        db.get_user_attribute(1, "current_model")
+    assert "Database.get_user_attribute" in caplog.text
+    assert "user.find_one({'_id': 'int'})" in caplog.text
+
+
+def test_profiler_reports_top_level_calls_only(db):
+    calls = []
+    db.profiler.listeners.append(lambda method_name, elapsed_seconds: calls.append(method_name))
+
+    db.add_new_user(1, 1)
+    db.start_new_dialog(1)  # reads the user with _get_user_attributes, which is not reported on its own
+    assert calls == ["add_new_user", "start_new_dialog"]
+
+
+def add_old_dialogs(db, user_id, n_dialogs):
+    for i in range(n_dialogs):
+        db.dialog_collection.insert_one({
+            "_id": f"dialog_{i}", "user_id": user_id, "chat_mode": "assistant", "model": "gpt-3.5-turbo",
+            "start_time": datetime(2020, 1, 1), "messages": [{"user": f"question {i}", "bot": f"answer {i}"}]
+        })
+
+
+def test_archive_and_rehydrate_dialog(db):
+    db.add_new_user(1, 1)
+    add_old_dialogs(db, 1, 3)
+    current_dialog_id = db.start_new_dialog(1)
+
+    report = db.archive_dialogs(older_than_days=30)
+    assert report["n_archived_dialogs"] == 3
+    assert db.dialog_collection.count_documents({}) == 1  # the current dialog stays
+    assert db.archived_dialog_collection.count_documents({}) == 3
+
+    # an archived dialog is moved back when it is read
+    assert db.get_dialog_messages(1, "dialog_1") == [{"user": "question 1", "bot": "answer 1"}]
+    assert db.dialog_collection.find_one({"_id": "dialog_1"})["chat_mode"] == "assistant"
+    assert db.archived_dialog_collection.find_one({"_id": "dialog_1"}) is None
+    assert db.get_dialog_messages(1, current_dialog_id) == []
+
+
+def test_archive_after_interrupted_run(db):
+    db.add_new_user(1, 1)
+    add_old_dialogs(db, 1, 3)
+    db.archive_dialogs(older_than_days=30)
+
+    # the process stopped after inserting into archived_dialog and before deleting from dialog
+    for archived_dialog in db.archived_dialog_collection.find():
+        db.dialog_collection.insert_one(database.unarchive_dialog(archived_dialog))
+    db.dialog_collection.update_one({"_id": "dialog_0"}, {"$set": {"messages": []}})
+
+    assert db.archive_dialogs(older_than_days=30)["n_archived_dialogs"] == 3
+    assert db.dialog_collection.count_documents({}) == 0
+    assert db.get_dialog_messages(1, "dialog_0") == []  # the newer copy was kept
+    assert db.get_dialog_messages(1, "dialog_2") == [{"user": "question 2", "bot": "answer 2"}]
+
+
+def test_import_dialogs_skips_existing_and_archived(db):
+    db.add_new_user(1, 1)
+    add_old_dialogs(db, 1, 3)
+    db.archive_dialogs(older_than_days=30)
+    dialogs = list(db.iter_dialogs())
+    dialogs.append({"_id": "dialog_new", "user_id": 1, "start_time": datetime(2020, 1, 1), "messages": []})
+
+    assert db.import_dialogs(dialogs, batch_size=2) == {"n_imported_dialogs": 1, "n_skipped_dialogs": 3}
+    assert db.import_dialogs(dialogs, batch_size=2) == {"n_imported_dialogs": 0, "n_skipped_dialogs": 4}
+    assert db.dialog_collection.count_documents({}) == 1  # archived dialogs don't come back next to their copy
+    assert db.archived_dialog_collection.count_documents({}) == 3
+
+
+def test_flush_last_interactions_keeps_latest(db):
+    db.add_new_user(1, 1)
+    db.add_new_user(2, 2)
+    stored_last_interaction = db.user_collection.find_one({"_id": 1})["last_interaction"]
+
+    older, newer = stored_last_interaction - timedelta(hours=1), stored_last_interaction + timedelta(hours=1)
+    db.set_last_interaction(1, older)  # e.g. written by another worker meanwhile
+    db.set_last_interaction(2, newer)
+    assert db.get_user_attribute(1, "last_interaction") == older  # pending values are read before the flush
+
+    assert db.flush_last_interactions() == 2
+    assert db.flush_last_interactions() == 0
+    assert db.user_collection.find_one({"_id": 1})["last_interaction"] == stored_last_interaction
+    assert db.user_collection.find_one({"_id": 2})["last_interaction"] == newer
+
+
+def test_flush_last_interactions_keeps_pending_values_until_written(db, monkeypatch):
+    db.add_new_user(1, 1)
+    db.add_new_user(2, 2)
+    first, second = datetime(2030, 1, 1), datetime(2030, 1, 2)
+    db.set_last_interaction(1, first)
+    db.set_last_interaction(2, first)
+    user_collection_bulk_write = db.user_collection.bulk_write
+
+    def failing_bulk_write(requests, ordered=True):
+        assert db.get_user_attribute(1, "last_interaction") == first  # still pending during the write
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(db.user_collection, "bulk_write", failing_bulk_write)
+    with pytest.raises(RuntimeError):
+        db.flush_last_interactions()
+
+    def bulk_write(requests, ordered=True):
+        db.set_last_interaction(2, second)  # a message during the write
+        return user_collection_bulk_write(requests, ordered=ordered)
+
+    monkeypatch.setattr(db.user_collection, "bulk_write", bulk_write)
+    assert db.flush_last_interactions() == 2
+    monkeypatch.setattr(db.user_collection, "bulk_write", user_collection_bulk_write)
+
+    assert db.user_collection.find_one({"_id": 1})["last_interaction"] == first
+    assert db.get_user_attribute(2, "last_interaction") == second
+    assert db.flush_last_interactions() == 1
+    assert db.user_collection.find_one({"_id": 2})["last_interaction"] == second
+
+
+class RecordingCollection:
+    def __init__(self, name, writes):
+        self.name = name
+        self._writes = writes
+
+    def bulk_write(self, requests, ordered=True, session=None):
+        self._writes.append((self.name, len(requests)))
+
+
+def test_unit_of_work_writes_dialogs_before_users():
+    writes = []
+    user_collection, dialog_collection = RecordingCollection("user", writes), RecordingCollection("dialog", writes)
+    unit_of_work = database.UnitOfWork(SimpleNamespace(profiler=database.QueryProfiler(None)))
+
+    unit_of_work.add(user_collection, "set current_dialog_id")
+    unit_of_work.add(dialog_collection, "insert dialog")
+    unit_of_work.add(user_collection, "set current_model")
+    assert writes == []
+
+    unit_of_work.commit()
+    assert writes == [("dialog", 1), ("user", 2)]
+
+    unit_of_work.commit()  # nothing left to write
+    assert writes == [("dialog", 1), ("user", 2)]
+
+
+def test_unit_of_work_reads_its_own_writes(db):
+    db.add_new_user(1, 1)
+    old_dialog_id = db.start_new_dialog(1)
+
+    with db.unit_of_work():
+        dialog_id = db.start_new_dialog(1)
+        db.set_user_attribute(1, "current_model", "gpt-4")
+        db.set_dialog_messages(1, [{"user": "hi", "bot": "hello"}])
+
+        assert db.get_user_attribute(1, "current_dialog_id") == dialog_id
+        assert db.get_user_attribute(1, "current_model") == "gpt-4"
+        assert db.get_dialog_messages(1) == [{"user": "hi", "bot": "hello"}]
+        # nothing is written before the end of the block
+        assert db.user_collection.find_one({"_id": 1})["current_dialog_id"] == old_dialog_id
+        assert db.dialog_collection.find_one({"_id": dialog_id}) is None
+
+    assert db.user_collection.find_one({"_id": 1})["current_dialog_id"] == dialog_id
+    assert db.get_dialog_messages(1, dialog_id) == [{"user": "hi", "bot": "hello"}]
+
+
+def test_update_n_used_tokens(db):
+    db.add_new_user(1, 1)
+    db.update_n_used_tokens(1, "gpt-3.5-turbo", 10, 5)
+
+    with db.unit_of_work():
+        db.update_n_used_tokens(1, "gpt-3.5-turbo", 1, 1)
+        db.update_n_used_tokens(1, "gpt-4", 7, 3)
+        assert db.get_n_used_tokens(1) == {
+            "gpt-3.5-turbo": {"n_input_tokens": 11, "n_output_tokens": 6},
+            "gpt-4": {"n_input_tokens": 7, "n_output_tokens": 3},
+        }
+        db.update_n_used_tokens(1, "gpt-4", 1, 1)  # e.g. by another handler of the user
+        assert db.get_n_used_tokens(1)["gpt-4"] == {"n_input_tokens": 8, "n_output_tokens": 4}
+
+    assert db.get_n_used_tokens(1) == {
+        "gpt-3.5-turbo": {"n_input_tokens": 11, "n_output_tokens": 6},
+        "gpt-4": {"n_input_tokens": 8, "n_output_tokens": 4},
+    }
+
+
+def test_user_migration_escapes_model_keys():
+    updates = database.get_user_migration_updates({
+        "schema_version": 2,
+        "n_used_tokens": {
+            "gpt-3.5-turbo": {"n_input_tokens": 1, "n_output_tokens": 2},
+            database.encode_model_key("gpt-3.5-turbo"): {"n_input_tokens": 10, "n_output_tokens": 20},
+            "gpt-4": {"n_input_tokens": 3, "n_output_tokens": 4},
+        }
+    })
+    assert updates == {
+        "n_used_tokens": {
+            database.encode_model_key("gpt-3.5-turbo"): {"n_input_tokens": 11, "n_output_tokens": 22},
+            "gpt-4": {"n_input_tokens": 3, "n_output_tokens": 4},
+        },
+        "schema_version": database.USER_SCHEMA_VERSION,
+    }
+
+
+def test_counters_add_up_in_overlapping_handlers(db):
+    db.add_new_user(1, 1)
+
+    with db.unit_of_work():
+        db.update_n_transcribed_seconds(1, 10.5)
+        db.update_n_generated_images(1, 2)
+        assert db.get_user_attribute(1, "n_transcribed_seconds") == 10.5
+        assert db.get_user_attribute(1, "n_generated_images") == 2
+
+        # another handler of the user commits before this one
+        db.user_collection.update_one({"_id": 1}, {"$inc": {"n_transcribed_seconds": 3.0, "n_generated_images": 1}})
+        assert db.get_user_attribute(1, "n_transcribed_seconds") == 13.5
+
+    assert db.get_user_attribute(1, "n_transcribed_seconds") == 13.5
+    assert db.get_user_attribute(1, "n_generated_images") == 3
+
+
+def test_set_user_attribute_replaces_pending_increments(db):
+    db.add_new_user(1, 1)
+
+    with db.unit_of_work():
+        db.update_n_generated_images(1, 2)
+        db.set_user_attribute(1, "n_generated_images", 0)
+        db.update_n_generated_images(1, 1)
+        assert db.get_user_attribute(1, "n_generated_images") == 1
+
+    assert db.get_user_attribute(1, "n_generated_images") == 1
+
+
+@pytest.fixture
+def usage_aggregation(monkeypatch):
+    monkeypatch.setattr(config, "usage_aggregation_config", config.UsageAggregationConfiguration({"enable": True}))
+
+
+def test_usage_is_not_logged_when_disabled(db):
+    db.add_new_user(1, 1)
+    db.update_n_used_tokens(1, "gpt-4", 1000, 1000)
+    assert db.usage_log_collection.count_documents({}) == 0
+
+
+def test_usage_is_logged_with_its_cost(db, usage_aggregation):
+    db.add_new_user(1, 1)
+    db.update_n_used_tokens(1, "gpt-4", 1000, 2000)
+    db.update_n_generated_images(1, 2)
+    db.log_usage(1, "removed-model", n_input_tokens=10)
+
+    usage_dicts = {usage_dict["model"]: usage_dict for usage_dict in db.usage_log_collection.find()}
+    gpt4 = config.snapshot.models["gpt-4"]
+    assert usage_dicts["gpt-4"]["n_spent_dollars"] == pytest.approx(
+        gpt4.price_per_1000_input_tokens + 2 * gpt4.price_per_1000_output_tokens
+    )
+    assert usage_dicts["dalle-2"]["n_images"] == 2
+    assert usage_dicts["removed-model"]["n_spent_dollars"] == 0.0  # no price known
+
+
+def test_aggregate_usage(db, usage_aggregation):
+    for user_id in [1, 2]:
+        db.add_new_user(user_id, user_id)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    db.update_n_used_tokens(1, "gpt-4", 1000, 1000)
+    db.update_n_used_tokens(1, "gpt-4", 1000, 1000)
+    db.update_n_used_tokens(1, "gpt-3.5-turbo", 100, 100)
+    db.update_n_used_tokens(2, "gpt-3.5-turbo", 100, 100)
+    db.usage_log_collection.insert_one({  # yesterday, out of the range below
+        "user_id": 2, "time": today - timedelta(hours=1), "model": "gpt-4",
+        "n_input_tokens": 1, "n_output_tokens": 1, "n_images": 0, "n_transcribed_seconds": 0.0, "n_spent_dollars": 1.0
+    })
+
+    assert db.aggregate_usage(today) == 3
+    assert db.aggregate_usage(today) == 3  # reruns replace the summaries
+    assert db.usage_daily_collection.count_documents({}) == 3
+
+    totals = db.get_usage_summaries(today, group_by="model")
+    assert [total["_id"] for total in totals] == ["gpt-4", "gpt-3.5-turbo"]  # most expensive first
+    assert (totals[0]["n_input_tokens"], totals[1]["n_input_tokens"]) == (2000, 200)
+
+    top_spenders = db.get_usage_summaries(today, group_by="user_id", limit=1)
+    assert [top_spender["_id"] for top_spender in top_spenders] == [1]
+
+    user_totals = db.get_usage_summaries(today, user_id=2)
+    assert [(total["_id"], total["n_output_tokens"]) for total in user_totals] == [("gpt-3.5-turbo", 100)]
@@ -0,0 +1,40 @@
+import time
+
+import pytest
+
+from dialog_keeper import UserKeywords, parse_custom_settings, parse_keywords
+
+
+@pytest.mark.parametrize("message, expected_message, expected_keywords", [
+    ("hello", "hello", set()),
+    ("_IM remember this", "remember this", {UserKeywords.ADD_TO_IMPORTANT_MESSAGES}),
+    ("be brief _SM", "be brief", {UserKeywords.ADD_TO_SYSTEM_MESSAGES}),
+    ("_SM _IM both", "both", {UserKeywords.ADD_TO_SYSTEM_MESSAGES, UserKeywords.ADD_TO_IMPORTANT_MESSAGES}),
+    ("_UPDT", "", {UserKeywords.UPDATE_FROM_FILE}),
+    ("_IMPORTANT is not a keyword", "_IMPORTANT is not a keyword", set()),
+    ("my_IM is not a keyword", "my_IM is not a keyword", set()),
+    (" untouched whitespace ", " untouched whitespace ", set()),
+    ("remember _IM this", "remember  this", {UserKeywords.ADD_TO_IMPORTANT_MESSAGES}),
+])
+def test_parse_keywords(message, expected_message, expected_keywords):
+    assert parse_keywords(message) == (expected_message, expected_keywords)
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("", (None, None, None)),
+    ("no sections", (None, None, None)),
+    ("PROMPT: be kind", ("be kind", None, None)),
+    ("PROMPT: be kind\nPREV: we met\nSUMMARY_FORMAT: a list", ("be kind", "we met", "a list")),
+    ("SUMMARY_FORMAT: a list PREV: we met PROMPT: be kind", ("be kind", "we met", "a list")),
+    ("PROMPT: first PROMPT: second", ("first", None, None)),
+    ("PROMPT:", ("", None, None)),
+])
+def test_parse_custom_settings(message, expected):
+    assert parse_custom_settings(message) == expected
+
+
+def test_parsers_are_linear_on_long_messages():
+    start_time = time.perf_counter()
+    parse_custom_settings("PROMPT: " + "x" * 200000 + " PREV:" * 1000)
+    parse_keywords("_I" * 100000)
+    assert time.perf_counter() - start_time < 1
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+import group_chats
+
+
+@pytest.mark.parametrize("n, n_parts, shares", [
+    (10, 1, [10]),
+    (10, 2, [5, 5]),
+    (10, 3, [4, 3, 3]),
+    (2, 3, [1, 1, 0]),
+    (0, 2, [0, 0]),
+])
+def test_split_evenly(n, n_parts, shares):
+    assert group_chats.split_evenly(n, n_parts) == shares
+    assert sum(group_chats.split_evenly(n, n_parts)) == n
+
+
+def test_rate_limiter_waits_for_the_oldest_completion():
+    rate_limiter = group_chats.ChatRateLimiter(max_completions=2, period_sec=60)
+
+    async def main():
+        await rate_limiter.acquire(-1)
+        await rate_limiter.acquire(-1)
+        await rate_limiter.acquire(-2)  # other chats have their own limit
+
+    asyncio.run(main())
+    assert 59 < rate_limiter.get_wait_sec(-1) <= 60
+    assert rate_limiter.get_wait_sec(-2) == 0
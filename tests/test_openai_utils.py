@@ -0,0 +1,111 @@
+import asyncio
+
+import openai
+import pytest
+
+import config
+import llm_providers
+import metrics
+import openai_utils
+
+
+class DelayedProvider(llm_providers.LLMProvider):
+    # the n-th request waits delays[n] before its first chunk, "error" fails it
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.closed = []
+
+    async def complete(self, model, messages=None, prompt=None, stream=True, **options):
+        i = len(self.closed)
+        self.closed.append(False)
+        try:
+            if self.delays[i] == "error":
+                raise openai.error.RateLimitError("The model is overloaded")
+            await asyncio.sleep(self.delays[i])
+            for text in ["a", " b", " c"]:
+                yield llm_providers.CompletionChunk(text)
+                await asyncio.sleep(0.01)
+        finally:
+            self.closed[i] = True
+
+
+@pytest.fixture
+def hedging(monkeypatch, word_encoding):
+    monkeypatch.setattr(openai_utils, "first_token_latencies", openai_utils.FirstTokenLatencies())
+    monkeypatch.setattr(config, "hedging_config", config.HedgingConfiguration(
+        {"enable": True, "default_delay_sec": 0.3, "min_delay_sec": 0.1}
+    ))
+
+
+def complete(delays, stream=True):
+    provider = DelayedProvider(delays)
+    chatgpt = openai_utils.ChatGPT("gpt-3.5-turbo", provider=provider)
+
+    async def main():
+        if stream:
+            return [gen_item async for gen_item in chatgpt.send_message_stream("hi there")][-1]
+        return await chatgpt.send_message("hi there")
+
+    return asyncio.run(main()), chatgpt, provider
+
+
+def count_input_tokens():
+    chatgpt = openai_utils.ChatGPT("gpt-3.5-turbo")
+    messages, prompt, _ = chatgpt._generate_request("hi there", [], "assistant", None)
+    return chatgpt._count_tokens(messages, prompt, "")[0]
+
+
+def get_samples():
+    return list(openai_utils.first_token_latencies._samples.get("gpt-3.5-turbo", []))
+
+
+def test_fast_answer_is_not_hedged(hedging):
+    (status, answer, _, _), chatgpt, provider = complete([0.05])
+    assert (status, answer) == ("finished", "a b c")
+    assert provider.closed == [True]
+    assert chatgpt.n_used_tokens == (count_input_tokens(), 4)
+
+
+def test_slow_request_is_hedged_and_both_are_closed(hedging):
+    n_wins_before = metrics.HEDGED_COMPLETION_WINS.labels("gpt-3.5-turbo")._value.get()
+
+    (status, answer, _, _), chatgpt, provider = complete([2.0, 0.05])
+    assert (status, answer) == ("finished", "a b c")
+    assert provider.closed == [True, True]
+    assert metrics.HEDGED_COMPLETION_WINS.labels("gpt-3.5-turbo")._value.get() == n_wins_before + 1
+    # the duplicate's input is billed, the slow request streamed nothing
+    assert chatgpt.n_used_tokens == (2 * count_input_tokens(), 4)
+
+
+def test_loser_output_is_billed(hedging):
+    # both requests have their first chunk before the loser is closed
+    (_, answer, _, _), chatgpt, provider = complete([0.32, 0.02])
+    assert answer == "a b c"
+    assert provider.closed == [True, True]
+    assert chatgpt.n_used_tokens == (2 * count_input_tokens(), 4 + 1)
+
+
+def test_first_token_latency_is_measured_from_each_request(hedging):
+    complete([0.5, 0.05])
+    samples = get_samples()
+    assert len(samples) == 1  # the slow request was closed before its first token
+    assert samples[0] < 0.2  # not from when the first request was sent
+
+
+def test_error_falls_back_to_other_request(hedging):
+    (status, answer, _, _), chatgpt, provider = complete([2.0, "error"])
+    assert (status, answer) == ("finished", "a b c")
+    assert chatgpt.n_used_tokens == (count_input_tokens(), 4)  # the failed duplicate is not billed
+
+    with pytest.raises(openai.error.RateLimitError):
+        complete(["error"])
+
+
+def test_whole_answer_is_not_first_token(hedging):
+    ttft_sum_before = metrics.COMPLETION_TIME_TO_FIRST_TOKEN.labels("gpt-3.5-turbo")._sum.get()
+
+    (answer, _, _), _, provider = complete([0.05], stream=False)
+    assert answer == "a b c"
+    assert provider.closed == [True]  # only streaming is hedged
+    assert get_samples() == []
+    assert metrics.COMPLETION_TIME_TO_FIRST_TOKEN.labels("gpt-3.5-turbo")._sum.get() == ttft_sum_before
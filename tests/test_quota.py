@@ -0,0 +1,62 @@
+import mongomock
+import pytest
+
+import config
+import quota
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient()["chatgpt_telegram_bot"]["quota_usage"]
+
+
+def make_engine(collection, **config_data):
+    return quota.QuotaEngine(config.QuotaConfiguration(config_data), quota.QuotaStore(collection))
+
+
+def test_disabled_quota_allows_everything(collection):
+    engine = make_engine(collection, user={"tokens_per_day": 10})
+    engine.record_tokens(1, 1, False, "gpt-4", 100)
+    assert engine.choose_model(1, 1, False, "gpt-4") == "gpt-4"
+
+
+def test_choose_model_downgrades(collection):
+    engine = make_engine(
+        collection, enable=True, downgrade_model="gpt-3.5-turbo",
+        user={"tokens_per_day": {"gpt-4": 1000, "default": 5000}}
+    )
+    assert engine.choose_model(1, 1, False, "gpt-4") == "gpt-4"
+
+    engine.record_tokens(1, 1, False, "gpt-4", 1200)  # the last request may exceed the limit
+    assert engine.choose_model(1, 1, False, "gpt-4") == "gpt-3.5-turbo"
+    assert engine.choose_model(2, 2, False, "gpt-4") == "gpt-4"  # other users are not affected
+
+    engine.record_tokens(1, 1, False, "gpt-3.5-turbo", 5000)
+    assert engine.choose_model(1, 1, False, "gpt-4") is None
+    assert engine.choose_model(1, 1, False, "gpt-3.5-turbo") is None
+
+
+def test_group_chat_limit(collection):
+    engine = make_engine(collection, enable=True, group_chat={"tokens_per_day": 3000})
+    engine.record_tokens(1, -100, True, "gpt-3.5-turbo", 3000)
+    assert engine.choose_model(2, -100, True, "gpt-3.5-turbo") is None
+    assert engine.choose_model(2, 2, False, "gpt-3.5-turbo") == "gpt-3.5-turbo"
+
+
+def test_usage_is_shared_by_processes(collection):
+    config_data = {"enable": True, "user": {"tokens_per_day": 1000}}
+    engine, other_engine = make_engine(collection, **config_data), make_engine(collection, **config_data)
+    assert other_engine.choose_model(1, 1, False, "gpt-4") == "gpt-4"
+
+    engine.record_tokens(1, 1, False, "gpt-4", 1000)
+    engine.store.sync()
+    other_engine.store.sync()
+    assert other_engine.choose_model(1, 1, False, "gpt-4") is None
+
+
+def test_models_with_similar_names_have_own_counters(collection):
+    engine = make_engine(collection, enable=True, user={"tokens_per_day": 1000})
+    engine.record_tokens(1, 1, False, "gpt-3.5", 1000)
+    engine.store.sync()
+    assert engine.choose_model(1, 1, False, "gpt-3.5") is None
+    assert engine.choose_model(1, 1, False, "gpt-3_5") == "gpt-3_5"
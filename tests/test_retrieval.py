@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+import config
+import dialog_keeper
+import retrieval
+
+
+class RecordingEmbedder(retrieval.HashingEmbedder):
+    def __init__(self):
+        super().__init__(dim=4096)  # no collisions of the few words below
+        self.batch_sizes = []
+
+    async def embed(self, texts):
+        self.batch_sizes.append(len(texts))
+        return await super().embed(texts)
+
+
+def make_dialog_messages(n_turns, n_tokens=400):
+    return [{"user": f"word{i}", "bot": f"reply{i}", "n_tokens": n_tokens} for i in range(n_turns)]
+
+
+def test_memory_indexes_last_turns_in_batches():
+    embedder = RecordingEmbedder()
+    memory = retrieval.DialogMemory(embedder, max_n_turns=5, embedding_batch_size=2)
+    dialog_messages = make_dialog_messages(12)
+
+    asyncio.run(memory.update(dialog_messages))
+    assert memory.n_turns == 12
+    assert embedder.batch_sizes == [2, 2, 1]  # only the last 5 turns
+    assert asyncio.run(memory.search("word9", min_score=0.3))[0][1] == 9
+    assert asyncio.run(memory.search("word3", min_score=0.3)) == []  # too old
+
+    asyncio.run(memory.update(dialog_messages + make_dialog_messages(14)[12:]))
+    assert memory.n_turns == 14
+    assert asyncio.run(memory.search("word13", min_score=0.3))[0][1] == 13
+    assert asyncio.run(memory.search("word8", min_score=0.3)) == []
+
+    asyncio.run(memory.update(dialog_messages[:11]))  # e.g. /retry
+    assert memory.n_turns == 11
+    assert asyncio.run(memory.search("word13", min_score=0.3)) == []
+
+    asyncio.run(memory.update(dialog_messages[:3]))  # shorter than the turns no longer indexed
+    assert memory.n_turns == 3
+    assert asyncio.run(memory.search("word1", min_score=0.3))[0][1] == 1
+
+
+@pytest.fixture
+def keeper(monkeypatch, word_encoding):
+    monkeypatch.setattr(config.long_dialog_config, "retrieval", config.RetrievalConfiguration(
+        {"enable": True, "min_score": 0.3}
+    ))
+    monkeypatch.setattr(retrieval, "default_embedder", RecordingEmbedder())
+
+    keeper = dialog_keeper.DialogKeeper(1)
+    keeper.start_new_dialog("gpt-3.5-turbo", "custom")
+    keeper.generate_api_options("hi", [])  # the custom settings of the dialog
+    return keeper
+
+
+def generate_api_options(keeper, message, dialog_messages):
+    asyncio.run(keeper.recall(message, dialog_messages))
+    messages, _ = keeper.generate_api_options(message, dialog_messages)
+    recalled_messages = [
+        message for message in messages if message["content"].startswith(dialog_keeper.RECALLED_MESSAGES_HEADER)
+    ]
+    return messages, recalled_messages
+
+
+def test_relevant_old_turn_is_recalled(keeper):
+    dialog_messages = make_dialog_messages(30)
+    dialog_messages[3] = {"user": "where is the purple elephant", "bot": "behind the barn", "n_tokens": 400}
+
+    messages, recalled_messages = generate_api_options(keeper, "purple elephant again", dialog_messages)
+    assert len(recalled_messages) == 1
+    assert "User: where is the purple elephant\nAssistant: behind the barn" in recalled_messages[0]["content"]
+    assert messages[-1] == {"role": "user", "content": "purple elephant again"}
+    # only the tokens of the recalled turn are left free, it is short, so all recent turns that fit stay
+    assert len(messages) == 1 + 2 * 7 + 1
+
+
+def test_no_room_is_reserved_for_turns_in_the_window(keeper):
+    dialog_messages = make_dialog_messages(30)
+
+    messages, recalled_messages = generate_api_options(keeper, "word28", dialog_messages)
+    assert keeper._recalled_turns  # found, but it is recent
+    assert recalled_messages == []
+    assert len(messages) == 2 * 7 + 1  # as many recent turns as without retrieval
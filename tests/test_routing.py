@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import config
+import routing
+
+
+def make_router(**config_data):
+    return routing.ModelRouter(config.ModelRoutingConfiguration({"enable": True, **config_data}))
+
+
+def stream_answer(completion, message="hi"):
+    async def main():
+        return [gen_item async for gen_item in completion.send_message_stream(message, chat_mode="assistant")]
+
+    return asyncio.run(main())
+
+
+def test_fallback_is_opt_in():
+    router = make_router()
+    assert router.new_completion("gpt-3.5-turbo", "assistant").candidates == ["gpt-3.5-turbo"]
+    assert router.new_completion("gpt-3.5-turbo", "assistant", enable_fallback=True).candidates[0] == "gpt-3.5-turbo"
+
+
+def test_candidates_have_the_type_and_context_of_the_preferred_model():
+    router = make_router()
+    candidates = router.new_completion("gpt-3.5-turbo", "assistant", enable_fallback=True).candidates
+    assert set(candidates) == {"gpt-3.5-turbo", "gpt-3.5-turbo-16k", "gpt-4"}  # no completion models
+
+    candidates = router.new_completion("gpt-4", "custom", enable_fallback=True).candidates
+    assert candidates == ["gpt-4", "gpt-3.5-turbo-16k"]  # long dialogs don't fit into 4k
+
+    candidates = router.new_completion(
+        "gpt-3.5-turbo", "assistant", enable_fallback=True, is_model_allowed=lambda model: model != "gpt-4"
+    ).candidates
+    assert "gpt-4" not in candidates
+
+
+def test_fallback_before_first_token(llm_provider):
+    llm_provider.failing_models = {"gpt-3.5-turbo"}
+    router = make_router(moving_average_weight=0.5)
+
+    completion = router.new_completion("gpt-3.5-turbo", "assistant", enable_fallback=True)
+    status, answer, _, _ = stream_answer(completion)[-1]
+    assert (status, answer) == ("finished", "answer to hi")
+    assert completion.model != "gpt-3.5-turbo"
+    assert router.stats["gpt-3.5-turbo"].n_in_flight == 0
+
+    # marked as failing, so the next answers start with another model
+    assert not router.is_healthy("gpt-3.5-turbo")
+    assert router.new_completion("gpt-3.5-turbo", "assistant", enable_fallback=True).candidates[-1] == "gpt-3.5-turbo"
+
+
+def test_error_without_fallback(llm_provider):
+    llm_provider.failing_models = {"gpt-3.5-turbo"}
+    completion = make_router().new_completion("gpt-3.5-turbo", "assistant")
+    with pytest.raises(routing.openai.error.RateLimitError):
+        stream_answer(completion)
+
+
+def test_slow_first_token_marks_model_unhealthy(llm_provider):
+    llm_provider.first_token_latency_sec = 0.1
+    router = make_router(slow_first_token_sec=0.05)
+
+    stream_answer(router.new_completion("gpt-4", "assistant", enable_fallback=True))
+    assert router.stats["gpt-4"].time_to_first_token_sec >= 0.1
+    assert not router.is_healthy("gpt-4")
+
+
+def test_whole_answers_are_not_first_token_times(llm_provider):
+    # e.g. group chat answers or enable_message_streaming: false
+    llm_provider.first_token_latency_sec = 0.1
+    router = make_router(slow_first_token_sec=0.05)
+
+    completion = router.new_completion("gpt-4", "assistant", enable_fallback=True)
+    answer, _, _ = asyncio.run(completion.send_message("hi", chat_mode="assistant"))
+    assert answer == "answer to hi"
+    assert router.stats["gpt-4"].time_to_first_token_sec is None
+    assert router.is_healthy("gpt-4")
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import sharding
+
+
+def make_update(user_id, chat_id, chat_type="private", text="hi"):
+    chat = SimpleNamespace(id=chat_id, type=chat_type)
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=chat,
+        message=None if text is None else SimpleNamespace(chat=chat, text=text)
+    )
+
+
+def test_hash_ring_is_deterministic():
+    ring, other_ring = sharding.HashRing(4), sharding.HashRing(4)
+    for key in range(1000):
+        shard = ring.get_shard(key)
+        assert 0 <= shard < 4
+        assert shard == other_ring.get_shard(key)
+
+
+def test_hash_ring_spreads_keys():
+    ring = sharding.HashRing(4)
+    counts = [0] * 4
+    for key in range(10000):
+        counts[ring.get_shard(key)] += 1
+    assert min(counts) > 10000 / 4 * 0.7
+
+
+def test_hash_ring_moves_few_keys_on_resize():
+    ring, bigger_ring = sharding.HashRing(4), sharding.HashRing(5)
+    moved_keys = [key for key in range(10000) if ring.get_shard(key) != bigger_ring.get_shard(key)]
+    assert len(moved_keys) < 10000 * 0.3  # ~1/5 expected
+    assert all(bigger_ring.get_shard(key) == 4 for key in moved_keys)  # only to the new shard
+
+
+def test_routing_key():
+    update = make_update(user_id=1, chat_id=1)
+    assert sharding.get_routing_key(update) == 1
+
+    update.effective_user = None  # e.g. a channel post
+    assert sharding.get_routing_key(update) == 1
+
+
+def test_group_chat_routing_key():
+    group_update = make_update(user_id=1, chat_id=-100, chat_type="supergroup", text="@bot hi")
+    assert sharding.get_routing_key(group_update) == 1
+    assert sharding.get_routing_key(group_update, route_group_chats_by_chat=True) == -100
+    assert sharding.get_routing_key(make_update(1, 1), route_group_chats_by_chat=True) == 1
+
+    # commands and button callbacks change the user, so they go to the user's worker
+    command_update = make_update(user_id=1, chat_id=-100, chat_type="supergroup", text="/mode@bot")
+    assert sharding.get_routing_key(command_update, route_group_chats_by_chat=True) == 1
+    callback_update = make_update(user_id=1, chat_id=-100, chat_type="supergroup", text=None)
+    assert sharding.get_routing_key(callback_update, route_group_chats_by_chat=True) == 1
@@ -0,0 +1,109 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import shutdown
+
+
+class FakeUpdater:
+    def __init__(self):
+        self.running = True
+
+    async def stop(self):
+        self.running = False
+
+
+def run_until_drained(coordinator, application, start_tasks):
+    # drain() stops the event loop, like run_polling's loop is stopped in the bot
+    loop = asyncio.new_event_loop()
+    try:
+        async def main():
+            start_tasks()
+            coordinator.request_stop(application)
+
+        loop.create_task(main())
+        loop.run_forever()
+    finally:
+        loop.close()
+
+
+def test_drain_finishes_fast_answers_and_cancels_slow_ones():
+    user_tasks = {}
+    coordinator = shutdown.ShutdownCoordinator(user_tasks, drain_timeout_sec=0.2)
+    application = SimpleNamespace(updater=FakeUpdater())
+    events = []
+
+    async def answer(user_id, duration_sec):
+        try:
+            await asyncio.sleep(duration_sec)
+            events.append(("finished", user_id))
+        except asyncio.CancelledError:
+            assert coordinator.is_shutting_down
+            events.append(("saved partial answer", user_id))
+            raise
+
+    def start_tasks():
+        user_tasks[1] = asyncio.ensure_future(answer(1, 0.01))
+        user_tasks[2] = asyncio.ensure_future(answer(2, 10))
+
+    run_until_drained(coordinator, application, start_tasks)
+
+    assert not application.updater.running
+    assert sorted(events) == [("finished", 1), ("saved partial answer", 2)]
+    assert coordinator.report["n_drained_tasks"] == 1
+    assert coordinator.report["n_cancelled_tasks"] == 1
+    assert 0.2 <= coordinator.report["drain_time_sec"] < 5
+
+
+def test_drain_cancels_waiting_tasks_first():
+    user_tasks, waiting_tasks = {}, {}
+    coordinator = shutdown.ShutdownCoordinator(user_tasks, drain_timeout_sec=10, waiting_tasks=waiting_tasks)
+    events = []
+
+    async def wait_for_batch(chat_id):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            events.append(("told to ask again", chat_id))
+            raise
+
+    def start_tasks():
+        waiting_tasks[-1] = asyncio.ensure_future(wait_for_batch(-1))
+        user_tasks[1] = asyncio.ensure_future(asyncio.sleep(0.01))
+
+    run_until_drained(coordinator, SimpleNamespace(updater=None), start_tasks)
+
+    assert events == [("told to ask again", -1)]
+    assert coordinator.report["n_cancelled_waits"] == 1
+    assert coordinator.report["n_drained_tasks"] == 1
+    assert coordinator.report["drain_time_sec"] < 1
+
+
+def test_drain_without_answers():
+    coordinator = shutdown.ShutdownCoordinator({}, drain_timeout_sec=10)
+    run_until_drained(coordinator, SimpleNamespace(updater=None), lambda: None)
+    assert coordinator.report["n_drained_tasks"] == 0
+    assert coordinator.report["drain_time_sec"] < 1
+
+
+def test_flush_writes_dialog_keepers_and_last_interactions(db):
+    db.add_new_user(1, 1)
+    db.set_last_interaction(1, datetime(2030, 1, 1))
+
+    class FailingKeeper:
+        def flush(self):
+            raise OSError("disk full")
+
+    dialog_keepers = {
+        1: SimpleNamespace(flush=lambda: 3),
+        2: SimpleNamespace(flush=lambda: 0),
+        3: FailingKeeper(),  # the others are flushed anyway
+    }
+    coordinator = shutdown.ShutdownCoordinator({}, drain_timeout_sec=10)
+    coordinator.flush(dialog_keepers, db)
+
+    assert coordinator.report["n_flushed_dialog_keepers"] == 1
+    assert coordinator.report["n_flushed_dialog_messages"] == 3
+    assert coordinator.report["n_flushed_last_interactions"] == 1
+    assert db.user_collection.find_one({"_id": 1})["last_interaction"] == datetime(2030, 1, 1)
+    assert "flushed 1 dialog keepers with 3 messages" in shutdown.format_shutdown_report(coordinator.report)